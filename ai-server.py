@@ -1,16 +1,40 @@
-from flask import Flask, request, jsonify
-from transformers import pipeline, AutoProcessor, AutoModelForImageTextToText
+from flask import Flask, request, jsonify, Response, stream_with_context
+from transformers import AutoConfig, AutoImageProcessor, AutoModelForImageClassification, AutoProcessor, AutoModelForImageTextToText
 from PIL import Image
+import numpy as np
 import uuid, os
+import io
+import hashlib
+import sqlite3
+import gc
+from collections import OrderedDict
+from types import SimpleNamespace
 from flask_cors import CORS
 import time
+import threading
+import queue
+import asyncio
+import math
+import mmap
+import struct
+from concurrent.futures import Future, ThreadPoolExecutor
 import torch
 from werkzeug.utils import secure_filename
 import paramiko
 import json
+import shlex
 import getpass
 import markdown
 from dotenv import load_dotenv
+import pydicom
+from pydicom.pixels import pixel_array
+import nibabel
+import nrrd
+import gzip
+import shutil
+import tempfile
+import base64
+import requests
 
 load_dotenv()
 
@@ -32,13 +56,99 @@ CORS(app, origins=["http://10.102.196.113"], supports_credentials=True) # Allow
 UPLOAD_FOLDER = 'static/uploads'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# Load models
-skin_cancer_model = pipeline("image-classification", model="Anwarkh1/Skin_Cancer-Image_Classification")
-pneumonia_model = pipeline("image-classification", model="lxyuan/vit-xray-pneumonia-classification")
-breast_cancer_model = pipeline("image-classification", model="Falah/vit-base-breast-cancer")
-covid19_model = pipeline("image-classification", model="DunnBC22/vit-base-patch16-224-in21k_covid_19_ct_scans")
-brain_tumor_model_vit = pipeline("image-classification", model="DunnBC22/vit-base-patch16-224-in21k_brain_tumor_diagnosis")
-brain_tumor_model_resnet50 = pipeline("image-classification", model="Alia-Mohammed/resnet-50-finetuned-brain-tumor")
+# Micro-batching: gom tối đa BATCH_MAX_SIZE ảnh hoặc chờ tối đa BATCH_MAX_WAIT_MS
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "5"))
+
+# Fan-out nhiều model trong một request: tối đa MODEL_WORKERS model forward cùng lúc (mặc định 1: mỗi forward
+# dùng đủ số luồng mặc định của torch, request một model không bị chia nhỏ core). Đặt MODEL_WORKERS > 1 để
+# chạy song song, khi đó mỗi model dùng INTRA_OP_THREADS luồng (0 = số core / MODEL_WORKERS) để không vượt số core
+MODEL_WORKERS = int(os.getenv("MODEL_WORKERS", "1"))
+INTRA_OP_THREADS = int(os.getenv("INTRA_OP_THREADS", "0"))
+
+# Ingest: JPEG được decode thẳng ở tỉ lệ 1/2..1/8 (draft) sao cho cạnh ngắn vẫn ≥ INGEST_DRAFT_SIZE (0 = tắt);
+# ảnh vẫn lớn hơn INGEST_MAX_MEGAPIXELS sau decode sẽ được thu nhỏ. Bản lưu trữ là file gốc, ghi ở background
+INGEST_DRAFT_SIZE = int(os.getenv("INGEST_DRAFT_SIZE", "448"))
+INGEST_MAX_MEGAPIXELS = float(os.getenv("INGEST_MAX_MEGAPIXELS", "4"))
+# Giới hạn cứng trước khi decode: PNG/TIFF... không có draft nên phải decode đủ độ phân giải rồi mới thu nhỏ được,
+# ảnh lớn hơn mức này (tính sau draft) bị từ chối với 413 thay vì chiếm vài GB RAM (0 = tắt)
+INGEST_MAX_DECODE_MEGAPIXELS = float(os.getenv("INGEST_MAX_DECODE_MEGAPIXELS", "50"))
+
+# DICOM: frame dùng để chẩn đoán với file nhiều frame ("middle" hoặc số thứ tự, bắt đầu từ 0)
+DICOM_FRAME = os.getenv("DICOM_FRAME", "middle")
+
+# Volume (NIfTI, NRRD, Analyze .hdr/.img, DICOM nhiều frame/series): đọc bằng mmap, mỗi lần chỉ đọc
+# VOLUME_BATCH_SIZE slice để RAM không phụ thuộc số slice. Kết quả cả study gộp theo VOLUME_AGGREGATE
+# (mean | max | topk = trung bình VOLUME_TOP_K slice có độ tin cậy cao nhất)
+VOLUME_EXTENSIONS = (".nii", ".nii.gz", ".nrrd", ".hdr", ".img")
+VOLUME_BATCH_SIZE = int(os.getenv("VOLUME_BATCH_SIZE", "32"))
+VOLUME_TOP_K = int(os.getenv("VOLUME_TOP_K", "5"))
+VOLUME_AGGREGATE = os.getenv("VOLUME_AGGREGATE", "topk")
+
+# Upload một lần (/prepare): decode/convert + kiểm tra ảnh y tế (mục "gate" của registry) ngay trong process,
+# ảnh đã decode được giữ UPLOAD_TOKEN_TTL_S giây theo token (tổng tối đa UPLOAD_TOKEN_CACHE_MB) để lần submit
+# sau khi người dùng xác nhận chỉ cần gửi token. DICOM/volume được trả kèm ảnh xem trước PREVIEW_SIZE px
+# Token chỉ nằm trong RAM của worker đã nhận /prepare: worker khác trả 410 và webserver gửi lại file như cũ
+UPLOAD_TOKEN_TTL_S = float(os.getenv("UPLOAD_TOKEN_TTL_S", "600"))
+UPLOAD_TOKEN_CACHE_MB = float(os.getenv("UPLOAD_TOKEN_CACHE_MB", "256"))
+# Gate không có model trong registry thì có thể gọi image server bên ngoài: GATE_URL (vd http://<host>:8000/infer),
+# để trống = không kiểm tra (mọi ảnh được coi là ảnh y tế)
+GATE_URL = os.getenv("GATE_URL", "")
+GATE_TIMEOUT_S = float(os.getenv("GATE_TIMEOUT_S", "10"))
+PREVIEW_SIZE = int(os.getenv("PREVIEW_SIZE", "512"))
+
+# Chế độ chạy: flask (dev server như cũ) hoặc asgi (uvicorn + hàng đợi inference có giới hạn)
+SERVER_MODE = os.getenv("SERVER_MODE", "flask")
+# ASGI: số job inference chạy cùng lúc, số job được xếp hàng thêm, thời gian chờ tối đa trong hàng đợi
+ASGI_WORKERS = int(os.getenv("ASGI_WORKERS", "4"))
+ASGI_QUEUE_SIZE = int(os.getenv("ASGI_QUEUE_SIZE", "32"))
+ASGI_QUEUE_TIMEOUT_S = float(os.getenv("ASGI_QUEUE_TIMEOUT_S", "30"))
+VQA_WORKERS = int(os.getenv("VQA_WORKERS", "2"))
+VQA_QUEUE_SIZE = int(os.getenv("VQA_QUEUE_SIZE", "8"))
+
+# Multi-worker: AI_WORKERS process uvicorn (SERVER_MODE=asgi). Weights eager được ghi ra safetensors trong
+# SHARED_WEIGHTS_FOLDER và mmap vào mọi worker, nên page cache của OS chỉ giữ một bản cho tất cả worker
+AI_WORKERS = int(os.getenv("AI_WORKERS", "1"))
+SHARED_WEIGHTS = os.getenv("SHARED_WEIGHTS", "1" if AI_WORKERS > 1 else "0")
+SHARED_WEIGHTS_FOLDER = os.getenv("SHARED_WEIGHTS_FOLDER", "shared_weights")
+
+# Cache kết quả theo (sha256 ảnh, model, revision): LRU trong RAM + SQLite trên đĩa
+# RESULT_CACHE_DB rỗng = chỉ cache trong RAM (benchmark/script load ai-server không ghi vào cache thật)
+CACHE_FOLDER = 'cache'
+os.makedirs(CACHE_FOLDER, exist_ok=True)
+RESULT_CACHE_DB = os.getenv("RESULT_CACHE_DB", os.path.join(CACHE_FOLDER, "diagnose_cache.db"))
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "2048"))
+
+# Registry khai báo các model: repo/revision trên HF Hub, backend, preprocessing, bản dịch nhãn.
+# "preprocessing" ghi đè thuộc tính của image processor (vd: {"image_mean": [...], "size": {...}})
+MODEL_REGISTRY_FILE = os.getenv("MODEL_REGISTRY", "models.json")
+
+# Cascade: với các cặp model cùng cơ quan (khai báo ở mục "cascades" của registry), model rẻ chạy trước,
+# model đắt chỉ chạy khi top score < threshold hoặc nhãn của model rẻ không quy đổi được.
+# Bật mặc định bằng CASCADE_MODE=1, hoặc theo từng request với form field cascade=1
+CASCADE_MODE = os.getenv("CASCADE_MODE", "0")
+
+# Explain trong process: heatmap tính từ chính lần forward cho ra top_label (ViT: attention rollout,
+# ResNet: Grad-CAM), thay cho việc gửi ảnh sang explain server. Bật theo request với form field explain=1
+# (EXPLAIN_MODE=1 để bật mặc định). Registry có thể ghi đè phương pháp bằng "explain" (null = tắt).
+# explain=saliency trả saliency thô (PNG xám 8-bit, vài trăm byte) + vùng ảnh model nhìn thấy thay cho ảnh đã tô,
+# để client tự tô lên ảnh gốc và lưu trữ nhỏ hơn hàng chục lần
+EXPLAIN_MODE = os.getenv("EXPLAIN_MODE", "0")
+EXPLAIN_ALPHA = float(os.getenv("EXPLAIN_ALPHA", "0.5"))
+
+# Token cho các endpoint /admin (không đặt → tắt các endpoint này)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# Model chỉ được load khi có request đầu tiên; vượt ngân sách RAM thì bỏ model ít dùng nhất
+MODEL_MEMORY_BUDGET_MB = float(os.getenv("MODEL_MEMORY_BUDGET_MB", "0"))  # 0 = không giới hạn
+MODEL_PINNED = os.getenv("MODEL_PINNED", "")  # vd: "skin_cancer_vit,pneumonia_vit"
+
+# Backend inference cho từng model: eager (fp32, mặc định), int8 (dynamic quantization), onnx (ONNX Runtime)
+# Mặc định lấy từ registry; biến môi trường này ghi đè, vd: MODEL_BACKENDS="skin_cancer_vit=int8,pneumonia_vit=onnx"
+# File .onnx tạo bằng export_backends.py
+MODEL_BACKENDS = os.getenv("MODEL_BACKENDS", "")
+ONNX_FOLDER = os.getenv("ONNX_FOLDER", "onnx_models")
+
 # Vision qa models
 
 #terminal auth: hf-auth-login
@@ -77,130 +187,1645 @@ def parse_model_names(model_name_str):
     return unique_models
 
 
+def parse_backends(backend_str):
+    backends = {}
+    for item in parse_model_names(backend_str):
+        name, _, backend = item.partition("=")
+        backends[name.strip()] = backend.strip() or "eager"
+    return backends
+
+
+def preprocess_spec(processor):
+    """Rút cấu hình resize/normalize từ image processor của model."""
+    size = getattr(processor, "size", None) or {}
+    try:
+        resample = int(getattr(processor, "resample", Image.BILINEAR))
+    except (TypeError, ValueError):
+        resample = int(Image.BILINEAR)
+
+    if getattr(processor, "do_resize", True) and "height" in size and "width" in size:
+        resize = ("fixed", size["height"], size["width"], resample)
+    elif getattr(processor, "do_resize", True) and "shortest_edge" in size and getattr(processor, "crop_pct", None):
+        # Kiểu ConvNext/ResNet: resize cạnh ngắn = shortest_edge / crop_pct rồi center crop
+        resize = ("shortest_edge_crop", size["shortest_edge"], processor.crop_pct, resample)
+    else:
+        # Processor lạ → để chính processor xử lý (vẫn chỉ chạy một lần cho mỗi cấu hình)
+        resize = ("processor", processor.to_json_string())
+
+    spec = {"resize": resize, "vectorized": resize[0] != "processor", "processor": processor}
+    if spec["vectorized"]:
+        spec["rescale_factor"] = processor.rescale_factor if getattr(processor, "do_rescale", True) else 1.0
+        if getattr(processor, "do_normalize", True):
+            spec["mean"] = torch.tensor(processor.image_mean, dtype=torch.float32).view(1, -1, 1, 1)
+            spec["std"] = torch.tensor(processor.image_std, dtype=torch.float32).view(1, -1, 1, 1)
+        else:
+            spec["mean"] = None
+            spec["std"] = None
+    return spec
+
+
+def resize_image(image, spec):
+    """Resize một ảnh RGB (hoặc xám "L") theo spec, trả về tensor uint8 (3, H, W) chưa normalize."""
+    kind = spec["resize"][0]
+    if kind == "processor":
+        return spec["processor"](images=image, return_tensors="pt")["pixel_values"][0]
+
+    if kind == "fixed":
+        _, height, width, resample = spec["resize"]
+        image = image.resize((width, height), resample=resample)
+    else:
+        _, shortest_edge, crop_pct, resample = spec["resize"]
+        if shortest_edge < 384:
+            target = int(shortest_edge / crop_pct)
+            w, h = image.size
+            if w <= h:
+                new_w, new_h = target, int(target * h / w)
+            else:
+                new_w, new_h = int(target * w / h), target
+            image = image.resize((new_w, new_h), resample=resample)
+            left = (new_w - shortest_edge) // 2
+            top = (new_h - shortest_edge) // 2
+            image = image.crop((left, top, left + shortest_edge, top + shortest_edge))
+        else:
+            image = image.resize((shortest_edge, shortest_edge), resample=resample)
+
+    array = np.asarray(image, dtype=np.uint8).copy()
+    if array.ndim == 2:
+        # Ảnh xám: resize một kênh rồi mới nhân ra 3 kênh, rẻ hơn convert("RGB") trước khi resize
+        return torch.from_numpy(array).expand(3, -1, -1)
+    return torch.from_numpy(array).permute(2, 0, 1)
+
+
+def prepare_inputs(image, entries):
+    """Decode một lần, resize một lần cho mỗi cấu hình processor, dùng chung cho mọi model."""
+    if not entries:
+        return {}
+    rgb = image.convert("RGB")
+    resized = {}
+    inputs = {}
+    for name, entry in entries.items():
+        spec = entry["spec"]
+        if spec["resize"] not in resized:
+            resized[spec["resize"]] = resize_image(rgb, spec)
+        inputs[name] = resized[spec["resize"]]
+    return inputs
+
+
+def normalize_batch(pixels, spec):
+    """Rescale + normalize cả batch bằng phép toán tensor thay vì từng ảnh."""
+    batch = torch.stack(pixels)
+    if not spec["vectorized"]:
+        return batch
+    batch = batch.to(torch.float32) * spec["rescale_factor"]
+    if spec["mean"] is not None:
+        batch = (batch - spec["mean"]) / spec["std"]
+    return batch
+
+
+def postprocess_logits(logits, config, top_k=5):
+    """Giống postprocess của pipeline image-classification: softmax + top k (class id, score)."""
+    if config.problem_type == "multi_label_classification" or config.num_labels == 1:
+        scores = logits.sigmoid()
+    else:
+        scores = logits.softmax(-1)
+    top_k = min(top_k, scores.shape[-1])
+    values, indices = scores.topk(top_k, dim=-1)
+
+    outputs = []
+    for row_values, row_indices in zip(values.tolist(), indices.tolist()):
+        outputs.append([
+            {"class_id": i, "score": v}
+            for v, i in zip(row_values, row_indices)
+        ])
+    return outputs
+
+
+def attention_rollout(attentions):
+    """Attention rollout: trung bình các head + residual, nhân dồn qua các layer; trả về (B, h, w) cho patch."""
+    rollout = None
+    for layer in attentions:
+        attention = layer.mean(dim=1)
+        attention = attention + torch.eye(attention.shape[-1], dtype=attention.dtype)
+        attention = attention / attention.sum(dim=-1, keepdim=True)
+        rollout = attention if rollout is None else attention @ rollout
+    # Hàng của token [CLS]: mức đóng góp của từng patch vào biểu diễn dùng để phân loại
+    patches = rollout[:, 0, 1:]
+    side = int(math.isqrt(patches.shape[-1]))
+    return patches[:, -side * side:].reshape(-1, side, side)
+
+
+def gradcam(model, pixel_values):
+    """Grad-CAM trên stage conv cuối của ResNet, cùng lần forward cho ra logits; trả về (logits, (B, h, w))."""
+    captured = {}
+
+    def hook(module, inputs, output):
+        # Weights mmap (shared weights) không requires_grad → bật grad từ feature map trở đi
+        captured["features"] = output if output.requires_grad else output.detach().requires_grad_()
+        return captured["features"]
+
+    handle = model.resnet.encoder.stages[-1].register_forward_hook(hook)
+    try:
+        with torch.enable_grad():
+            logits = model(pixel_values=pixel_values).logits
+            features = captured["features"]
+            # Mỗi ảnh trong batch độc lập (BatchNorm ở eval) nên lấy gradient của tổng là đủ
+            target = logits.gather(1, logits.argmax(dim=1, keepdim=True)).sum()
+            grads, = torch.autograd.grad(target, features)
+    finally:
+        handle.remove()
+    weights = grads.mean(dim=(2, 3), keepdim=True)
+    return logits.detach(), torch.relu((weights * features).sum(dim=1)).detach()
+
+
+def explain_forward(entry, pixel_values):
+    """Forward kèm saliency theo phương pháp của model; trả về (logits, saliency (B, h, w) đã chuẩn hóa 0..1)."""
+    model = entry["model"]
+    method = entry["meta"]["explain"]
+    if method == "attention_rollout":
+        # Model đã được chuyển sang attention eager lúc load (ModelManager._load) nên trả được attention
+        with torch.inference_mode():
+            output = model(pixel_values=pixel_values, output_attentions=True)
+        logits, saliency = output.logits, attention_rollout(output.attentions)
+    elif method == "gradcam":
+        logits, saliency = gradcam(model, pixel_values)
+    else:
+        raise ValueError(f"Phương pháp explain không hợp lệ: {method}")
+
+    low = saliency.amin(dim=(1, 2), keepdim=True)
+    high = saliency.amax(dim=(1, 2), keepdim=True)
+    return logits, ((saliency - low) / (high - low).clamp_min(1e-8)).float().numpy()
+
+
+class BatchScheduler:
+    """Gom request từ nhiều luồng thành một lần forward theo batch cho một model."""
+
+    def __init__(self, name, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS):
+        self.name = name
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.queue = queue.Queue()
+        # Luồng chỉ được tạo ở lần submit đầu tiên: script import ai-server không phải chạy sẵn một luồng cho mỗi model
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def submit(self, entry, pixels, explain=False):
+        """entry là model đã được request giữ lại, nên swap/evict giữa chừng không ảnh hưởng.
+
+        Future trả về (kết quả, timing), hoặc (kết quả, timing, saliency) khi explain=True.
+        """
+        if self.thread is None:
+            with self.start_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._loop, name=f"batch-{self.name}", daemon=True)
+                    self.thread.start()
+        future = Future()
+        self.queue.put((entry, pixels, future, time.perf_counter(), explain))
+        return future
+
+    def _collect(self):
+        # Chặn tới khi có request đầu tiên, sau đó chờ thêm tối đa max_wait
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout <= 0:
+                    batch.append(self.queue.get_nowait())
+                else:
+                    batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        # torch.set_num_threads là cấu hình toàn process, đã gọi một lần lúc khởi động
+        while True:
+            batch = self._collect()
+            # Trong lúc hot swap có thể có hai phiên bản model trong cùng một batch
+            # Ảnh cần explain chạy thành nhóm riêng để batch thường vẫn đi đường inference_mode nhanh
+            groups = OrderedDict()
+            for item in batch:
+                groups.setdefault((id(item[0]), item[4]), []).append(item)
+            for (_, explain), group in groups.items():
+                self._run(group, explain)
+
+    def _run(self, group, explain=False):
+        entry = group[0][0]
+        saliency = [None] * len(group)
+        try:
+            pixel_values = normalize_batch([item[1] for item in group], entry["spec"])
+            # Giữ một slot của worker pool trong lúc forward để các model không tranh nhau core
+            with inference_slots:
+                start = time.perf_counter()
+                if explain:
+                    logits, saliency = explain_forward(entry, pixel_values)
+                else:
+                    with torch.inference_mode():
+                        logits = entry["model"](pixel_values=pixel_values).logits
+            outputs = postprocess_logits(logits, entry["model"].config)
+        except Exception as e:
+            for item in group:
+                item[2].set_exception(e)
+            return
+        end = time.perf_counter()
+
+        for (_, _, future, enqueued_at, _), output, item_saliency in zip(group, outputs, saliency):
+            timing = {
+                "batch_size": len(group),
+                "queue_wait_ms": round((start - enqueued_at) * 1000, 2),
+                "inference_ms": round((end - start) * 1000, 2)
+            }
+            future.set_result((output, timing, item_saliency) if explain else (output, timing))
+
+
+def model_memory_bytes(model):
+    """Tổng dung lượng tensor trong state_dict (gồm cả packed params của model int8)."""
+    seen = set()
+    total = 0
+    stack = list(model.state_dict().values())
+    while stack:
+        value = stack.pop()
+        if isinstance(value, (tuple, list)):
+            stack.extend(value)
+        elif torch.is_tensor(value):
+            if value.is_quantized:
+                total += value.numel() * value.element_size()
+            elif value.data_ptr() not in seen:
+                seen.add(value.data_ptr())
+                total += value.numel() * value.element_size()
+    return total
+
+
+class OnnxClassifier:
+    """Bọc InferenceSession của ONNX Runtime để gọi giống model transformers."""
+
+    def __init__(self, path, config):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.config = config
+
+    def __call__(self, pixel_values):
+        logits = self.session.run(["logits"], {"pixel_values": pixel_values.numpy()})[0]
+        return SimpleNamespace(logits=torch.from_numpy(logits))
+
+
+def onnx_model_path(name):
+    return os.path.join(ONNX_FOLDER, name, "model.onnx")
+
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8,
+    "U8": torch.uint8, "BOOL": torch.bool
+}
+
+
+def shared_weights_path(name, config):
+    commit = getattr(config, "_commit_hash", None) or "local"
+    return os.path.join(SHARED_WEIGHTS_FOLDER, f"{name}-{commit}.safetensors")
+
+
+def save_shared_weights(model, path):
+    from safetensors.torch import save_file
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Nhiều worker có thể cùng ghi lần đầu: ghi file tạm riêng rồi rename
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    save_file({k: v.contiguous() for k, v in model.state_dict().items()}, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def mmap_state_dict(path):
+    """Đọc safetensors bằng mmap: tensor trỏ thẳng vào page cache, không copy vào RAM riêng của process."""
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        # ACCESS_COPY = MAP_PRIVATE: các worker dùng chung trang nhớ cho tới khi có ghi (inference không ghi)
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    state = {}
+    for key, info in header.items():
+        if key == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        count = (end - start) // torch.empty((), dtype=dtype).element_size()
+        tensor = torch.frombuffer(mm, dtype=dtype, count=count, offset=8 + header_size + start) if count else torch.empty(0, dtype=dtype)
+        state[key] = tensor.view(info["shape"])
+    return state, mm
+
+
+def load_shared_classifier(name, repo, revision="main"):
+    config = AutoConfig.from_pretrained(repo, revision=revision)
+    path = shared_weights_path(name, config)
+    if not os.path.exists(path):
+        model = AutoModelForImageClassification.from_pretrained(repo, revision=revision)
+        save_shared_weights(model, path)
+        del model
+        gc.collect()
+
+    state, mm = mmap_state_dict(path)
+    # Khởi tạo trên meta device (không cấp phát weights) rồi gán thẳng tensor mmap
+    with torch.device("meta"):
+        model = AutoModelForImageClassification.from_config(config)
+    model.load_state_dict(state, strict=True, assign=True)
+    if any(t.is_meta for t in list(model.parameters()) + list(model.buffers())):
+        print(f"[models] {name} có buffer ngoài state_dict, load bình thường thay vì mmap")
+        return AutoModelForImageClassification.from_pretrained(repo, revision=revision)
+    model._shared_weights = mm  # giữ mmap sống cùng model
+    return model
+
+
+def prepare_shared_weights(registry):
+    """Ghi trước safetensors cho các model eager để các worker chỉ việc mmap."""
+    for name, record in registry.items():
+        if record.get("backend", "eager") == "eager":
+            load_shared_classifier(name, record["repo"], record.get("revision", "main"))
+            print(f"[models] Shared weights sẵn sàng cho {name}")
+    gc.collect()
+
+
+def process_memory():
+    """RSS/PSS của process hiện tại (MB). PSS chia đều trang dùng chung cho các process đang map."""
+    memory = {}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("Rss", "Pss", "Shared_Clean", "Private_Clean", "Private_Dirty"):
+                    memory[key.lower() + "_mb"] = round(int(value.split()[0]) / 1024, 2)
+    except OSError:
+        import resource
+        memory["rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)
+    return memory
+
+
+def load_classifier(name, repo, revision="main", backend="eager", preprocessing=None):
+    """Load (model, image processor, số byte RAM) cho một model theo backend đã chọn."""
+    processor = AutoImageProcessor.from_pretrained(repo, revision=revision)
+    for key, value in (preprocessing or {}).items():
+        setattr(processor, key, value)
+
+    if backend == "onnx":
+        path = onnx_model_path(name)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Chưa export ONNX cho {name}: {path} (chạy export_backends.py)")
+        config = AutoConfig.from_pretrained(repo, revision=revision)
+        return OnnxClassifier(path, config), processor, os.path.getsize(path)
+
+    if backend == "eager" and SHARED_WEIGHTS == "1":
+        model = load_shared_classifier(name, repo, revision)
+    else:
+        model = AutoModelForImageClassification.from_pretrained(repo, revision=revision)
+    model.eval()
+    if backend == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif backend != "eager":
+        raise ValueError(f"Backend không hợp lệ cho {name}: {backend}")
+    return model, processor, model_memory_bytes(model)
+
+
+def load_registry(path=MODEL_REGISTRY_FILE):
+    with open(path, encoding="utf-8") as f:
+        registry = json.load(f)["models"]
+    for name, backend in parse_backends(MODEL_BACKENDS).items():
+        if name in registry:
+            registry[name]["backend"] = backend
+    return registry
+
+
+def load_cascades(registry, path=MODEL_REGISTRY_FILE):
+    with open(path, encoding="utf-8") as f:
+        cascades = json.load(f).get("cascades", {})
+    for name, cascade in cascades.items():
+        if len(cascade["stages"]) != 2 or any(m not in registry for m in cascade["stages"]):
+            raise ValueError(f"Cascade {name} phải gồm đúng 2 model có trong registry")
+    return cascades
+
+
+def save_registry(name, changes, path=MODEL_REGISTRY_FILE):
+    """Ghi thay đổi của một model vào file registry; override của MODEL_BACKENDS không bị ghi theo."""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    data["models"][name].update(changes)
+    # Ghi ra file tạm rồi rename để file registry không bao giờ bị ghi dở
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def compile_labels(config, record):
+    """Dịch nhãn một lần thành mảng đánh chỉ số theo class id."""
+    origin_labels = [config.id2label[i] for i in range(config.num_labels)]
+    translations = record.get("labels", {})
+    return {
+        "origin_labels": origin_labels,
+        "labels": [translations.get(label, label) for label in origin_labels]
+    }
+
+
+# Phương pháp explain mặc định theo kiến trúc model
+EXPLAIN_DEFAULTS = {"vit": "attention_rollout", "resnet": "gradcam"}
+
+
+def explain_method(record, config):
+    backend = record.get("backend", "eager")
+    method = record.get("explain", EXPLAIN_DEFAULTS.get(config.model_type))
+    # ONNX Runtime không trả attention/gradient; Linear int8 (dynamic) không backward được
+    if backend == "onnx" or (method == "gradcam" and backend == "int8"):
+        return None
+    return method
+
+
+def model_meta(name, record, config):
+    """Thông tin nhỏ của một revision: khóa cache + mảng nhãn + tên hiển thị."""
+    revision = getattr(config, "_commit_hash", None) or record.get("revision", "main")
+    backend = record.get("backend", "eager")
+    # Backend khác eager cho điểm số hơi khác fp32 nên được gắn vào revision dùng làm khóa cache
+    if backend != "eager":
+        revision = f"{revision}+{backend}"
+    return {
+        "revision": revision,
+        "display_name": record.get("display_name", name),
+        "explain": explain_method(record, config),
+        **compile_labels(config, record)
+    }
+
+
+class ModelManager:
+    """Load model khi dùng lần đầu, theo dõi RAM từng model và evict theo LRU khi vượt ngân sách."""
+
+    def __init__(self, registry, budget_mb=MODEL_MEMORY_BUDGET_MB, pinned=()):
+        self.registry = registry
+        self.budget_bytes = int(budget_mb * 1024 * 1024)
+        self.pinned = set(pinned) | {n for n, r in registry.items() if r.get("pinned")}
+        self.resident = OrderedDict()
+        self.metas = {}
+        self.swaps = {}
+        self.stats = {name: {"loads": 0, "evictions": 0, "last_load_ms": None} for name in registry}
+        self.lock = threading.Lock()
+        self.load_locks = {name: threading.Lock() for name in registry}
+
+    def backend(self, name):
+        return self.registry[name].get("backend", "eager")
+
+    def meta(self, name):
+        """Revision + nhãn của model, chỉ cần đọc config.json chứ không load weights."""
+        with self.lock:
+            if name in self.metas:
+                return self.metas[name]
+            record = self.registry[name]
+
+        config = AutoConfig.from_pretrained(record["repo"], revision=record.get("revision", "main"))
+        meta = model_meta(name, record, config)
+        with self.lock:
+            # Nếu vừa có swap thì giữ meta mới hơn
+            if self.registry[name] is record:
+                self.metas.setdefault(name, meta)
+            return self.metas.get(name, meta)
+
+    def get(self, name):
+        with self.lock:
+            if name in self.resident:
+                self.resident.move_to_end(name)
+                return self.resident[name]
+
+        # Mỗi model có lock riêng để hai request đồng thời không load trùng
+        with self.load_locks[name]:
+            with self.lock:
+                if name in self.resident:
+                    self.resident.move_to_end(name)
+                    return self.resident[name]
+                record = self.registry[name]
+
+            entry = self._load(name, record)
+
+            with self.lock:
+                if self.registry[name] is record:
+                    self.resident[name] = entry
+                    self.metas[name] = entry["meta"]
+                    self._evict(keep=name)
+        return entry
+
+    def _load(self, name, record):
+        start = time.perf_counter()
+        model, processor, nbytes = load_classifier(
+            name, record["repo"], record.get("revision", "main"),
+            record.get("backend", "eager"), record.get("preprocessing")
+        )
+        meta = model_meta(name, record, model.config)
+        if meta["explain"] == "attention_rollout":
+            # SDPA không trả attention: chuyển sang eager một lần trước khi model được dùng chung,
+            # thay vì đổi qua lại mỗi batch explain trong lúc luồng khác có thể đang forward
+            model.set_attn_implementation("eager")
+        load_ms = round((time.perf_counter() - start) * 1000, 2)
+
+        self.stats[name]["loads"] += 1
+        self.stats[name]["last_load_ms"] = load_ms
+        print(f"[models] Loaded {name} ({record.get('backend', 'eager')}) in {load_ms} ms")
+        return {
+            "model": model,
+            "spec": preprocess_spec(processor),
+            "bytes": nbytes,
+            "meta": meta
+        }
+
+    def _evict(self, keep):
+        if self.budget_bytes <= 0:
+            return
+        while sum(e["bytes"] for e in self.resident.values()) > self.budget_bytes:
+            victim = next((n for n in self.resident if n != keep and n not in self.pinned), None)
+            if victim is None:
+                print("[models] Vượt ngân sách RAM nhưng mọi model còn lại đều đang được pin/sử dụng")
+                break
+            # Request đang chạy vẫn giữ tham chiếu tới model cũ nên không bị gián đoạn
+            del self.resident[victim]
+            self.stats[victim]["evictions"] += 1
+            print(f"[models] Evicted {victim}")
+        gc.collect()
+
+    def warm(self, names):
+        for name in names:
+            try:
+                self.get(name)
+            except Exception as e:
+                print(f"[models] Không load được {name}: {e}")
+
+    def start_swap(self, name, changes, persist=False):
+        """Load + warm revision mới ở background rồi thay thế nguyên tử, không chặn request.
+
+        persist: chỉ ghi `changes` vào models.json, không ghi cả record đang chạy (có thể chứa override từ env).
+        """
+        with self.lock:
+            job = self.swaps.get(name)
+            if job and job["status"] in ("loading", "warming"):
+                return job
+            record = {**self.registry[name], **changes}
+            job = {"model": name, "status": "loading", "target": record, "error": None, "started_at": time.time()}
+            self.swaps[name] = job
+
+        threading.Thread(target=self._swap, args=(name, record, job, changes if persist else None), name=f"swap-{name}", daemon=True).start()
+        return job
+
+    def _swap(self, name, record, job, persist_changes):
+        try:
+            entry = self._load(name, record)
+
+            # Warm-up: chạy thử một batch để cấp phát bộ nhớ/kernels trước khi nhận traffic thật
+            job["status"] = "warming"
+            pixels = resize_image(Image.new("RGB", (256, 256)), entry["spec"])
+            with torch.inference_mode():
+                entry["model"](pixel_values=normalize_batch([pixels], entry["spec"]))
+
+            with self.lock:
+                self.registry[name] = record
+                self.metas[name] = entry["meta"]
+                self.resident[name] = entry
+                self.resident.move_to_end(name)
+                self._evict(keep=name)
+                if persist_changes:
+                    save_registry(name, persist_changes)
+            job["status"] = "done"
+            job["revision"] = entry["meta"]["revision"]
+            print(f"[models] Swapped {name} → {entry['meta']['revision']}")
+        except Exception as e:
+            job["status"] = "failed"
+            job["error"] = str(e)
+            print(f"[models] Swap {name} thất bại: {e}")
+        job["finished_at"] = time.time()
+
+    def snapshot(self):
+        with self.lock:
+            resident = {n: e["bytes"] for n, e in self.resident.items()}
+            metas = dict(self.metas)
+        return {
+            "pid": os.getpid(),
+            "shared_weights": SHARED_WEIGHTS == "1",
+            "process_memory": process_memory(),
+            "budget_mb": round(self.budget_bytes / 1024 / 1024, 2),
+            "resident_mb": round(sum(resident.values()) / 1024 / 1024, 2),
+            "models": {
+                name: {
+                    "resident": name in resident,
+                    "memory_mb": round(resident[name] / 1024 / 1024, 2) if name in resident else None,
+                    "pinned": name in self.pinned,
+                    "repo": record["repo"],
+                    "revision": metas[name]["revision"] if name in metas else record.get("revision", "main"),
+                    "backend": record.get("backend", "eager"),
+                    **self.stats[name]
+                }
+                for name, record in self.registry.items()
+            }
+        }
+
+
+model_manager = ModelManager(load_registry(), pinned=parse_model_names(MODEL_PINNED))
+
+# Worker pool cho forward pass: số model chạy song song × số luồng mỗi model ≈ số core
+# Khi chạy nhiều worker process, mỗi process chỉ dùng phần core của mình
+cpu_count = max(1, (os.cpu_count() or 1) // max(1, AI_WORKERS))
+model_workers = max(1, MODEL_WORKERS)
+inference_slots = threading.BoundedSemaphore(model_workers)
+# Chỉ chia luồng khi có nhiều forward/process chạy cùng lúc; một worker, một process giữ mặc định của torch
+if INTRA_OP_THREADS or model_workers > 1 or AI_WORKERS > 1:
+    torch.set_num_threads(INTRA_OP_THREADS or max(1, cpu_count // model_workers))
+intra_op_threads = torch.get_num_threads()
+print(f"[models] {model_workers} inference workers × {intra_op_threads} threads")
+
+batchers = {name: BatchScheduler(name) for name in model_manager.registry}
+
+cascades = load_cascades(model_manager.registry)
+
+
+def start_warmup():
+    """Load trước các model được pin ở background, server vẫn nhận request ngay.
+
+    Chỉ gọi khi chạy server (__main__, asgi.py), không gọi khi script khác import ai-server.
+    """
+    threading.Thread(target=model_manager.warm, args=(sorted(model_manager.pinned),), daemon=True).start()
+
+
+class ResultCache:
+    """Cache kết quả inference: LRU trong RAM, phía sau là bảng SQLite trên đĩa."""
+
+    def __init__(self, db_path=RESULT_CACHE_DB, max_entries=RESULT_CACHE_SIZE):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        if not self.db_path:
+            return
+
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('''CREATE TABLE IF NOT EXISTS results
+                        (image_hash TEXT NOT NULL,
+                         model_name TEXT NOT NULL,
+                         model_revision TEXT NOT NULL,
+                         results TEXT NOT NULL,
+                         created_at REAL,
+                         PRIMARY KEY (image_hash, model_name, model_revision))''')
+        conn.commit()
+        conn.close()
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return self.memory[key]
+            if not self.db_path:
+                self.stats["misses"] += 1
+                return None
+
+        conn = sqlite3.connect(self.db_path)
+        row = conn.execute(
+            "SELECT results FROM results WHERE image_hash=? AND model_name=? AND model_revision=?", key
+        ).fetchone()
+        conn.close()
+
+        with self.lock:
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            value = json.loads(row[0])
+            self._remember(key, value)
+            self.stats["disk_hits"] += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self._remember(key, value)
+        if not self.db_path:
+            return
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(
+            "INSERT OR REPLACE INTO results (image_hash, model_name, model_revision, results, created_at) VALUES (?,?,?,?,?)",
+            (*key, json.dumps(value), time.time())
+        )
+        conn.commit()
+        conn.close()
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["memory_entries"] = len(self.memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+
+result_cache = ResultCache()
+
+
+def saliency_cache_key(image_hash, model_name, meta):
+    # Heatmap dùng chung bảng cache với kết quả, phân biệt bằng phương pháp explain gắn vào revision
+    return image_hash, model_name, f"{meta['revision']}+{meta['explain']}"
+
+
+def run_models(model_names, entries, inputs, cached, image_hash, saliency=None):
+    """Gửi mọi model chưa có cache vào batcher cùng lúc, rồi gom kết quả theo đúng thứ tự ban đầu.
+
+    Model có trong dict saliency mà chưa có heatmap (None) được chạy kèm explain, heatmap được ghi vào saliency[model].
+    """
+    saliency = {} if saliency is None else saliency
+    futures = {}
+    for model_name in model_names:
+        if cached.get(model_name) is None:
+            explain = model_name in saliency and saliency[model_name] is None
+            futures[model_name] = batchers[model_name].submit(entries[model_name], inputs[model_name], explain)
+
+    outputs = {}
+    for model_name in model_names:
+        if model_name not in futures:
+            outputs[model_name] = cached[model_name], {"cached": True}
+            continue
+        meta = entries[model_name]["meta"]
+        if model_name in saliency and saliency[model_name] is None:
+            results, timing, saliency[model_name] = futures[model_name].result()
+            result_cache.put(saliency_cache_key(image_hash, model_name, meta), saliency[model_name].tolist())
+        else:
+            results, timing = futures[model_name].result()
+        result_cache.put((image_hash, model_name, meta["revision"]), results)
+        outputs[model_name] = results, dict(timing, cached=False)
+    return outputs
+
+
+def class_id_of(r, meta):
+    # Kết quả cache cũ chỉ có nhãn gốc, chưa có class_id
+    return r["class_id"] if "class_id" in r else meta["origin_labels"].index(r["label"])
+
+
+def format_result(results, meta, timing):
+    """Gắn nhãn gốc + nhãn tiếng Việt (tra mảng theo class id) cho kết quả một model."""
+    filtered_results = []
+    for r in results:
+        class_id = class_id_of(r, meta)
+        filtered_results.append({
+            "originLabel": meta["origin_labels"][class_id],
+            "label": meta["labels"][class_id],
+            "score": round(r["score"], 4)
+        })
+    best = max(filtered_results, key=lambda x: x["score"])
+    return {
+        "model": meta["display_name"],
+        "top_label": best["label"],
+        "top_label_origin": best["originLabel"],
+        "top_score": best["score"],
+        "details": filtered_results,
+        "timing": timing
+    }
+
+
+def input_box(image, spec):
+    """Vùng của ảnh gốc mà model thực sự nhìn thấy sau resize/center crop (left, top, right, bottom)."""
+    w, h = image.size
+    if spec["resize"][0] != "shortest_edge_crop" or spec["resize"][1] >= 384:
+        return 0, 0, w, h
+    _, shortest_edge, crop_pct, _ = spec["resize"]
+    # Tỉ lệ crop so với cạnh ngắn giống resize_image: shortest_edge / (shortest_edge / crop_pct)
+    side = min(w, h) * crop_pct
+    left, top = (w - side) / 2, (h - side) / 2
+    return round(left), round(top), round(left + side), round(top + side)
+
+
+def render_explanation(image, saliency, spec, alpha=EXPLAIN_ALPHA):
+    """Tô heatmap (colormap kiểu jet) lên đúng vùng ảnh mà model nhìn thấy, trả về JPEG base64."""
+    rgb = image.convert("RGB")
+    box = input_box(rgb, spec)
+    heat = Image.fromarray((saliency * 255).astype(np.uint8)).resize((box[2] - box[0], box[3] - box[1]), Image.BILINEAR)
+    x = np.asarray(heat, dtype=np.float32) / 255.0
+    colored = np.stack([np.clip(1.5 - np.abs(4 * x - k), 0, 1) for k in (3, 2, 1)], axis=-1) * 255
+    region = np.asarray(rgb.crop(box), dtype=np.float32)
+    rgb.paste(Image.fromarray((region * (1 - alpha) + colored * alpha).astype(np.uint8)), box[:2])
+    buffer = io.BytesIO()
+    rgb.save(buffer, "JPEG", quality=90)
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def active_cascades(models, enabled):
+    """Các cascade mà request chọn đủ cả hai model."""
+    if not enabled:
+        return {}
+    return {name: c for name, c in cascades.items() if all(m in models for m in c["stages"])}
+
+
+def cascade_decision(cascade, results, meta):
+    """Quyết định có cần chạy model đắt không, dựa trên kết quả của model rẻ."""
+    first = cascade["stages"][0]
+    best = max(results, key=lambda r: r["score"])
+    label = meta["origin_labels"][class_id_of(best, meta)]
+    if label not in cascade.get("label_map", {}).get(first, {}):
+        return True, "unmapped_label"
+    if best["score"] < cascade["threshold"]:
+        return True, "low_confidence"
+    return False, "confident"
+
+
+def infer_from_cascade(cascade, results, meta, target_meta):
+    """Quy đổi kết quả model rẻ sang không gian nhãn của model đắt (cộng dồn xác suất)."""
+    label_map = cascade["label_map"][cascade["stages"][0]]
+    scores = [0.0] * len(target_meta["origin_labels"])
+    for r in results:
+        target = label_map.get(meta["origin_labels"][class_id_of(r, meta)])
+        if target is not None:
+            scores[target_meta["origin_labels"].index(target)] += r["score"]
+    return sorted(
+        ({"class_id": i, "score": v} for i, v in enumerate(scores)),
+        key=lambda r: r["score"], reverse=True
+    )
+
+
 # ----- Diagnosis -----
-@app.route("/diagnose", methods=["POST"])
-def diagnose():
-    model_names = request.form.get("model")
-    file = request.files.get("file")
+# Ghi bản lưu trữ ngoài luồng request, một luồng là đủ vì chỉ là ghi file
+archive_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="archive")
 
-    print(file.filename)
 
-    if not model_names or not file:
-        return jsonify({"error":"Thiếu model hoặc file ảnh"}),400
+def archive_upload(raw, filename):
+    """Lưu nguyên file upload (độ phân giải gốc) mà không decode/encode lại, chạy ở background."""
+    def write():
+        try:
+            with open(os.path.join(UPLOAD_FOLDER, filename), "wb") as f:
+                f.write(raw)
+        except Exception as e:
+            print(f"[ingest] Không lưu được {filename}: {e}")
+    archive_executor.submit(write)
+
 
+def is_dicom(raw):
+    # File DICOM Part 10: 128 byte preamble rồi tới "DICM"
+    return len(raw) > 132 and raw[128:132] == b"DICM"
+
+
+def first_value(value):
+    # WindowCenter/WindowWidth có thể là danh sách nhiều cửa sổ, dùng cửa sổ đầu tiên
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return value[0] if len(value) else None
+
+
+def dicom_window(header):
+    """(low, high) theo WindowCenter/WindowWidth của header, hoặc None nếu không có."""
+    center = first_value(header.get("WindowCenter"))
+    width = first_value(header.get("WindowWidth"))
+    if center is None or not width or float(width) <= 1:
+        return None
+    center, width = float(center), float(width)
+    return center - 0.5 - (width - 1) / 2, center - 0.5 + (width - 1) / 2
+
+
+def window_to_uint8(arr, low, high, invert=False, inplace=False):
+    """Map [low, high] → [0, 255]; low/high có thể là mảng để window riêng từng slice."""
+    out = arr if inplace else arr.astype(np.float32, copy=True)
+    out -= low
+    out *= 255.0 / np.maximum(np.asarray(high, dtype=np.float32) - low, 1e-6)
+    np.clip(out, 0, 255, out=out)
+    if invert:
+        np.subtract(255, out, out=out)
+    return out.astype(np.uint8)
+
+
+def apply_window(pixels, header):
+    """Rescale + window/level (DICOM PS3.3 C.11.2.1.2) trên toàn mảng bằng NumPy, trả về uint8."""
+    if int(header.get("SamplesPerPixel", 1) or 1) == 3:
+        return pixels if pixels.dtype == np.uint8 else (pixels >> max(0, int(header.BitsStored) - 8)).astype(np.uint8)
+
+    arr = pixels.astype(np.float32)
+    slope = float(header.get("RescaleSlope", 1) or 1)
+    intercept = float(header.get("RescaleIntercept", 0) or 0)
+    if slope != 1 or intercept != 0:
+        arr *= slope
+        arr += intercept
+
+    low, high = dicom_window(header) or (float(arr.min()), float(arr.max()))
+    return window_to_uint8(arr, low, high, header.get("PhotometricInterpretation") == "MONOCHROME1", inplace=True)
+
+
+def decode_dicom(raw):
+    """Đọc header DICOM (không đọc pixel), chỉ decode đúng một frame rồi áp window/level."""
+    header = pydicom.dcmread(io.BytesIO(raw), stop_before_pixels=True)
+    frames = int(header.get("NumberOfFrames", 1) or 1)
+    index = frames // 2 if DICOM_FRAME == "middle" else min(int(DICOM_FRAME), frames - 1)
+    pixels = pixel_array(io.BytesIO(raw), index=index if frames > 1 else None)
+    return Image.fromarray(apply_window(pixels, header))
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+def decode_upload(raw):
+    """Giải mã ảnh upload ở kích thước vừa đủ cho model; trả về (ảnh, sha256) hoặc raise nếu không đọc được.
+
+    Ảnh vượt INGEST_MAX_DECODE_MEGAPIXELS raise ImageTooLarge (413) trước khi decode pixel.
+    """
+    if is_dicom(raw):
+        image = decode_dicom(raw)
+    else:
+        image = Image.open(io.BytesIO(raw))
+    if image.format == "JPEG" and INGEST_DRAFT_SIZE > 0:
+        # Decoder JPEG scale DCT trực tiếp → không bao giờ giữ ảnh 12MP đầy đủ trong RAM
+        image.draft("RGB", (INGEST_DRAFT_SIZE, INGEST_DRAFT_SIZE))
+    # Image.open chỉ đọc header: image.size đã là kích thước sẽ được decode (sau draft với JPEG)
+    max_decode_pixels = INGEST_MAX_DECODE_MEGAPIXELS * 1_000_000
+    if max_decode_pixels > 0 and image.width * image.height > max_decode_pixels:
+        raise ImageTooLarge(f"Ảnh quá lớn ({image.width}x{image.height}), tối đa {INGEST_MAX_DECODE_MEGAPIXELS:g} megapixel")
+    image.load()
+
+    max_pixels = INGEST_MAX_MEGAPIXELS * 1_000_000
+    if max_pixels > 0 and image.width * image.height > max_pixels:
+        # Format không có draft (PNG, TIFF...): giảm theo hệ số nguyên bằng box filter, không cấp phát ảnh trung gian lớn
+        factor = math.ceil(math.sqrt(image.width * image.height / max_pixels))
+        image = image.reduce(factor)
+    return image, hashlib.sha256(raw).hexdigest()
+
+
+def encode_saliency(image, saliency, spec):
+    """Saliency ở độ phân giải gốc của model (vd 14x14) dạng PNG xám + box theo tỉ lệ kích thước ảnh."""
+    w, h = image.size
+    left, top, right, bottom = input_box(image, spec)
+    buffer = io.BytesIO()
+    Image.fromarray((saliency * 255).round().astype(np.uint8)).save(buffer, "PNG", optimize=True)
+    return {
+        "format": "saliency",
+        "dtype": "uint8",
+        "shape": list(saliency.shape),
+        "box": [round(left / w, 4), round(top / h, 4), round(right / w, 4), round(bottom / h, 4)],
+        "map": base64.b64encode(buffer.getvalue()).decode()
+    }
+
+
+def diagnose_image(raw, image, image_hash, upload_name, model_names, cascade=None, request_start=None, explain=None):
+    """Phần chung của /diagnose cho cả Flask và ASGI; trả về (payload, status code)."""
+    request_start = request_start or time.perf_counter()
+    models = parse_model_names(model_names)
+
+    if any(m not in batchers for m in models):
+        return {"error":"Model không hợp lệ"}, 400
+
+    # Chưa đọc được config.json của model (Hub/mạng lỗi...) thì báo 503 để client thử lại, không để thành 500
     try:
-        image = Image.open(file)
+        metas = {m: model_manager.meta(m) for m in models}
     except Exception as e:
-        return jsonify({"error":f"Lỗi đọc ảnh: {e}"}),400
+        return {"error":f"Không đọc được cấu hình model: {e}"}, 503
+
+    filename = f"{uuid.uuid4()}_{secure_filename(upload_name)}"
+    archive_upload(raw, filename)
+
+    cascade_enabled = (cascade or CASCADE_MODE).lower() in ("1", "true", "yes")
+    active = active_cascades(models, cascade_enabled)
+    # Model đắt của cascade chỉ chạy sau khi đã xem kết quả model rẻ
+    deferred = {c["stages"][1] for c in active.values()}
+
+    # Tra cache trước, chỉ load model + preprocess cho các model chưa có kết quả
+    explain_format = (explain or EXPLAIN_MODE).lower()
+    explain_enabled = explain_format in ("1", "true", "yes", "saliency")
+    # Heatmap cũng được cache; model chưa có heatmap phải forward lại kèm explain (cache không có activation)
+    saliency = {}
+    for m in models:
+        if explain_enabled and metas[m]["explain"]:
+            cached_map = result_cache.get(saliency_cache_key(image_hash, m, metas[m]))
+            saliency[m] = None if cached_map is None else np.asarray(cached_map, dtype=np.float32)
+    cached = {m: None if m in saliency and saliency[m] is None else result_cache.get((image_hash, m, metas[m]["revision"])) for m in models}
+    # Model có heatmap vẫn cần spec resize để đặt heatmap lên ảnh, kể cả khi kết quả lấy từ cache
+    entries = {m: model_manager.get(m) for m in models if (cached[m] is None or m in saliency) and m not in deferred}
+    for m, entry in entries.items():
+        metas[m] = entry["meta"]
+
+    # Decode + resize dùng chung cho tất cả model được chọn
+    preprocess_start = time.perf_counter()
+    inputs = prepare_inputs(image, {m: e for m, e in entries.items() if cached[m] is None})
+    preprocess_ms = round((time.perf_counter() - preprocess_start) * 1000, 2)
+
+    # Fan-out: các model chạy song song trên worker pool, latency ≈ model chậm nhất
+    outputs = run_models([m for m in models if m not in deferred], entries, inputs, cached, image_hash, saliency)
+
+    cascade_info, skipped = {}, {}
+    for name, cascade in active.items():
+        first, second = cascade["stages"]
+        run_second, reason = cascade_decision(cascade, outputs[first][0], metas[first])
+        if not run_second and cached[second] is not None:
+            # Đã có kết quả thật của model đắt trong cache → dùng luôn thay vì suy ra từ model rẻ
+            run_second, reason = True, "cached"
+        if run_second:
+            if cached[second] is None or second in saliency:
+                entries[second] = model_manager.get(second)
+                metas[second] = entries[second]["meta"]
+            if cached[second] is None:
+                inputs.update(prepare_inputs(image, {second: entries[second]}))
+            outputs.update(run_models([second], entries, inputs, cached, image_hash, saliency))
+        else:
+            # Model không chạy thì cũng không có heatmap
+            saliency.pop(second, None)
+            inferred = infer_from_cascade(cascade, outputs[first][0], metas[first], metas[second])
+            outputs[second] = inferred, {"cached": False, "skipped": True, "inferred_from": first}
+            skipped[second] = metas[first]["display_name"]
+        cascade_info[name] = {
+            "stages": cascade["stages"],
+            "stages_ran": cascade["stages"] if run_second else [first],
+            "threshold": cascade["threshold"],
+            "reason": reason
+        }
+
+    final_results = []
+    explain_ms = 0.0
+    for model_name in models:
+        results, timing = outputs[model_name]
+        result = format_result(results, metas[model_name], timing)
+        if model_name in skipped:
+            # Không phải dự đoán thật của model: client hiển thị/lưu như kết quả suy ra từ stage đầu
+            result["skipped"] = True
+            result["inferred_from"] = skipped[model_name]
+        if explain_enabled:
+            if saliency.get(model_name) is not None:
+                explain_start = time.perf_counter()
+                spec = entries[model_name]["spec"]
+                if explain_format == "saliency":
+                    result["explanation"] = {"method": metas[model_name]["explain"], **encode_saliency(image, saliency[model_name], spec)}
+                else:
+                    result["explanation"] = {
+                        "method": metas[model_name]["explain"],
+                        "format": "jpeg",
+                        "image": render_explanation(image, saliency[model_name], spec)
+                    }
+                explain_ms += (time.perf_counter() - explain_start) * 1000
+            else:
+                # Model không hỗ trợ (backend onnx/int8...) hoặc stage cascade đã được bỏ qua
+                result["explanation"] = {"method": metas[model_name]["explain"], "image": None, "map": None}
+        final_results.append(result)
+
+    timing = {"preprocess_ms": preprocess_ms, "total_ms": round((time.perf_counter() - request_start) * 1000, 2)}
+    if explain_enabled:
+        timing["explain_render_ms"] = round(explain_ms, 2)
+    return {
+        "status": "finished",
+        "results": final_results,
+        "image_sha256": image_hash,
+        "cascades": cascade_info,
+        "timing": timing
+    }, 200
+
+
+# ----- Volume -----
+NRRD_DTYPES = {
+    "int8": "i1", "signed char": "i1", "int8_t": "i1",
+    "uint8": "u1", "uchar": "u1", "unsigned char": "u1", "uint8_t": "u1",
+    "short": "i2", "short int": "i2", "signed short": "i2", "signed short int": "i2", "int16": "i2", "int16_t": "i2",
+    "ushort": "u2", "unsigned short": "u2", "unsigned short int": "u2", "uint16": "u2", "uint16_t": "u2",
+    "int": "i4", "signed int": "i4", "int32": "i4", "int32_t": "i4",
+    "uint": "u4", "unsigned int": "u4", "uint32": "u4", "uint32_t": "u4",
+    "longlong": "i8", "long long": "i8", "long long int": "i8", "int64": "i8", "int64_t": "i8",
+    "ulonglong": "u8", "unsigned long long": "u8", "unsigned long long int": "u8", "uint64": "u8", "uint64_t": "u8",
+    "float": "f4", "double": "f8"
+}
+
+
+def is_volume_upload(names, volume_flag=None):
+    if str(volume_flag or "").lower() in ("1", "true", "yes"):
+        return True
+    return len(names) > 1 or any(n.lower().endswith(VOLUME_EXTENSIONS) for n in names)
+
+
+def volume_upload_paths(names):
+    # Cùng một prefix cho cả request để cặp .hdr/.img vẫn cùng tên gốc
+    prefix = uuid.uuid4()
+    return [os.path.join(UPLOAD_FOLDER, f"{prefix}_{secure_filename(n)}") for n in names]
+
+
+def decompress_to_temp(path, suffix):
+    """Giải nén gzip theo từng khối ra file tạm để mmap được; RAM không phụ thuộc kích thước volume."""
+    tmp = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+    with gzip.open(path, "rb") as src, tmp:
+        shutil.copyfileobj(src, tmp, 1024 * 1024)
+    return tmp.name
+
+
+def open_dicom_volume(paths):
+    headers = [pydicom.dcmread(p, stop_before_pixels=True) for p in paths]
+    header = headers[0]
+    slope = float(header.get("RescaleSlope", 1) or 1)
+    intercept = float(header.get("RescaleIntercept", 0) or 0)
 
-    filename = f"{uuid.uuid4()}_{secure_filename(file.filename)}"
-    image.save(os.path.join(UPLOAD_FOLDER, filename))
+    if len(paths) == 1:
+        # Một file nhiều frame: mỗi lần chỉ decode các frame cần
+        path = paths[0]
+        count = int(header.get("NumberOfFrames", 1) or 1)
+        def read(start, end):
+            if count == 1:
+                return pixel_array(path).astype(np.float32)[None] * slope + intercept
+            return np.stack([pixel_array(path, index=i) for i in range(start, end)]).astype(np.float32) * slope + intercept
+    else:
+        # Series: sắp xếp theo vị trí slice (hoặc InstanceNumber), mỗi file là một slice
+        def position(item):
+            h = item[1]
+            if h.get("ImagePositionPatient") is not None:
+                return float(h.ImagePositionPatient[2])
+            return float(h.get("InstanceNumber", 0) or 0)
+        ordered = [p for p, _ in sorted(zip(paths, headers), key=position)]
+        count = len(ordered)
+        def read(start, end):
+            return np.stack([pixel_array(p) for p in ordered[start:end]]).astype(np.float32) * slope + intercept
 
+    return SimpleNamespace(
+        format="dicom", count=count, shape=(count, int(header.Rows), int(header.Columns)), read=read,
+        window=dicom_window(header), invert=header.get("PhotometricInterpretation") == "MONOCHROME1", cleanup=[]
+    )
+
+
+def open_nifti_volume(path):
+    cleanup = []
+    if path.lower().endswith(".gz"):
+        path = decompress_to_temp(path, ".nii")
+        cleanup.append(path)
+    # mmap=True: dataobj là ArrayProxy, chỉ đọc phần được slice
+    image = nibabel.load(path, mmap=True)
+    proxy = image.dataobj
+    shape = image.shape
+    count = shape[2] if len(shape) >= 3 else 1
+
+    def read(start, end):
+        if len(shape) == 2:
+            slab = np.asarray(proxy, dtype=np.float32)[:, :, None]
+        elif len(shape) == 3:
+            slab = np.asarray(proxy[:, :, start:end], dtype=np.float32)
+        else:
+            slab = np.asarray(proxy[:, :, start:end, 0], dtype=np.float32)
+        # (x, y, k) theo RAS → (k, hàng, cột) hiển thị như ảnh axial thông thường
+        return np.flip(slab.transpose(2, 1, 0), axis=1)
+
+    return SimpleNamespace(format="nifti", count=count, shape=tuple(shape), read=read, window=None, invert=False, cleanup=cleanup)
+
+
+def open_nrrd_volume(path):
+    cleanup = []
+    with open(path, "rb") as f:
+        header = nrrd.read_header(f)
+        offset = f.tell()
+    if header.get("data file"):
+        raise ValueError("NRRD tách file dữ liệu (detached) chưa được hỗ trợ")
+
+    encoding = header.get("encoding", "raw")
+    if encoding in ("gzip", "gz"):
+        with open(path, "rb") as src, tempfile.NamedTemporaryFile(suffix=".raw", delete=False) as tmp:
+            src.seek(offset)
+            with gzip.GzipFile(fileobj=src) as data:
+                shutil.copyfileobj(data, tmp, 1024 * 1024)
+        path, offset = tmp.name, 0
+        cleanup.append(path)
+    elif encoding != "raw":
+        raise ValueError(f"NRRD encoding {encoding} chưa được hỗ trợ")
+
+    dtype = np.dtype(NRRD_DTYPES[header["type"]])
+    if dtype.itemsize > 1:
+        dtype = dtype.newbyteorder("<" if header.get("endian", "little") == "little" else ">")
+    offset += int(header.get("byte skip", 0))
+    # NRRD lưu trục đầu tiên nhanh nhất → mảng C order có shape đảo ngược (z, y, x)
+    shape = tuple(reversed([int(n) for n in header["sizes"]]))
+    data = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape)
+    count = shape[0] if len(shape) == 3 else 1
+
+    def read(start, end):
+        if len(shape) == 2:
+            return np.asarray(data, dtype=np.float32)[None]
+        return np.asarray(data[start:end], dtype=np.float32)
+
+    return SimpleNamespace(format="nrrd", count=count, shape=shape, read=read, window=None, invert=False, cleanup=cleanup)
+
+
+def file_is_dicom(path):
+    with open(path, "rb") as f:
+        return is_dicom(f.read(133))
+
+
+def open_volume(paths):
+    names = [p.lower() for p in paths]
+    if all(file_is_dicom(p) for p in paths):
+        return open_dicom_volume(paths)
+    if len(paths) == 1 and names[0].endswith((".nii", ".nii.gz")):
+        return open_nifti_volume(paths[0])
+    if len(paths) == 1 and names[0].endswith(".nrrd"):
+        return open_nrrd_volume(paths[0])
+    headers = [p for p, n in zip(paths, names) if n.endswith(".hdr")]
+    if headers and any(n.endswith(".img") for n in names):
+        # Analyze 7.5 / NIfTI pair: nibabel tự tìm file .img cùng tên
+        return open_nifti_volume(headers[0])
+    raise ValueError("Định dạng volume không được hỗ trợ (cần .nii, .nii.gz, .nrrd, cặp .hdr/.img hoặc DICOM)")
+
+
+def window_slab(slab, window, invert):
+    if window:
+        return window_to_uint8(slab, window[0], window[1], invert)
+    # Không có window: co giãn theo min/max của từng slice (vectorized cho cả batch)
+    return window_to_uint8(slab, slab.min(axis=(1, 2), keepdims=True), slab.max(axis=(1, 2), keepdims=True), invert)
+
+
+def model_window(model_name, volume):
+    window = model_manager.registry[model_name]["volume"].get("window")
+    if window:
+        center, width = window
+        return center - width / 2, center + width / 2
+    return volume.window
+
+
+def diagnose_volume(paths, model_names, aggregate=None, request_start=None):
+    """Chạy classifier trên từng slice của volume theo batch, rồi gộp thành kết quả cả study."""
+    request_start = request_start or time.perf_counter()
+    aggregate = aggregate or VOLUME_AGGREGATE
     models = parse_model_names(model_names)
 
+    if not models or any(m not in batchers for m in models):
+        return {"error":"Model không hợp lệ"}, 400
+    if any(model_manager.registry[m].get("volume") is None for m in models):
+        return {"error":"Model không hỗ trợ ảnh 3D"}, 400
+    if aggregate not in ("mean", "max", "topk"):
+        return {"error":"aggregate phải là mean, max hoặc topk"}, 400
+
+    try:
+        volume = open_volume(paths)
+    except Exception as e:
+        return {"error":f"Lỗi đọc volume: {e}"}, 400
+
+    try:
+        entries = {m: model_manager.get(m) for m in models}
+        scores = {m: np.zeros((volume.count, len(entries[m]["meta"]["origin_labels"])), dtype=np.float32) for m in models}
+        timing = {"read_ms": 0.0, "preprocess_ms": 0.0, "inference_ms": 0.0}
+
+        for start in range(0, volume.count, VOLUME_BATCH_SIZE):
+            end = min(start + VOLUME_BATCH_SIZE, volume.count)
+            t0 = time.perf_counter()
+            slab = volume.read(start, end)
+            t1 = time.perf_counter()
+
+            # Window + resize một lần cho mỗi cấu hình, rồi gửi cả batch slice vào batcher của mọi model
+            windowed, resized, futures = {}, {}, []
+            for m, entry in entries.items():
+                window = model_window(m, volume)
+                if window not in windowed:
+                    windowed[window] = window_slab(slab, window, volume.invert)
+                key = (window, entry["spec"]["resize"])
+                if key not in resized:
+                    as_image = (lambda s: Image.fromarray(s).convert("RGB")) if entry["spec"]["resize"][0] == "processor" else Image.fromarray
+                    resized[key] = [resize_image(as_image(s), entry["spec"]) for s in windowed[window]]
+                futures += [(m, start + i, batchers[m].submit(entry, pixels)) for i, pixels in enumerate(resized[key])]
+            t2 = time.perf_counter()
+
+            for m, index, future in futures:
+                results, _ = future.result()
+                for r in results:
+                    scores[m][index, r["class_id"]] = r["score"]
+            t3 = time.perf_counter()
+
+            timing["read_ms"] += (t1 - t0) * 1000
+            timing["preprocess_ms"] += (t2 - t1) * 1000
+            timing["inference_ms"] += (t3 - t2) * 1000
+    finally:
+        for path in volume.cleanup:
+            os.remove(path)
+
     final_results = []
+    for m in models:
+        meta = entries[m]["meta"]
+        matrix = scores[m]
+        confidence = matrix.max(axis=1)
+        top_slices = np.argsort(-confidence, kind="stable")[:max(1, min(VOLUME_TOP_K, volume.count))]
+        aggregates = {"mean": matrix.mean(axis=0), "max": matrix.max(axis=0), "topk": matrix[top_slices].mean(axis=0)}
+
+        def as_results(vector):
+            return [{"class_id": int(i), "score": float(vector[i])} for i in np.argsort(-vector, kind="stable")]
+
+        result = format_result(as_results(aggregates[aggregate]), meta, {"slices": volume.count, "cached": False})
+        result["volume"] = {
+            "aggregation": aggregate,
+            "aggregates": {name: format_result(as_results(v), meta, None)["details"] for name, v in aggregates.items()},
+            "top_slices": [{
+                "slice": int(i),
+                "top_label": meta["labels"][int(matrix[i].argmax())],
+                "top_label_origin": meta["origin_labels"][int(matrix[i].argmax())],
+                "top_score": round(float(confidence[i]), 4)
+            } for i in top_slices],
+            "origin_labels": meta["origin_labels"],
+            "slice_scores": np.round(matrix, 4).tolist()
+        }
+        final_results.append(result)
+
+    return {
+        "status": "finished",
+        "results": final_results,
+        "volume": {"format": volume.format, "slices": volume.count, "shape": list(volume.shape)},
+        "timing": {**{k: round(v, 2) for k, v in timing.items()}, "total_ms": round((time.perf_counter() - request_start) * 1000, 2)}
+    }, 200
+
 
-    model_map = {
-        "skin_cancer_vit": "Ung thư da",
-        "pneumonia_vit": "Viêm phổi",
-        "covid19_vit": "Covid-19",
-        "breast_cancer_vit": "Ung thư vú",
-        "brain_tumor_vit": "U não - A",
-        "brain_tumor_resnet": "U não - B"
+# ----- Upload một lần: convert + gate + token -----
+def load_gate(registry, path=MODEL_REGISTRY_FILE):
+    """Cấu hình gate ảnh y tế: chạy model "model" của registry trong process, hoặc gọi GATE_URL ("url") nếu chưa có model."""
+    with open(path, encoding="utf-8") as f:
+        gate = json.load(f).get("gate", {})
+    # Địa chỉ image server theo môi trường triển khai, không ghi cứng trong registry dùng chung
+    gate["url"] = GATE_URL or gate.get("url")
+    if gate.get("model") and gate["model"] not in registry:
+        raise ValueError(f"Gate model {gate['model']} không có trong registry")
+    for label, route in gate.get("routes", {}).items():
+        if any(m not in registry for m in route.get("models", [])):
+            raise ValueError(f"Gate route {label} chứa model không có trong registry")
+    return gate
+
+
+gate = load_gate(model_manager.registry)
+
+
+def run_gate(image):
+    """Ảnh có phải ảnh y tế không + vùng chụp và các model gợi ý (nhãn top 1 không thuộc negative_labels)."""
+    start = time.perf_counter()
+    negative = set(gate.get("negative_labels", []))
+    if gate.get("model"):
+        name = gate["model"]
+        entry = model_manager.get(name)
+        results, _ = batchers[name].submit(entry, prepare_inputs(image, {name: entry})[name]).result()
+        details = [{"label": entry["meta"]["origin_labels"][r["class_id"]], "score": r["score"]} for r in results]
+        medical = max(details, key=lambda d: d["score"])["label"] not in negative
+        source = "model"
+    elif gate.get("url"):
+        # Chưa có gate model trong registry: gửi ảnh đã decode (PNG nhỏ) cho image server, chỉ một lần từ phía server
+        buffer = io.BytesIO()
+        image.convert("RGB").save(buffer, "PNG")
+        resp = requests.post(gate["url"], files={"image": ("image.png", buffer.getvalue(), "image/png")}, timeout=GATE_TIMEOUT_S)
+        resp.raise_for_status()
+        data = resp.json()
+        details = [{"label": r["label"], "score": r["score"]} for r in data.get("result", [])]
+        medical = data.get("prediction") == "Positive"
+        source = "remote"
+    else:
+        return {"medical": True, "source": "disabled", "label": None, "region": None, "models": [], "details": []}
+
+    candidates = sorted((d for d in details if d["label"] not in negative), key=lambda d: d["score"], reverse=True)
+    label = candidates[0]["label"] if candidates else None
+    route = gate.get("routes", {}).get(label, {})
+    return {
+        "medical": medical,
+        "source": source,
+        "label": label,
+        "region": route.get("name"),
+        "models": route.get("models", []),
+        "details": [{"label": d["label"], "score": round(d["score"], 4)} for d in details],
+        "gate_ms": round((time.perf_counter() - start) * 1000, 2)
     }
 
-    for model_name in models:
-        if model_name=="skin_cancer_vit":
-            results = normalize_results(skin_cancer_model(image))
-            label_map = {
-                "melanocytic_Nevi": "Nốt ruồi lành tính",
-                "benign_keratosis-like_lesions": "Tổn thương sừng lành tính",
-                "melanoma": "U ác tính",
-                "actinic_keratoses": "Dày sừng ánh sáng",
-                "basal_cell_carcinoma": "Ung thư biểu mô tế bào đáy"
-            }
 
-        elif model_name=="pneumonia_vit":
-            results = normalize_results(pneumonia_model(image))
-            label_map = {
-                "NORMAL": "Phổi bình thường",
-                "PNEUMONIA": "Viêm phổi"
-            }
+class UploadTokenCache:
+    """Ảnh đã decode theo token: hết hạn sau ttl_s, vượt ngân sách RAM thì bỏ token cũ nhất."""
 
-        elif model_name=="covid19_vit":
-            results = normalize_results(covid19_model(image))
-            label_map = {
-                "CT_COVID": "Hình ảnh CT có dấu hiệu COVID-19",
-                "CT_NonCOVID": "Hình ảnh CT không có dấu hiệu COVID-19"
-            }
+    def __init__(self, ttl_s=UPLOAD_TOKEN_TTL_S, budget_mb=UPLOAD_TOKEN_CACHE_MB):
+        self.ttl_s = ttl_s
+        self.budget = budget_mb * 1024 * 1024
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"issued": 0, "hits": 0, "misses": 0, "expired": 0, "evicted": 0}
 
-        elif model_name=="breast_cancer_vit":
-            results = normalize_results(breast_cancer_model(image))
-            label_map = {
-                "class0": "Không bị ung thư vú",
-                "class1": "Bị ung thư vú"
-            }
-        elif model_name=='brain_tumor_vit':
-            results = normalize_results(brain_tumor_model_vit(image))
-            label_map = {
-                "yes": "Bị u não",
-                "no": "Không bị u não"
-            }
-        elif model_name=='brain_tumor_resnet':
-            results = normalize_results(brain_tumor_model_resnet50(image))
-            label_map = {
-                "meningioma": "U màng não",
-                "pituitary": "U tuyến yên",
-                "glioma": "U tế bào thần kinh đệm",
-                "notumor": "Không có khối u"
-            }
+    def _drop(self, token):
+        self.bytes -= self.entries.pop(token)["bytes"]
+
+    def _expire(self, now):
+        # Token được thêm theo thứ tự thời gian → chỉ cần xét từ đầu
+        while self.entries:
+            token, item = next(iter(self.entries.items()))
+            if now - item["created_at"] < self.ttl_s:
+                break
+            self._drop(token)
+            self.stats["expired"] += 1
+
+    def put(self, raw, image, image_hash, upload_name):
+        token = uuid.uuid4().hex
+        size = len(raw) + image.width * image.height * len(image.getbands())
+        with self.lock:
+            self._expire(time.time())
+            while self.entries and self.bytes + size > self.budget:
+                self._drop(next(iter(self.entries)))
+                self.stats["evicted"] += 1
+            self.entries[token] = {"raw": raw, "image": image, "image_hash": image_hash, "upload_name": upload_name,
+                                   "bytes": size, "created_at": time.time()}
+            self.bytes += size
+            self.stats["issued"] += 1
+        return token
+
+    def get(self, token):
+        with self.lock:
+            self._expire(time.time())
+            item = self.entries.get(token)
+            self.stats["hits" if item else "misses"] += 1
+            return item
+
+    def discard(self, token):
+        with self.lock:
+            if token in self.entries:
+                self._drop(token)
+
+    def snapshot(self):
+        with self.lock:
+            return {"entries": len(self.entries), "memory_mb": round(self.bytes / 1024 / 1024, 2),
+                    "ttl_s": self.ttl_s, **self.stats}
+
+
+upload_tokens = UploadTokenCache()
+
+
+def volume_preview(paths):
+    """Slice giữa của volume (đã window) thành ảnh 2D, giống ảnh mà /convert của image server trả về."""
+    volume = open_volume(paths)
+    try:
+        middle = volume.count // 2
+        return Image.fromarray(window_slab(volume.read(middle, middle + 1), volume.window, volume.invert)[0])
+    finally:
+        for path in volume.cleanup:
+            os.remove(path)
+
+
+def encode_preview(image):
+    preview = image.convert("RGB")
+    preview.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+    buffer = io.BytesIO()
+    preview.save(buffer, "JPEG", quality=90)
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def prepare_upload(raw, upload_name, volume_paths=None):
+    """Phần chung của /prepare: decode một lần, chạy gate, giữ ảnh theo token; trả về (payload, status code)."""
+    request_start = time.perf_counter()
+    try:
+        if volume_paths:
+            image = volume_preview(volume_paths)
+            # Volume được chẩn đoán trên slice giữa như luồng /convert cũ, lưu dưới dạng PNG
+            buffer = io.BytesIO()
+            image.save(buffer, "PNG")
+            raw, upload_name = buffer.getvalue(), upload_name + ".png"
+            image_hash = hashlib.sha256(raw).hexdigest()
         else:
-            return jsonify({"error":"Model không hợp lệ"}),400
-
-        # Áp dụng filter mapping
-        filtered_results = []
-        for r in results:
-            new_label = label_map.get(r["label"], r["label"])
-            filtered_results.append({
-                "originLabel": r["label"],
-                "label": new_label,
-                "score": round(r["score"], 4)
-            })
-        best = max(filtered_results, key=lambda x: x["score"])
-        new_model_name = model_map.get(model_name, model_name)
-        final_results.append({
-            "model": new_model_name,
-            "top_label": best["label"],
-            "top_label_origin": best["originLabel"],
-            "top_score": best["score"],
-            "details": filtered_results
-        })
+            image, image_hash = decode_upload(raw)
+    except ImageTooLarge as e:
+        return {"error":str(e)}, 413
+    except Exception as e:
+        return {"error":f"Lỗi đọc ảnh: {e}"}, 400
+    decode_ms = round((time.perf_counter() - request_start) * 1000, 2)
 
-    return jsonify({
-        "status": "finished",
-        "results": final_results
-    })
+    try:
+        verdict = run_gate(image)
+    except Exception as e:
+        return {"error":f"Không kiểm tra được loại ảnh: {e}"}, 502
 
-@app.route("/vqa-diagnose", methods=["POST"])
-def vqa_diagnose():
-    model_name = request.form.get("model")
-    question = request.form.get("question")
+    payload = {
+        "token": upload_tokens.put(raw, image, image_hash, upload_name),
+        "expires_in": upload_tokens.ttl_s,
+        "image_sha256": image_hash,
+        "gate": verdict,
+        "timing": {"decode_ms": decode_ms, "total_ms": round((time.perf_counter() - request_start) * 1000, 2)}
+    }
+    if volume_paths or is_dicom(raw):
+        # Trình duyệt không hiển thị được DICOM/volume: gửi kèm ảnh xem trước để webserver lưu vào lịch sử
+        payload["preview"] = encode_preview(image)
+    return payload, 200
+
+
+def diagnose_token(token, model_names, cascade=None, request_start=None, explain=None):
+    """/diagnose với token của /prepare: dùng lại ảnh đã decode, không cần upload lại."""
+    item = upload_tokens.get(token)
+    if item is None:
+        return {"error":"Token không tồn tại hoặc đã hết hạn"}, 410
+    payload, status = diagnose_image(item["raw"], item["image"], item["image_hash"], item["upload_name"], model_names, cascade, request_start, explain)
+    if status == 200:
+        upload_tokens.discard(token)
+    return payload, status
+
+
+@app.route("/prepare", methods=["POST"])
+def prepare():
     file = request.files.get("file")
+    if not file:
+        return jsonify({"error":"Thiếu file ảnh"}),400
+    if is_volume_upload([file.filename]):
+        paths = volume_upload_paths([file.filename])
+        file.save(paths[0])
+        payload, status = prepare_upload(b"", file.filename, paths)
+    else:
+        payload, status = prepare_upload(file.read(), file.filename)
+    return jsonify(payload), status
 
-    print("model: ", model_name)
 
-    if not file or not model_name or not question:
-        return "Invalid", 400
-    
-    ext = os.path.splitext(file.filename)[1].lower()
-    
-    file.save(LOCAL_IMAGE + ext)
-
-    # ===== COMMAND =====
-    curl_cmd = f"""
-    cd {REMOTE_DIR} && curl -X POST http://10.200.1.3:5000/{model_name} -F "image=@upload{ext}" -F "question={question}"
+@app.route("/diagnose", methods=["POST"])
+def diagnose():
+    request_start = time.perf_counter()
+    model_names = request.form.get("model")
+    files = request.files.getlist("file")
+    file = files[0] if files else None
+    token = request.form.get("token")
+
+    if not model_names or not (file or token):
+        return jsonify({"error":"Thiếu model hoặc file ảnh"}),400
+
+    if not file:
+        payload, status = diagnose_token(token, model_names, request.form.get("cascade"), request_start, request.form.get("explain"))
+        return jsonify(payload), status
+
+    print(file.filename)
+
+    names = [f.filename for f in files]
+    if is_volume_upload(names, request.form.get("volume")):
+        # Volume được ghi thẳng xuống đĩa (không đọc hết vào RAM) rồi mmap
+        paths = volume_upload_paths(names)
+        for f, path in zip(files, paths):
+            f.save(path)
+        payload, status = diagnose_volume(paths, model_names, request.form.get("aggregate"), request_start)
+        return jsonify(payload), status
+
+    raw = file.read()
+    try:
+        image, image_hash = decode_upload(raw)
+    except ImageTooLarge as e:
+        return jsonify({"error":str(e)}),413
+    except Exception as e:
+        return jsonify({"error":f"Lỗi đọc ảnh: {e}"}),400
+
+    payload, status = diagnose_image(raw, image, image_hash, file.filename, model_names, request.form.get("cascade"), request_start, request.form.get("explain"))
+    return jsonify(payload), status
+
+@app.route("/models", methods=["GET"])
+def models_status():
+    return jsonify(model_manager.snapshot())
+
+def admin_swap(name, method, token, data):
+    if not ADMIN_TOKEN or token != ADMIN_TOKEN:
+        return {"error": "Forbidden"}, 403
+    if name not in model_manager.registry:
+        return {"error": "Model không hợp lệ"}, 404
+
+    if method == "GET":
+        return model_manager.swaps.get(name, {"model": name, "status": "idle"}), 200
+
+    changes = {k: data[k] for k in ("repo", "revision", "backend", "preprocessing", "labels", "display_name") if k in data}
+    if not changes:
+        return {"error": "Thiếu thông tin revision/backend mới"}, 400
+    persist = str(data.get("persist", "")).lower() in ("1", "true", "yes")
+
+    return model_manager.start_swap(name, changes, persist=persist), 202
+
+@app.route("/admin/models/<name>/swap", methods=["GET", "POST"])
+def admin_swap_model(name):
+    data = request.get_json(silent=True) or request.form.to_dict()
+    payload, status = admin_swap(name, request.method, request.headers.get("X-Admin-Token"), data)
+    return jsonify(payload), status
+
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    return jsonify({**result_cache.snapshot(), "upload_tokens": upload_tokens.snapshot()})
+
+def batch_queue_depth():
+    # Số ảnh đang chờ forward của từng model; webserver dựa vào đây để biết lúc nào rảnh mà prefetch heatmap
+    return {name: b.queue.qsize() for name, b in batchers.items()}
+
+@app.route("/queue/stats", methods=["GET"])
+def queue_stats():
+    return jsonify({"batch": batch_queue_depth()})
+
+def write_vqa_image(raw, upload_name):
+    """Ghi ảnh VQA ra file riêng của request để upload lên node GPU; trả về hậu tố tên file đã dùng.
+
+    Mỗi request một tên (LOCAL_IMAGE/REMOTE_IMAGE + hậu tố) để các request VQA chạy song song
+    không ghi đè ảnh của nhau.
     """
+    ext = os.path.splitext(upload_name)[1].lower()
+    if is_dicom(raw):
+        # VQA server chỉ nhận ảnh thường: render frame đã window/level thành PNG ngay tại đây
+        buffer = io.BytesIO()
+        decode_dicom(raw).save(buffer, "PNG")
+        raw, ext = buffer.getvalue(), ".png"
+
+    suffix = f"-{uuid.uuid4().hex}{ext}"
+    with open(LOCAL_IMAGE + suffix, "wb") as f:
+        f.write(raw)
+    return suffix
+
 
+def vqa_command(model_name, suffix, question, stream=False):
+    # --form-string: câu hỏi bắt đầu bằng @ hoặc < không bị curl hiểu là file
+    # Ảnh của request được xoá trên node GPU ngay sau khi curl xong
+    stream_args = "-N -F stream=1 " if stream else ""
+    return f"""
+    cd {REMOTE_DIR} && curl -s {stream_args}-X POST http://10.200.1.3:5000/{shlex.quote(model_name)} -F "image=@upload{suffix}" --form-string {shlex.quote("question=" + question)}; rm -f upload{suffix}
+    """
+
+
+def connect_vqa(suffix):
+    """SSH qua CMS tới node GPU và upload ảnh; trả về SSHClient của node GPU."""
     # ===== INPUT SECRETS =====
     key_passphrase = PASS_PHRASE
     gpu_password = GPU_PASSWD
@@ -243,16 +1868,91 @@ def vqa_diagnose():
         sftp.mkdir(REMOTE_DIR)
         sftp.chdir(REMOTE_DIR)
 
-    sftp.put(LOCAL_IMAGE + ext, REMOTE_IMAGE + ext)
+    sftp.put(LOCAL_IMAGE + suffix, REMOTE_IMAGE + suffix)
     sftp.close()
+    return gpu
+
+
+def ask_vqa(raw, upload_name, model_name, question):
+    """Gửi ảnh + câu hỏi tới VQA server trên node GPU (qua CMS), trả về câu trả lời dạng HTML."""
+    suffix = write_vqa_image(raw, upload_name)
+    try:
+        gpu = connect_vqa(suffix)
+    finally:
+        os.remove(LOCAL_IMAGE + suffix)
 
     # ===== EXEC CURL =====
     print("[*] Running MedGemma request...")
-    stdin, stdout, stderr = gpu.exec_command(curl_cmd)
+    stdin, stdout, stderr = gpu.exec_command(vqa_command(model_name, suffix, question))
 
     #gpu.close()
     #cms.close()
-    return jsonify({"answer": markdown.markdown(json.loads(stdout.read().decode())['result'])}),200
+    return {"answer": markdown.markdown(json.loads(stdout.read().decode())['result'])}
+
+
+def stream_vqa(raw, upload_name, model_name, question):
+    """Như ask_vqa nhưng chuyển tiếp từng token (SSE) ngay khi VQA server sinh ra.
+
+    Event cuối {"done": true, "answer": HTML, "timing"} giống kết quả của ask_vqa.
+    """
+    suffix = None
+    try:
+        suffix = write_vqa_image(raw, upload_name)
+        gpu = connect_vqa(suffix)
+    except Exception as e:
+        yield f"data: {json.dumps({'error': f'Không kết nối được VQA server: {e}'}, ensure_ascii=False)}\n\n"
+        return
+    finally:
+        if suffix:
+            os.remove(LOCAL_IMAGE + suffix)
+    print("[*] Streaming MedGemma request...")
+    stdin, stdout, stderr = gpu.exec_command(vqa_command(model_name, suffix, question, stream=True))
+    try:
+        for line in stdout:
+            line = line.strip()
+            if line.startswith("{"):
+                # VQA server chưa hỗ trợ stream: trả JSON một lần
+                event = dict(json.loads(line), done=True)
+            elif line.startswith("data:"):
+                event = json.loads(line[5:])
+            else:
+                continue
+            if event.get("done"):
+                event = {"done": True, "answer": markdown.markdown(event["result"]), "timing": event.get("timing")}
+            yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+            if event.get("done") or event.get("error"):
+                return
+    finally:
+        gpu.close()
+
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+@app.route("/vqa-diagnose", methods=["POST"])
+def vqa_diagnose():
+    model_name = request.form.get("model")
+    question = request.form.get("question")
+    file = request.files.get("file")
+    token = request.form.get("token")
+
+    print("model: ", model_name)
+
+    if not (file or token) or not model_name or not question:
+        return "Invalid", 400
+
+    if not file:
+        item = upload_tokens.get(token)
+        if item is None:
+            return jsonify({"error":"Token không tồn tại hoặc đã hết hạn"}),410
+        raw, upload_name = item["raw"], item["upload_name"]
+    else:
+        raw, upload_name = file.read(), file.filename
+
+    if request.form.get("stream") == "1":
+        return Response(stream_with_context(stream_vqa(raw, upload_name, model_name, question)),
+                        mimetype="text/event-stream", headers=SSE_HEADERS)
+    return jsonify(ask_vqa(raw, upload_name, model_name, question)),200
 
     # messages = [
     #     {
@@ -285,5 +1985,239 @@ def vqa_diagnose():
     return jsonify({"answer":"Tính năng này tạm thời bị đóng do chưa có GPU =))"}),200
 
 
+# ----- ASGI -----
+class QueueRejected(Exception):
+    def __init__(self, status, message, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+
+class QueueSlot:
+    """Một chỗ trong InferenceQueue. release() gọi nhiều lần chỉ trả chỗ một lần; bị thu hồi (GC) mà chưa trả,
+    vd stream chưa từng được đọc vì client ngắt trước chunk đầu, thì tự trả để hàng đợi không mất chỗ vĩnh viễn."""
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.released = False
+
+    def release(self):
+        with self.queue.lock:
+            if self.released:
+                return
+            self.released = True
+            self.queue.pending -= 1
+
+    def __del__(self):
+        self.release()
+
+
+class InferenceQueue:
+    """Executor có giới hạn: tối đa `workers` job chạy + `max_queue` job chờ; đầy thì từ chối ngay."""
+
+    def __init__(self, name, workers, max_queue, queue_timeout_s=ASGI_QUEUE_TIMEOUT_S):
+        self.name = name
+        self.workers = max(1, workers)
+        self.limit = self.workers + max(0, max_queue)
+        self.queue_timeout_s = queue_timeout_s
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"asgi-{name}")
+        # pending được trả từ worker thread (job xong) hoặc lúc GC nên cần lock
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.avg_job_s = 1.0
+        self.stats = {"accepted": 0, "rejected": 0, "timed_out": 0}
+
+    def retry_after(self):
+        # Ước lượng thời gian để hàng đợi hiện tại chạy hết
+        return max(1, math.ceil(self.avg_job_s * self.pending / self.workers))
+
+    def acquire(self):
+        """Giữ một chỗ (QueueSlot), hoặc ném QueueRejected 429 nếu hàng đợi đầy."""
+        with self.lock:
+            if self.pending >= self.limit:
+                self.stats["rejected"] += 1
+                raise QueueRejected(429, "Server đang quá tải, vui lòng thử lại sau", self.retry_after())
+            self.pending += 1
+            self.stats["accepted"] += 1
+        return QueueSlot(self)
+
+    async def run(self, fn, *args):
+        slot = self.acquire()
+        enqueued_at = time.perf_counter()
+
+        def job():
+            # Job đã chờ quá lâu thì caller cũng sắp timeout, bỏ qua để giải phóng worker
+            if time.perf_counter() - enqueued_at > self.queue_timeout_s:
+                raise QueueRejected(503, "Hàng đợi inference bị quá hạn", self.retry_after())
+            start = time.perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                self.avg_job_s = 0.8 * self.avg_job_s + 0.2 * (time.perf_counter() - start)
+
+        # Trả chỗ khi job thật sự xong (hoặc bị huỷ trước khi chạy), không phải khi caller bị huỷ:
+        # request bị ngắt giữa chừng thì job vẫn chiếm worker tới khi xong
+        future = self.executor.submit(job)
+        future.add_done_callback(lambda _: slot.release())
+        try:
+            return await asyncio.wrap_future(future)
+        except QueueRejected:
+            self.stats["timed_out"] += 1
+            raise
+
+    def stream(self, fn, *args):
+        """Như run nhưng cho generator fn (SSE): giữ chỗ trong hàng đợi tới khi stream kết thúc.
+
+        Quá tải thì QueueRejected được ném ngay, trước khi response bắt đầu.
+        """
+        slot = self.acquire()
+
+        async def chunks():
+            start = time.perf_counter()
+            iterator = fn(*args)
+            loop = asyncio.get_running_loop()
+            try:
+                while True:
+                    # Mỗi lần next() chỉ giữ một worker trong lúc chờ token tiếp theo
+                    chunk = await loop.run_in_executor(self.executor, next, iterator, None)
+                    if chunk is None:
+                        return
+                    yield chunk
+            finally:
+                self.avg_job_s = 0.8 * self.avg_job_s + 0.2 * (time.perf_counter() - start)
+                try:
+                    await loop.run_in_executor(self.executor, iterator.close)
+                finally:
+                    slot.release()
+
+        # Generator chưa từng được đọc thì finally ở trên không chạy; slot được trả khi generator bị thu hồi
+        return chunks()
+
+    def snapshot(self):
+        return {"workers": self.workers, "limit": self.limit, "pending": self.pending,
+                "avg_job_s": round(self.avg_job_s, 4), **self.stats}
+
+
+inference_queue = InferenceQueue("diagnose", ASGI_WORKERS, ASGI_QUEUE_SIZE)
+vqa_queue = InferenceQueue("vqa", VQA_WORKERS, VQA_QUEUE_SIZE)
+
+def create_asgi_app():
+    """FastAPI app dùng chung các hàm xử lý với Flask app; FastAPI/uvicorn chỉ được import khi chạy ASGI."""
+    from fastapi import FastAPI, File, Form, Request, UploadFile
+    from fastapi.concurrency import run_in_threadpool
+    from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+    asgi_app = FastAPI(title="InsecMed AI server")
+
+    @asgi_app.exception_handler(QueueRejected)
+    async def queue_rejected_handler(request: Request, exc: QueueRejected):
+        return JSONResponse({"error": exc.message}, status_code=exc.status, headers={"Retry-After": str(exc.retry_after)})
+
+    @asgi_app.post("/prepare")
+    async def asgi_prepare(file: UploadFile = File(None)):
+        if not file:
+            return JSONResponse({"error":"Thiếu file ảnh"}, status_code=400)
+        if is_volume_upload([file.filename]):
+            paths = volume_upload_paths([file.filename])
+            with open(paths[0], "wb") as out:
+                await run_in_threadpool(shutil.copyfileobj, file.file, out, 1024 * 1024)
+            payload, status = await inference_queue.run(prepare_upload, b"", file.filename, paths)
+        else:
+            raw = await file.read()
+            payload, status = await inference_queue.run(prepare_upload, raw, file.filename)
+        return JSONResponse(payload, status_code=status)
+
+    @asgi_app.post("/diagnose")
+    async def asgi_diagnose(file: list[UploadFile] = File(None), model: str = Form(None), cascade: str = Form(None),
+                            volume: str = Form(None), aggregate: str = Form(None), token: str = Form(None),
+                            explain: str = Form(None)):
+        request_start = time.perf_counter()
+        if not model or not (file or token):
+            return JSONResponse({"error":"Thiếu model hoặc file ảnh"}, status_code=400)
+
+        if not file:
+            payload, status = await inference_queue.run(diagnose_token, token, model, cascade, request_start, explain)
+            return JSONResponse(payload, status_code=status)
+
+        files, file = file, file[0]
+        names = [f.filename for f in files]
+        if is_volume_upload(names, volume):
+            # Upload đã được spool ra file tạm; copy theo khối sang thư mục upload rồi mmap
+            paths = volume_upload_paths(names)
+            for f, path in zip(files, paths):
+                with open(path, "wb") as out:
+                    await run_in_threadpool(shutil.copyfileobj, f.file, out, 1024 * 1024)
+            payload, status = await inference_queue.run(diagnose_volume, paths, model, aggregate, request_start)
+            return JSONResponse(payload, status_code=status)
+
+        # Nhận upload + decode không chặn event loop, inference mới vào hàng đợi có giới hạn
+        raw = await file.read()
+        try:
+            image, image_hash = await run_in_threadpool(decode_upload, raw)
+        except ImageTooLarge as e:
+            return JSONResponse({"error":str(e)}, status_code=413)
+        except Exception as e:
+            return JSONResponse({"error":f"Lỗi đọc ảnh: {e}"}, status_code=400)
+
+        payload, status = await inference_queue.run(diagnose_image, raw, image, image_hash, file.filename, model, cascade, request_start, explain)
+        return JSONResponse(payload, status_code=status)
+
+    @asgi_app.post("/vqa-diagnose")
+    async def asgi_vqa_diagnose(file: UploadFile = File(None), model: str = Form(None), question: str = Form(None),
+                                token: str = Form(None), stream: str = Form(None)):
+        if not (file or token) or not model or not question:
+            return PlainTextResponse("Invalid", status_code=400)
+        if not file:
+            item = upload_tokens.get(token)
+            if item is None:
+                return JSONResponse({"error":"Token không tồn tại hoặc đã hết hạn"}, status_code=410)
+            raw, upload_name = item["raw"], item["upload_name"]
+        else:
+            raw, upload_name = await file.read(), file.filename
+
+        if stream == "1":
+            return StreamingResponse(vqa_queue.stream(stream_vqa, raw, upload_name, model, question),
+                                     media_type="text/event-stream", headers=SSE_HEADERS)
+        return await vqa_queue.run(ask_vqa, raw, upload_name, model, question)
+
+    @asgi_app.get("/models")
+    async def asgi_models_status():
+        return model_manager.snapshot()
+
+    @asgi_app.api_route("/admin/models/{name}/swap", methods=["GET", "POST"])
+    async def asgi_admin_swap_model(name: str, request: Request):
+        data = {}
+        if request.method == "POST":
+            if request.headers.get("content-type", "").startswith("application/json"):
+                data = await request.json()
+            else:
+                data = dict(await request.form())
+        payload, status = admin_swap(name, request.method, request.headers.get("X-Admin-Token"), data)
+        return JSONResponse(payload, status_code=status)
+
+    @asgi_app.get("/cache/stats")
+    async def asgi_cache_stats():
+        return {**result_cache.snapshot(), "upload_tokens": upload_tokens.snapshot()}
+
+    @asgi_app.get("/queue/stats")
+    async def asgi_queue_stats():
+        return {"diagnose": inference_queue.snapshot(), "vqa": vqa_queue.snapshot(), "batch": batch_queue_depth()}
+
+    return asgi_app
+
+
 if __name__=="__main__":
-    app.run(host="0.0.0.0", port=8080, debug=True)
+    if SERVER_MODE == "asgi" and AI_WORKERS > 1:
+        if SHARED_WEIGHTS == "1":
+            prepare_shared_weights(model_manager.registry)
+        import uvicorn
+        # Worker của uvicorn import lại module qua asgi.py
+        uvicorn.run("asgi:app", host="0.0.0.0", port=8080, workers=AI_WORKERS)
+    elif SERVER_MODE == "asgi":
+        import uvicorn
+        start_warmup()
+        uvicorn.run(create_asgi_app(), host="0.0.0.0", port=8080)
+    else:
+        start_warmup()
+        app.run(host="0.0.0.0", port=8080, debug=True)
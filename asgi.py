@@ -0,0 +1,14 @@
+"""Entry point ASGI cho ai-server: uvicorn asgi:app --host 0.0.0.0 --port 8080
+
+Tương đương SERVER_MODE=asgi python ai-server.py, nhưng dùng được với --workers của uvicorn.
+"""
+import importlib.util
+import os
+
+# ai-server.py có dấu gạch ngang nên phải load theo đường dẫn
+server_spec = importlib.util.spec_from_file_location("ai_server", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ai-server.py"))
+ai_server = importlib.util.module_from_spec(server_spec)
+server_spec.loader.exec_module(ai_server)
+
+ai_server.start_warmup()
+app = ai_server.create_asgi_app()
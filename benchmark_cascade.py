@@ -0,0 +1,148 @@
+"""Đo lợi ích của cascade (model rẻ trước, model đắt khi chưa chắc chắn) trên ảnh đã lưu.
+
+Chạy cả hai model của cascade trên toàn bộ ảnh trong static/uploads, rồi với từng ngưỡng
+tính: tỉ lệ ảnh phải chạy model đắt, thời gian tiết kiệm so với luôn chạy cả hai model,
+và tỉ lệ kết luận của cascade trùng với model đắt. Nếu có file nhãn (CSV: filename,label
+theo nhãn gốc của model đắt) thì tính thêm độ chính xác của cascade so với model đắt.
+
+Ví dụ:
+    python benchmark_cascade.py --cascade brain_tumor --thresholds 0.6,0.7,0.8,0.9
+"""
+import argparse
+import csv
+import glob
+import importlib.util
+import json
+import os
+import time
+
+import torch
+from PIL import Image
+
+# Cache kết quả chỉ trong RAM: benchmark không đọc/ghi diagnose_cache.db thật của server
+os.environ["RESULT_CACHE_DB"] = ""
+# ai-server.py có dấu gạch ngang nên phải load theo đường dẫn
+server_spec = importlib.util.spec_from_file_location("ai_server", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ai-server.py"))
+ai_server = importlib.util.module_from_spec(server_spec)
+server_spec.loader.exec_module(ai_server)
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+
+def list_images(folder, limit):
+    paths = sorted(p for p in glob.glob(os.path.join(folder, "*")) if p.lower().endswith(IMAGE_EXTENSIONS))
+    return paths[:limit] if limit else paths
+
+
+def load_labels(path):
+    if not path:
+        return {}
+    with open(path, newline="", encoding="utf-8") as f:
+        return {os.path.basename(row[0]): row[1].strip() for row in csv.reader(f) if len(row) >= 2}
+
+
+def run_model(entry, images, batch_size):
+    """Trả về (kết quả thô từng ảnh, ms trung bình mỗi ảnh gồm cả resize)."""
+    outputs = []
+    start = time.perf_counter()
+    for i in range(0, len(images), batch_size):
+        pixels = [ai_server.resize_image(image, entry["spec"]) for image in images[i:i + batch_size]]
+        with torch.inference_mode():
+            logits = entry["model"](pixel_values=ai_server.normalize_batch(pixels, entry["spec"])).logits
+        outputs += ai_server.postprocess_logits(logits, entry["model"].config)
+    return outputs, (time.perf_counter() - start) * 1000 / max(1, len(images))
+
+
+def top_label(results, meta):
+    best = max(results, key=lambda r: r["score"])
+    return meta["origin_labels"][ai_server.class_id_of(best, meta)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cascade", default="brain_tumor", help="tên cascade trong registry")
+    parser.add_argument("--folder", default=ai_server.UPLOAD_FOLDER)
+    parser.add_argument("--limit", type=int, default=0, help="số ảnh tối đa (0 = tất cả)")
+    parser.add_argument("--thresholds", default="0.5,0.6,0.7,0.8,0.9,0.95")
+    parser.add_argument("--labels", help="CSV filename,label (nhãn gốc của model đắt) để tính độ chính xác")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--output", default=os.path.join("reports", "cascade_benchmark.json"))
+    args = parser.parse_args()
+
+    cascade = ai_server.cascades[args.cascade]
+    first, second = cascade["stages"]
+    labels = load_labels(args.labels)
+
+    paths, images = [], []
+    for path in list_images(args.folder, args.limit):
+        try:
+            images.append(Image.open(path).convert("RGB"))
+            paths.append(path)
+        except Exception as e:
+            print(f"bỏ qua {path}: {e}")
+    if not images:
+        print(f"Không có ảnh trong {args.folder}")
+        return
+    print(f"Dùng {len(images)} ảnh, cascade {first} → {second}")
+
+    entries = {m: ai_server.model_manager.get(m) for m in cascade["stages"]}
+    metas = {m: entries[m]["meta"] for m in cascade["stages"]}
+    # Chạy lượt đầu để warm-up, không tính giờ
+    run_model(entries[first], images[:1], 1)
+    run_model(entries[second], images[:1], 1)
+    first_results, first_ms = run_model(entries[first], images, args.batch_size)
+    second_results, second_ms = run_model(entries[second], images, args.batch_size)
+    full_ms = first_ms + second_ms
+
+    reference = [top_label(r, metas[second]) for r in second_results]
+    truth = [labels.get(os.path.basename(p)) for p in paths]
+    labelled = [i for i, t in enumerate(truth) if t is not None]
+
+    report = {
+        "cascade": args.cascade,
+        "stages": cascade["stages"],
+        "images": len(images),
+        "labelled_images": len(labelled),
+        "ms_per_image": {first: round(first_ms, 3), second: round(second_ms, 3), "both": round(full_ms, 3)},
+        "thresholds": {}
+    }
+    if labelled:
+        report["second_stage_accuracy"] = round(sum(reference[i] == truth[i] for i in labelled) / len(labelled), 4)
+
+    for threshold in (float(t) for t in args.thresholds.split(",")):
+        config = dict(cascade, threshold=threshold)
+        verdicts, escalated, reasons = [], 0, {}
+        for results, full in zip(first_results, reference):
+            run_second, reason = ai_server.cascade_decision(config, results, metas[first])
+            reasons[reason] = reasons.get(reason, 0) + 1
+            if run_second:
+                escalated += 1
+                verdicts.append(full)
+            else:
+                inferred = ai_server.infer_from_cascade(config, results, metas[first], metas[second])
+                verdicts.append(top_label(inferred, metas[second]))
+
+        escalation_rate = escalated / len(images)
+        cascade_ms = first_ms + escalation_rate * second_ms
+        row = {
+            "escalation_rate": round(escalation_rate, 4),
+            "reasons": reasons,
+            "ms_per_image": round(cascade_ms, 3),
+            "compute_saved": round(1 - cascade_ms / full_ms, 4),
+            "agreement_with_second_stage": round(sum(v == r for v, r in zip(verdicts, reference)) / len(images), 4)
+        }
+        if labelled:
+            accuracy = sum(verdicts[i] == truth[i] for i in labelled) / len(labelled)
+            row["accuracy"] = round(accuracy, 4)
+            row["accuracy_change"] = round(accuracy - report["second_stage_accuracy"], 4)
+        report["thresholds"][str(threshold)] = row
+        print(f"  threshold={threshold:<5} {row}")
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nĐã ghi báo cáo: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
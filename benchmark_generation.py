@@ -0,0 +1,359 @@
+"""Benchmark sinh text của vqa-server.
+
+--scenario concurrent (mặc định): so sánh sinh text tuần tự (generate từng request như trước) với
+continuous batching. Gửi --requests câu hỏi cùng lúc, độ dài prompt và max_new_tokens khác nhau để
+sequence rời batch ở các thời điểm khác nhau. Báo cáo queue wait + tokens/s của từng request và
+throughput tổng; với greedy decoding, token sinh ra của hai cách phải giống nhau (matches_sequential).
+Mặc định dùng một Llama nhỏ khởi tạo ngẫu nhiên nên chạy được trên CPU, không cần tải model.
+
+--scenario followup: mỗi ảnh được hỏi --questions câu liên tiếp (như người dùng hỏi tiếp về cùng
+một ảnh), prompt dạng system prompt cố định + ảnh + câu hỏi như /medgemma, trên một Gemma3 vision nhỏ
+ngẫu nhiên. Chạy ba cấu hình: không cache, chỉ feature cache, feature cache + prefix KV cache. Báo cáo
+vision_ms, prefill_ms, time-to-first-token, hit rate, thời gian tiết kiệm; câu trả lời của mọi cấu
+hình phải giống nhau (matches_uncached).
+
+--scenario speculative: tập cặp ảnh/câu hỏi cố định (--images ảnh đầu tiên trong --image-dir × --questions
+câu hỏi trong SPEC_QUESTIONS, prompt như /medgemma), decode bằng model chính không đổi và bằng speculative
+decoding (draft model đề xuất --draft-tokens token, model chính kiểm tra trong một forward). Báo cáo
+acceptance rate, tokens/s, speedup end-to-end và câu trả lời của từng cặp; với greedy, câu trả lời phải
+giống nhau (matches_baseline). Mặc định MedGemma + gemma-3-270m-it (cùng tokenizer); --draft-layers N
+dùng bản sao N layer đầu của model chính làm draft thay cho --draft.
+
+Ví dụ:
+    python benchmark_generation.py --requests 16 --max-batch 8
+    python benchmark_generation.py --model HuggingFaceTB/SmolLM2-135M --requests 8
+    python benchmark_generation.py --scenario followup --images 4 --questions 4
+    python benchmark_generation.py --scenario speculative --images 2 --questions 4 --draft-tokens 4
+    python benchmark_generation.py --scenario speculative --draft-layers 4 --image-dir static/test
+"""
+import argparse
+import copy
+import glob
+import importlib.util
+import json
+import os
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+# Không load MedGemma/IDEFICS khi import vqa-server
+os.environ["VQA_MODELS"] = ""
+SERVER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vqa-server.py")
+# vqa-server.py có dấu gạch ngang nên phải load theo đường dẫn
+server_spec = importlib.util.spec_from_file_location("vqa_server", SERVER_FILE)
+vqa_server = importlib.util.module_from_spec(server_spec)
+server_spec.loader.exec_module(vqa_server)
+
+
+def load_model(name):
+    """(model, eos id); không có --model thì tạo Llama 4 layer ngẫu nhiên."""
+    from transformers import AutoModelForCausalLM, LlamaConfig, LlamaForCausalLM
+
+    if name:
+        model = AutoModelForCausalLM.from_pretrained(name, dtype=torch.float32)
+    else:
+        torch.manual_seed(0)
+        config = LlamaConfig(vocab_size=2048, hidden_size=256, intermediate_size=512, num_hidden_layers=4,
+                             num_attention_heads=8, num_key_value_heads=4, max_position_embeddings=2048,
+                             bos_token_id=1, eos_token_id=2)
+        model = LlamaForCausalLM(config)
+    return model.eval(), model.config.eos_token_id
+
+
+def load_vision_model():
+    """Gemma3 (kiến trúc của MedGemma) nhỏ khởi tạo ngẫu nhiên: SigLIP 224px + 256 token ảnh như MedGemma."""
+    from transformers import Gemma3Config, Gemma3ForConditionalGeneration
+
+    torch.manual_seed(0)
+    config = Gemma3Config(
+        text_config={"vocab_size": 2048, "hidden_size": 512, "intermediate_size": 2048, "num_hidden_layers": 8,
+                     "num_attention_heads": 8, "num_key_value_heads": 4, "head_dim": 64, "sliding_window": 128,
+                     "bos_token_id": 1, "eos_token_id": 2, "pad_token_id": 0},
+        vision_config={"hidden_size": 384, "intermediate_size": 1536, "num_hidden_layers": 8,
+                       "num_attention_heads": 6, "image_size": 224, "patch_size": 14},
+        mm_tokens_per_image=256
+    )
+    model = Gemma3ForConditionalGeneration(config)
+    return model.eval(), config.text_config.eos_token_id
+
+
+SPEC_QUESTIONS = [
+    "Describe this X-ray",
+    "Is there any sign of pneumonia?",
+    "Are the lungs clear?",
+    "What abnormalities are visible in this image?"
+]
+
+
+def make_draft(model, layers):
+    """Draft text-only gồm bản sao `layers` layer đầu của model chính (embedding, norm cuối, lm_head cũng được sao chép).
+    Weight của model chính không bị thay đổi."""
+    from transformers import Gemma3ForCausalLM
+
+    config = copy.deepcopy(model.config.text_config)
+    config.num_hidden_layers = layers
+    config.layer_types = config.layer_types[:layers]
+    draft = Gemma3ForCausalLM(config).to(model.dtype)
+    text_state = model.model.language_model.state_dict()
+    draft.model.load_state_dict({k: v.clone() for k, v in text_state.items()
+                                 if not k.startswith("layers.") or int(k.split(".")[1]) < layers})
+    draft.lm_head.weight.data.copy_(model.lm_head.weight.data)
+    return draft.eval()
+
+
+def load_speculative(args):
+    """(processor, model chính, eos, draft, các cặp cố định: --images ảnh đầu trong --image-dir × --questions câu hỏi)."""
+    from PIL import Image
+    from transformers import AutoModelForCausalLM, AutoModelForImageTextToText, AutoProcessor
+
+    processor = AutoProcessor.from_pretrained(args.target)
+    model = AutoModelForImageTextToText.from_pretrained(args.target, dtype=torch.float32).eval()
+    if args.draft_layers:
+        draft = make_draft(model, args.draft_layers)
+    else:
+        draft = AutoModelForCausalLM.from_pretrained(args.draft, dtype=torch.float32).eval()
+    eos = model.generation_config.eos_token_id
+    paths = sorted(p for p in glob.glob(os.path.join(args.image_dir, "*")) if p.lower().endswith((".png", ".jpg", ".jpeg")))
+    items = [{
+        "inputs": vqa_server.medgemma_inputs(processor, model, Image.open(path).convert("RGB"), question),
+        "image_key": path,
+        "image": os.path.basename(path),
+        "question": question,
+        "max_new_tokens": args.max_new_tokens
+    } for path in paths[:args.images] for question in SPEC_QUESTIONS[:args.questions]]
+    if not items:
+        raise SystemExit(f"Không có ảnh trong {args.image_dir}")
+    return processor, model, eos, draft, items
+
+
+def speculative_report(args):
+    processor, model, eos, draft, items = load_speculative(args)
+    speculative = {"draft_model": draft, "draft_inputs": vqa_server.gemma3_draft_inputs,
+                   "num_draft_tokens": args.draft_tokens}
+    # Warm-up, không tính giờ
+    run_followups(model, eos, items[:1], 0, 0)
+    run_followups(model, eos, items[:1], 0, 0, **speculative)
+
+    # Tắt feature/prefix cache để chỉ so sánh phần decode; baseline là model chính không đổi, không có draft
+    baseline, baseline_outputs = run_followups(model, eos, items, 0, 0)
+    spec, spec_outputs = run_followups(model, eos, items, 0, 0, **speculative)
+    proposed = sum(r["draft_proposed"] for r in spec["requests"])
+    accepted = sum(r["draft_accepted"] for r in spec["requests"])
+    return {
+        "model": args.target,
+        "draft": f"{args.target} (bản sao {args.draft_layers} layer đầu)" if args.draft_layers else args.draft,
+        "pairs": len(items),
+        "max_new_tokens": args.max_new_tokens,
+        "draft_tokens": args.draft_tokens,
+        "baseline": baseline,
+        "speculative": spec,
+        "acceptance_rate": round(accepted / proposed, 4) if proposed else None,
+        "matches_baseline": sum(a == b for a, b in zip(baseline_outputs, spec_outputs)),
+        "speedup": round(baseline["wall_s"] / spec["wall_s"], 3),
+        # Câu trả lời của model chính (greedy) để đối chiếu từng cặp
+        "answers": [{
+            "image": item["image"],
+            "question": item["question"],
+            "baseline": processor.decode(base, skip_special_tokens=True),
+            "matches_baseline": base == out
+        } for item, base, out in zip(items, baseline_outputs, spec_outputs)]
+    }
+
+
+def make_followups(model, images, questions, seed):
+    """Mỗi ảnh --questions câu hỏi; cùng ảnh thì cùng pixel_values và cùng image_key."""
+    rng = random.Random(seed)
+    config = model.config
+    vocab_size = config.text_config.vocab_size
+    size = config.vision_config.image_size
+    # bos + system prompt cố định, rồi ảnh (boi, token ảnh, eoi), rồi câu hỏi
+    system = [1] + [rng.randrange(5, vocab_size) for _ in range(16)]
+    image = [3] + [config.image_token_id] * config.mm_tokens_per_image + [4]
+    items = []
+    for i in range(images):
+        pixel_values = torch.randn(1, 3, size, size, generator=torch.Generator().manual_seed(seed + i))
+        for _ in range(questions):
+            question = [rng.randrange(5, vocab_size) for _ in range(rng.randint(8, 32))]
+            input_ids = torch.tensor([system + image + question])
+            items.append({
+                "inputs": {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids),
+                           "token_type_ids": (input_ids == config.image_token_id).long(),
+                           "pixel_values": pixel_values},
+                "image_key": f"image-{i}",
+                "max_new_tokens": rng.randint(8, 24)
+            })
+    return items
+
+
+def run_followups(model, eos, items, feature_mb, prefix_mb, **scheduler_kwargs):
+    """Hỏi lần lượt (câu sau chờ câu trước, như hội thoại) qua scheduler như /medgemma."""
+    vqa_server.feature_cache = vqa_server.TensorCache(feature_mb)
+    vqa_server.prefix_cache = vqa_server.TensorCache(prefix_mb)
+    scheduler = vqa_server.GenerationScheduler("benchmark", model, eos, encode_image=vqa_server.gemma3_encode_image,
+                                               image_inputs=vqa_server.gemma3_image_inputs,
+                                               prefix_boundaries=vqa_server.gemma3_prefix_boundaries,
+                                               **scheduler_kwargs)
+    rows, outputs = [], []
+    start = time.perf_counter()
+    for item in items:
+        tokens, timing = scheduler.submit(item["inputs"], item["max_new_tokens"], image_key=item["image_key"]).result()
+        outputs.append(tokens)
+        rows.append(dict(timing, latency_ms=round(timing["queue_wait_ms"] + timing["generate_ms"], 2)))
+    wall_s = time.perf_counter() - start
+    report = summarize(rows, wall_s)
+    report.update({
+        "mean_vision_ms": round(statistics.mean(r["vision_ms"] for r in rows), 2),
+        "mean_prefill_ms": round(statistics.mean(r["prefill_ms"] for r in rows), 2),
+        "mean_first_token_ms": round(statistics.mean(r["first_token_ms"] for r in rows), 2),
+        # Câu hỏi tiếp theo về ảnh đã hỏi (bỏ câu đầu tiên của mỗi ảnh)
+        "followup_first_token_ms": round(statistics.mean(
+            r["first_token_ms"] for i, r in enumerate(rows) if items[i]["image_key"] == items[i - 1]["image_key"] and i
+        ), 2) if len(rows) > 1 else None,
+        "feature_cache": vqa_server.feature_cache.snapshot(),
+        "prefix_cache": vqa_server.prefix_cache.snapshot()
+    })
+    return report, outputs
+
+
+def followup_report(args):
+    model, eos = load_vision_model()
+    items = make_followups(model, args.images, args.questions, args.seed)
+    # Warm-up, không tính giờ
+    run_followups(model, eos, items[:1], 0, 0)
+
+    uncached, uncached_outputs = run_followups(model, eos, items, 0, 0)
+    feature, feature_outputs = run_followups(model, eos, items, args.cache_mb, 0)
+    prefix, prefix_outputs = run_followups(model, eos, items, args.cache_mb, args.prefix_mb)
+    return {
+        "model": "tiny-gemma3-vision-random",
+        "images": args.images,
+        "questions_per_image": args.questions,
+        "uncached": uncached,
+        "feature_cache": feature,
+        "prefix_cache": prefix,
+        "matches_uncached": {
+            "feature_cache": sum(a == b for a, b in zip(uncached_outputs, feature_outputs)),
+            "prefix_cache": sum(a == b for a, b in zip(uncached_outputs, prefix_outputs))
+        },
+        "prefill_speedup": {
+            "feature_cache": round(uncached["mean_prefill_ms"] / feature["mean_prefill_ms"], 3),
+            "prefix_cache": round(uncached["mean_prefill_ms"] / prefix["mean_prefill_ms"], 3)
+        },
+        "followup_first_token_speedup": round(uncached["followup_first_token_ms"] / prefix["followup_first_token_ms"], 3)
+    }
+
+
+def make_requests(count, vocab_size, seed):
+    rng = random.Random(seed)
+    return [{
+        "input_ids": torch.tensor([[1] + [rng.randrange(3, vocab_size) for _ in range(rng.randint(8, 96))]]),
+        "max_new_tokens": rng.randint(16, 96)
+    } for _ in range(count)]
+
+
+def with_mask(item):
+    return {"input_ids": item["input_ids"], "attention_mask": torch.ones_like(item["input_ids"])}
+
+
+def run_sequential(model, eos, items):
+    """Cách cũ: mỗi request một lần generate, request sau chờ request trước xong."""
+    rows, outputs = [], []
+    start = time.perf_counter()
+    for item in items:
+        begin = time.perf_counter()
+        with torch.inference_mode():
+            generated = model.generate(**with_mask(item), max_new_tokens=item["max_new_tokens"], do_sample=False,
+                                       eos_token_id=eos, pad_token_id=eos)
+        end = time.perf_counter()
+        tokens = generated[0, item["input_ids"].shape[1]:].tolist()
+        outputs.append(tokens)
+        rows.append({"queue_wait_ms": round((begin - start) * 1000, 2), "new_tokens": len(tokens),
+                     "tokens_per_s": round(len(tokens) / (end - begin), 2), "latency_ms": round((end - start) * 1000, 2)})
+    return rows, outputs, time.perf_counter() - start
+
+
+def run_batched(model, eos, items, max_batch):
+    scheduler = vqa_server.GenerationScheduler("benchmark", model, eos, max_batch_size=max_batch)
+    start = time.perf_counter()
+    # Gửi đồng thời như nhiều request Flask cùng lúc
+    with ThreadPoolExecutor(max_workers=len(items)) as pool:
+        futures = list(pool.map(lambda item: scheduler.submit(with_mask(item), item["max_new_tokens"]), items))
+        results = [f.result() for f in futures]
+    wall_s = time.perf_counter() - start
+    rows = [dict(timing, latency_ms=round(timing["queue_wait_ms"] + timing["generate_ms"], 2)) for _, timing in results]
+    return rows, [tokens for tokens, _ in results], wall_s
+
+
+def summarize(rows, wall_s):
+    tokens = sum(r["new_tokens"] for r in rows)
+    return {
+        "tokens_per_s": round(tokens / wall_s, 2),
+        "wall_s": round(wall_s, 3),
+        "mean_queue_wait_ms": round(statistics.mean(r["queue_wait_ms"] for r in rows), 2),
+        "mean_latency_ms": round(statistics.mean(r["latency_ms"] for r in rows), 2),
+        "requests": rows
+    }
+
+
+def concurrent_report(args):
+    model, eos = load_model(args.model)
+    items = make_requests(args.requests, model.config.vocab_size, args.seed)
+    # Warm-up, không tính giờ
+    run_sequential(model, eos, items[:1])
+
+    seq_rows, seq_outputs, seq_s = run_sequential(model, eos, items)
+    batch_rows, batch_outputs, batch_s = run_batched(model, eos, items, args.max_batch)
+
+    report = {
+        "model": args.model or "tiny-llama-random",
+        "requests": args.requests,
+        "max_batch": args.max_batch,
+        "sequential": summarize(seq_rows, seq_s),
+        "continuous": summarize(batch_rows, batch_s),
+        "matches_sequential": sum(a == b for a, b in zip(seq_outputs, batch_outputs))
+    }
+    report["throughput_speedup"] = round(report["continuous"]["tokens_per_s"] / report["sequential"]["tokens_per_s"], 3)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=["concurrent", "followup", "speculative"], default="concurrent")
+    parser.add_argument("--model", default="", help="causal LM trên Hugging Face (bỏ trống = Llama nhỏ ngẫu nhiên)")
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--max-batch", type=int, default=vqa_server.GEN_MAX_BATCH_SIZE)
+    parser.add_argument("--images", type=int, default=4, help="followup: số ảnh")
+    parser.add_argument("--questions", type=int, default=4, help="followup: số câu hỏi mỗi ảnh")
+    parser.add_argument("--cache-mb", type=float, default=vqa_server.FEATURE_CACHE_MB or 256,
+                        help="followup: dung lượng feature cache khi bật")
+    parser.add_argument("--prefix-mb", type=float, default=vqa_server.PREFIX_CACHE_MB or 1024,
+                        help="followup: dung lượng prefix KV cache khi bật")
+    parser.add_argument("--draft-tokens", type=int, default=vqa_server.SPEC_NUM_DRAFT_TOKENS,
+                        help="speculative: số token draft đề xuất mỗi lượt")
+    parser.add_argument("--draft-layers", type=int, default=0,
+                        help="speculative: > 0 thì draft là bản sao N layer đầu của model chính thay cho --draft")
+    parser.add_argument("--max-new-tokens", type=int, default=64, help="speculative: số token sinh mỗi câu")
+    parser.add_argument("--target", default="google/medgemma-4b-it", help="speculative: model chính trên Hugging Face")
+    parser.add_argument("--draft", default="google/gemma-3-270m-it", help="speculative: model draft cùng tokenizer")
+    parser.add_argument("--image-dir", default=os.path.join("static", "test"), help="speculative: thư mục ảnh")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    reports = {"concurrent": concurrent_report, "followup": followup_report, "speculative": speculative_report}
+    report = reports[args.scenario](args)
+    output = args.output or os.path.join("reports", f"generation_{args.scenario}_benchmark.json")
+
+    print(json.dumps({k: ({kk: vv for kk, vv in v.items() if kk != "requests"} if isinstance(v, dict) else v)
+                      for k, v in report.items()}, indent=2, ensure_ascii=False))
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nĐã ghi báo cáo: {output}")
+
+
+if __name__ == "__main__":
+    main()
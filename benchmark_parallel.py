@@ -0,0 +1,109 @@
+"""So sánh latency của request nhiều model: chạy tuần tự vs fan-out song song trên worker pool.
+
+Với mỗi ảnh trong static/uploads đo: từng model chạy riêng, tất cả model chạy lần lượt
+(cách cũ), và tất cả model fan-out cùng lúc (cách /diagnose đang dùng). Mục tiêu là
+latency fan-out gần với model chậm nhất thay vì tổng các model. Cache kết quả chỉ
+giữ trong RAM để không ảnh hưởng tới cache thật.
+
+Mặc định MODEL_WORKERS=1 (forward lần lượt, mỗi forward dùng đủ luồng torch); so sánh
+với fan-out song song bằng cách đặt MODEL_WORKERS > 1.
+
+Ví dụ:
+    python benchmark_parallel.py --models brain_tumor_vit --limit 50
+    MODEL_WORKERS=3 INTRA_OP_THREADS=4 python benchmark_parallel.py --limit 50
+"""
+import argparse
+import glob
+import importlib.util
+import json
+import os
+import statistics
+import time
+
+from PIL import Image
+
+# Cache kết quả chỉ trong RAM: benchmark không đọc/ghi diagnose_cache.db thật của server
+os.environ["RESULT_CACHE_DB"] = ""
+# ai-server.py có dấu gạch ngang nên phải load theo đường dẫn
+server_spec = importlib.util.spec_from_file_location("ai_server", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ai-server.py"))
+ai_server = importlib.util.module_from_spec(server_spec)
+server_spec.loader.exec_module(ai_server)
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+
+def list_images(folder, limit):
+    paths = sorted(p for p in glob.glob(os.path.join(folder, "*")) if p.lower().endswith(IMAGE_EXTENSIONS))
+    return paths[:limit] if limit else paths
+
+
+def timed_run(models, entries, image):
+    """Một lượt giống /diagnose (preprocess + fan-out), bỏ qua cache; trả về ms."""
+    start = time.perf_counter()
+    inputs = ai_server.prepare_inputs(image, {m: entries[m] for m in models})
+    ai_server.run_models(models, entries, inputs, {}, "benchmark")
+    return (time.perf_counter() - start) * 1000
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        "mean_ms": round(statistics.mean(samples), 3),
+        "p50_ms": round(samples[len(samples) // 2], 3),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", default=",".join(ai_server.model_manager.registry), help="danh sách model, cách nhau bởi dấu phẩy")
+    parser.add_argument("--folder", default=ai_server.UPLOAD_FOLDER)
+    parser.add_argument("--limit", type=int, default=20, help="số ảnh tối đa (0 = tất cả)")
+    parser.add_argument("--output", default=os.path.join("reports", "parallel_benchmark.json"))
+    args = parser.parse_args()
+
+    models = ai_server.parse_model_names(args.models)
+    images = [Image.open(p).convert("RGB") for p in list_images(args.folder, args.limit)]
+    if not images:
+        print(f"Không có ảnh trong {args.folder}")
+        return
+
+    entries = {m: ai_server.model_manager.get(m) for m in models}
+    # Warm-up mỗi model một lượt, không tính giờ
+    timed_run(models, entries, images[0])
+
+    single = {m: [] for m in models}
+    sequential, parallel = [], []
+    for image in images:
+        for m in models:
+            single[m].append(timed_run([m], entries, image))
+        # Cách cũ: chờ xong model này mới gửi model kế tiếp
+        sequential.append(sum(timed_run([m], entries, image) for m in models))
+        parallel.append(timed_run(models, entries, image))
+
+    single = {m: summarize(v) for m, v in single.items()}
+    slowest = max(single, key=lambda m: single[m]["p50_ms"])
+    report = {
+        "images": len(images),
+        "models": models,
+        "cpu_count": ai_server.cpu_count,
+        "model_workers": ai_server.model_workers,
+        "intra_op_threads": ai_server.intra_op_threads,
+        "batch_max_wait_ms": ai_server.BATCH_MAX_WAIT_MS,
+        "single": single,
+        "slowest_single": slowest,
+        "sequential": summarize(sequential),
+        "parallel": summarize(parallel)
+    }
+    report["speedup_vs_sequential"] = round(report["sequential"]["p50_ms"] / report["parallel"]["p50_ms"], 3)
+    report["parallel_over_slowest"] = round(report["parallel"]["p50_ms"] / single[slowest]["p50_ms"], 3)
+
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nĐã ghi báo cáo: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Đo RAM và thời gian khởi động khi chạy N worker process, có và không có shared weights.
+
+Mỗi worker load ai-server, load tất cả model được chọn rồi chạy thử một forward (giống một
+worker uvicorn đã warm). Khi mọi worker đều sẵn sàng thì đo RSS/PSS của từng worker.
+PSS chia đều các trang dùng chung cho các process, nên tổng PSS là RAM thực tế của cả nhóm.
+
+Ví dụ:
+    python benchmark_workers.py --workers 4
+"""
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import time
+
+SERVER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ai-server.py")
+
+
+def load_server():
+    # Cache kết quả chỉ trong RAM: benchmark không đọc/ghi diagnose_cache.db thật của server
+    os.environ["RESULT_CACHE_DB"] = ""
+    # ai-server.py có dấu gạch ngang nên phải load theo đường dẫn
+    server_spec = importlib.util.spec_from_file_location("ai_server", SERVER_FILE)
+    ai_server = importlib.util.module_from_spec(server_spec)
+    server_spec.loader.exec_module(ai_server)
+    return ai_server
+
+
+def worker(env, models, ready, done, results):
+    os.environ.update(env)
+    start = time.perf_counter()
+    ai_server = load_server()
+    import torch
+    from PIL import Image
+
+    for name in models:
+        entry = ai_server.model_manager.get(name)
+        pixels = ai_server.resize_image(Image.new("RGB", (256, 256)), entry["spec"])
+        with torch.inference_mode():
+            entry["model"](pixel_values=ai_server.normalize_batch([pixels], entry["spec"]))
+    startup_s = time.perf_counter() - start
+
+    # Đo khi tất cả worker cùng sống để PSS phản ánh đúng phần chia sẻ
+    ready.wait()
+    results.put({"pid": os.getpid(), "startup_s": round(startup_s, 3), **ai_server.process_memory()})
+    done.wait()
+
+
+def run_mode(shared, workers, models):
+    env = {"SHARED_WEIGHTS": "1" if shared else "0", "AI_WORKERS": str(workers)}
+    ctx = multiprocessing.get_context("spawn")
+    ready, done, results = ctx.Barrier(workers), ctx.Barrier(workers + 1), ctx.Queue()
+    processes = [ctx.Process(target=worker, args=(env, models, ready, done, results)) for _ in range(workers)]
+    for p in processes:
+        p.start()
+    rows = [results.get() for _ in processes]
+    done.wait()
+    for p in processes:
+        p.join()
+
+    summary = {"workers": rows}
+    for key in ("startup_s", "rss_mb", "pss_mb"):
+        values = [r[key] for r in rows if key in r]
+        if values:
+            summary[f"max_{key}" if key == "startup_s" else f"total_{key}"] = round(max(values) if key == "startup_s" else sum(values), 2)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--models", default="", help="danh sách model (mặc định: tất cả model eager trong registry)")
+    parser.add_argument("--output", default=os.path.join("reports", "worker_memory.json"))
+    args = parser.parse_args()
+
+    # Chuẩn bị file safetensors trước, giống process chính của uvicorn
+    os.environ["SHARED_WEIGHTS"] = "1"
+    ai_server = load_server()
+    registry = ai_server.model_manager.registry
+    models = ai_server.parse_model_names(args.models) or [n for n, r in registry.items() if r.get("backend", "eager") == "eager"]
+    ai_server.prepare_shared_weights({n: registry[n] for n in models})
+
+    report = {"workers": args.workers, "models": models}
+    for mode, shared in (("private", False), ("shared", True)):
+        print(f"== {mode}: {args.workers} worker")
+        report[mode] = run_mode(shared, args.workers, models)
+        print({k: v for k, v in report[mode].items() if k != "workers"})
+
+    if "total_pss_mb" in report["shared"]:
+        report["pss_saved_mb"] = round(report["private"]["total_pss_mb"] - report["shared"]["total_pss_mb"], 2)
+    report["startup_speedup"] = round(report["private"]["max_startup_s"] / report["shared"]["max_startup_s"], 3)
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nĐã ghi báo cáo: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""Export/quantize các model phân loại của ai-server và so sánh với fp32.
+
+Với mỗi model: export ONNX vào ONNX_FOLDER, tạo bản INT8 (dynamic quantization),
+chạy cả ba backend trên ảnh trong static/test + static/uploads rồi ghi báo cáo parity
+(tỉ lệ trùng top_label, sai lệch score, thời gian/ảnh) và gợi ý giá trị MODEL_BACKENDS.
+
+Ví dụ:
+    python export_backends.py --models skin_cancer_vit,pneumonia_vit --limit 200
+"""
+import argparse
+import glob
+import importlib.util
+import json
+import os
+import time
+
+import torch
+from PIL import Image
+
+# Cache kết quả chỉ trong RAM: benchmark không đọc/ghi diagnose_cache.db thật của server
+os.environ["RESULT_CACHE_DB"] = ""
+# ai-server.py có dấu gạch ngang nên phải load theo đường dẫn
+server_spec = importlib.util.spec_from_file_location("ai_server", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ai-server.py"))
+ai_server = importlib.util.module_from_spec(server_spec)
+server_spec.loader.exec_module(ai_server)
+
+IMAGE_FOLDERS = ["static/test", "static/uploads"]
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+BACKENDS = ["eager", "int8", "onnx"]
+
+
+class LogitsOnly(torch.nn.Module):
+    """ONNX chỉ cần đầu ra logits, bỏ các trường khác của ModelOutput."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model(pixel_values=pixel_values).logits
+
+
+def export_onnx(name, model, spec, opset):
+    path = ai_server.onnx_model_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    dummy = torch.zeros(1, 3, 224, 224)
+    if spec["resize"][0] == "fixed":
+        dummy = torch.zeros(1, 3, spec["resize"][1], spec["resize"][2])
+
+    torch.onnx.export(
+        LogitsOnly(model).eval(), (dummy,), path,
+        input_names=["pixel_values"], output_names=["logits"],
+        dynamic_axes={"pixel_values": {0: "batch"}, "logits": {0: "batch"}},
+        opset_version=opset, dynamo=False
+    )
+    return path
+
+
+def list_images(limit):
+    paths = []
+    for folder in IMAGE_FOLDERS:
+        paths += sorted(p for p in glob.glob(os.path.join(folder, "*")) if p.lower().endswith(IMAGE_EXTENSIONS))
+    return paths[:limit] if limit else paths
+
+
+def load_pixels(paths, spec):
+    pixels = []
+    for path in paths:
+        try:
+            image = Image.open(path).convert("RGB")
+        except Exception as e:
+            print(f"  bỏ qua {path}: {e}")
+            continue
+        pixels.append(ai_server.resize_image(image, spec))
+    return pixels
+
+
+def run_backend(model, pixels, spec, batch_size):
+    """Trả về (ma trận xác suất [N, num_labels], ms trung bình mỗi ảnh)."""
+    scores = []
+    start = time.perf_counter()
+    for i in range(0, len(pixels), batch_size):
+        batch = ai_server.normalize_batch(pixels[i:i + batch_size], spec)
+        with torch.inference_mode():
+            logits = model(pixel_values=batch).logits
+        scores.append(logits.float().softmax(-1))
+    elapsed = time.perf_counter() - start
+    return torch.cat(scores), elapsed * 1000 / max(1, len(pixels))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", default=",".join(ai_server.model_manager.registry), help="danh sách model, cách nhau bởi dấu phẩy")
+    parser.add_argument("--limit", type=int, default=0, help="số ảnh tối đa dùng để so sánh (0 = tất cả)")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--min-agreement", type=float, default=0.99, help="tỉ lệ trùng top_label tối thiểu so với fp32")
+    parser.add_argument("--output", default=os.path.join("reports", "backend_parity.json"))
+    args = parser.parse_args()
+
+    paths = list_images(args.limit)
+    print(f"Dùng {len(paths)} ảnh để so sánh")
+
+    report = {"images": len(paths), "min_agreement": args.min_agreement, "models": {}}
+    recommended = {}
+
+    for name in ai_server.parse_model_names(args.models):
+        record = ai_server.model_manager.registry[name]
+        repo, revision = record["repo"], record.get("revision", "main")
+        preprocessing = record.get("preprocessing")
+        print(f"== {name} ({repo}@{revision})")
+
+        eager, processor, eager_bytes = ai_server.load_classifier(name, repo, revision, "eager", preprocessing)
+        spec = ai_server.preprocess_spec(processor)
+        print("  export ONNX →", export_onnx(name, eager, spec, args.opset))
+
+        pixels = load_pixels(paths, spec)
+        if not pixels:
+            print("  không có ảnh hợp lệ, bỏ qua")
+            continue
+
+        reference, _ = run_backend(eager, pixels, spec, args.batch_size)
+        results = {}
+        for backend in BACKENDS:
+            if backend == "eager":
+                model, nbytes = eager, eager_bytes
+            else:
+                model, _, nbytes = ai_server.load_classifier(name, repo, revision, backend, preprocessing)
+            scores, ms_per_image = run_backend(model, pixels, spec, args.batch_size)
+            diff = (scores - reference).abs()
+            results[backend] = {
+                "top_label_agreement": round((scores.argmax(-1) == reference.argmax(-1)).float().mean().item(), 4),
+                "max_score_diff": round(diff.max().item(), 6),
+                "mean_score_diff": round(diff.mean().item(), 6),
+                "ms_per_image": round(ms_per_image, 3),
+                "memory_mb": round(nbytes / 1024 / 1024, 2)
+            }
+            print(f"  {backend:6s} {results[backend]}")
+
+        eligible = [b for b in BACKENDS if results[b]["top_label_agreement"] >= args.min_agreement]
+        recommended[name] = min(eligible, key=lambda b: results[b]["ms_per_image"])
+        report["models"][name] = {"repo": repo, "revision": revision, "backends": results, "recommended": recommended[name]}
+
+    report["MODEL_BACKENDS"] = ",".join(f"{n}={b}" for n, b in recommended.items())
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    print(f"\nĐã ghi báo cáo: {args.output}")
+    print(f'MODEL_BACKENDS="{report["MODEL_BACKENDS"]}"')
+
+
+if __name__ == "__main__":
+    main()
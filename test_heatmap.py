@@ -1,43 +1,342 @@
-import requests
+"""Benchmark + kiểm tra hồi quy cho ảnh giải thích (explain).
+
+Quét model × kích thước ảnh × mức đồng thời. Mỗi case gửi --requests lượt explain cho một model
+từ --concurrency luồng, đo latency p50/p95/p99, throughput (lượt/giây) và RAM đỉnh (RSS lấy mẫu
+trong lúc chạy case). Target:
+  local   gọi thẳng ai-server trong process, cùng đường đi với /diagnose?explain=saliency
+          (--modes explain,plain để so với chẩn đoán không explain)
+  standin explain server giả chạy trên localhost, cùng giao thức với EXPLAIN_SERVER_HOST cũ
+          (POST /explain: model_kind, prediction, image → PNG) nhưng tính bằng ai-server, để đo
+          chi phí của cách cũ (upload lại ảnh + forward lại + PNG) mà không cần host GPU
+  URL     explain server thật, vd http://10.102.196.101:8000/explain (RAM đỉnh chỉ đo được khi
+          server chạy cùng máy và có --pid)
+
+Báo cáo (JSON) ghi cả dung lượng mỗi explanation: ảnh đã tô (JPEG) so với saliency thô. Nếu có
+--baseline (báo cáo của lần chạy trước) thì so từng case và đánh dấu hồi quy khi p95 / RAM đỉnh
+tăng hoặc throughput giảm quá --tolerance. Ảnh giải thích của ảnh đầu tiên được ghi ra
+explain_{idx}_{tên ảnh} trong --save-folder để xem lại. Cache kết quả chỉ giữ trong RAM để không
+ảnh hưởng tới cache thật.
+
+Ví dụ:
+    python test_heatmap.py --models brain_tumor_vit,brain_tumor_resnet --sizes 224,1024 --concurrency 1,4
+    python test_heatmap.py --target standin --output reports/explain_standin.json
+    python test_heatmap.py --baseline reports/explain_benchmark.json --fail-on-regression
+"""
+import argparse
+import base64
+import email.parser
+import glob
+import importlib.util
+import io
+import json
 import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from PIL import Image
+
+# Cache kết quả chỉ trong RAM: benchmark không đọc/ghi diagnose_cache.db thật của server
+os.environ["RESULT_CACHE_DB"] = ""
+# ai-server.py có dấu gạch ngang nên phải load theo đường dẫn
+server_spec = importlib.util.spec_from_file_location("ai_server", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ai-server.py"))
+ai_server = importlib.util.module_from_spec(server_spec)
+server_spec.loader.exec_module(ai_server)
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+# Khoảng lấy mẫu RSS khi đo RAM đỉnh
+MEMORY_SAMPLE_S = 0.01
+# Các chỉ số so với baseline: (tên, True nếu tăng là xấu)
+REGRESSION_METRICS = (("p95_ms", True), ("throughput_rps", False), ("peak_rss_mb", True))
+
+
+def list_images(folder, limit):
+    paths = sorted(p for p in glob.glob(os.path.join(folder, "*")) if p.lower().endswith(IMAGE_EXTENSIONS) and not os.path.basename(p).startswith("explain_"))
+    return paths[:limit] if limit else paths
+
+
+def parse_ints(value):
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def resize_long_side(image, size):
+    """Đổi cạnh dài của ảnh về size (giữ tỉ lệ) để quét theo kích thước ảnh upload."""
+    scale = size / max(image.size)
+    return image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.BILINEAR)
+
+
+def encode_png(image):
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def local_explain(entries, model, image, explain=True):
+    """Một lượt giống /diagnose?explain=saliency cho một model (bỏ qua cache); trả về saliency đã encode hoặc None."""
+    inputs = ai_server.prepare_inputs(image, {model: entries[model]})
+    saliency = {model: None} if explain and entries[model]["meta"]["explain"] else {}
+    ai_server.run_models([model], entries, inputs, {}, "benchmark", saliency)
+    if saliency.get(model) is None:
+        return None
+    return ai_server.encode_saliency(image, saliency[model], entries[model]["spec"])
+
+
+def remote_explain(url, model, payload):
+    """Cách cũ: gửi lại ảnh sang explain server cho một model; trả về nội dung ảnh giải thích."""
+    files = {
+        "model_kind": (None, ai_server.model_manager.registry[model]["repo"]),
+        "prediction": (None, ""),
+        "image": ("image.png", payload, "image/png")
+    }
+    response = requests.post(url, files=files, timeout=120)
+    response.raise_for_status()
+    return response.content
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """POST /explain giống explain server cũ: forward lại ảnh trên ai-server, trả về PNG đã tô."""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        message = email.parser.BytesParser().parsebytes(f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body)
+        fields = {part.get_param("name", header="content-disposition"): part.get_payload(decode=True) for part in message.get_payload()}
+        repo = fields.get("model_kind", b"").decode()
+        model = next((n for n, r in ai_server.model_manager.registry.items() if r["repo"] == repo), None)
+        if model is None:
+            self.send_error(404, f"Không có model {repo}")
+            return
+        entries = {model: ai_server.model_manager.get(model)}
+        image = Image.open(io.BytesIO(fields["image"])).convert("RGB")
+        inputs = ai_server.prepare_inputs(image, entries)
+        saliency = {model: None} if entries[model]["meta"]["explain"] else {}
+        ai_server.run_models([model], entries, inputs, {}, "standin", saliency)
+        if saliency.get(model) is None:
+            self.send_error(422, f"{model} không hỗ trợ explain")
+            return
+        overlay = Image.open(io.BytesIO(base64.b64decode(ai_server.render_explanation(image, saliency[model], entries[model]["spec"]))))
+        content = encode_png(overlay)
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
 
-EXPLAIN_SERVER_HOST = "http://10.102.196.101:8000/explain"
-UPLOAD_FOLDER = 'static/test'
-filename = "image.jpg"
 
-model_name='skin,breast,pneu,brain,covid'
+def start_standin():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandinHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/explain"
 
-# File ảnh cần upload
-image_path = "image.jpg"   # đổi thành ảnh của bạn
 
-for idx, m in enumerate(model_name.split(',')):
-        input_file = open(os.path.join(UPLOAD_FOLDER, filename), 'rb')
-        # Explain Multipart form-data
-        explain_model_name = ""
+def read_rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
 
-        if 'skin' in m:
-            explain_model_name = "Anwarkh1/Skin_Cancer-Image_Classification"
 
-        elif 'breast' in m:
-            explain_model_name = "Falah/vit-base-breast-cancer"
+class PeakMemory:
+    """Lấy mẫu RSS của process pid trong một luồng nền; peak_mb là giá trị lớn nhất thấy được."""
 
-        elif 'brain' in m:
-            explain_model_name = "DunnBC22/vit-base-patch16-224-in21k_brain_tumor_diagnosis"
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak_mb = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
 
-        elif 'pneu' in m:
-            explain_model_name = "xyuan/vit-xray-pneumonia-classification"
+    def _sample(self):
+        while True:
+            rss = read_rss_mb(self.pid)
+            if rss is not None:
+                self.peak_mb = rss if self.peak_mb is None else max(self.peak_mb, rss)
+            if self._stop.wait(MEMORY_SAMPLE_S):
+                return
 
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def percentile(samples, q):
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def summarize(samples, wall_s):
+    samples = sorted(samples)
+    return {
+        "requests": len(samples),
+        "mean_ms": round(statistics.mean(samples), 3),
+        "p50_ms": round(percentile(samples, 0.5), 3),
+        "p95_ms": round(percentile(samples, 0.95), 3),
+        "p99_ms": round(percentile(samples, 0.99), 3),
+        "throughput_rps": round(len(samples) / wall_s, 3)
+    }
+
+
+def run_case(call, inputs, requests_count, concurrency, pid):
+    """Chạy requests_count lượt call(input) từ concurrency luồng; trả về thống kê latency/throughput/RAM."""
+    call(inputs[0])  # warm-up, không tính giờ
+
+    def timed(item):
+        start = time.perf_counter()
+        call(item)
+        return (time.perf_counter() - start) * 1000
+
+    cuda = pid == os.getpid() and ai_server.torch.cuda.is_available()
+    if cuda:
+        ai_server.torch.cuda.reset_peak_memory_stats()
+    with PeakMemory(pid) as memory:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            samples = list(pool.map(timed, (inputs[i % len(inputs)] for i in range(requests_count))))
+        wall_s = time.perf_counter() - start
+    stats = summarize(samples, wall_s)
+    stats["peak_rss_mb"] = round(memory.peak_mb, 2) if memory.peak_mb is not None else None
+    if cuda:
+        stats["peak_cuda_mb"] = round(ai_server.torch.cuda.max_memory_allocated() / 1024 ** 2, 2)
+    return stats
+
+
+def compare(cases, baseline, tolerance):
+    """Các chỉ số xấu đi quá tolerance so với baseline (cùng khóa case)."""
+    regressions = []
+    for key, stats in cases.items():
+        previous = baseline.get(key)
+        if not previous:
+            continue
+        for metric, higher_is_worse in REGRESSION_METRICS:
+            old, new = previous.get(metric), stats.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (change > tolerance) if higher_is_worse else (change < -tolerance):
+                regressions.append({"case": key, "metric": metric, "baseline": old, "current": new, "change": round(change, 4)})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", default=",".join(ai_server.model_manager.registry), help="danh sách model, cách nhau bởi dấu phẩy")
+    parser.add_argument("--folder", default="static/test")
+    parser.add_argument("--limit", type=int, default=20, help="số ảnh tối đa (0 = tất cả)")
+    parser.add_argument("--target", default="local", help="local, standin hoặc URL /explain")
+    parser.add_argument("--pid", type=int, help="pid của explain server (target URL chạy cùng máy) để đo RAM đỉnh")
+    parser.add_argument("--modes", default="explain", help="explain,plain (plain chỉ có với target local)")
+    parser.add_argument("--sizes", default="224,512,1024", help="cạnh dài của ảnh gửi đi, cách nhau bởi dấu phẩy")
+    parser.add_argument("--concurrency", default="1,4", help="số luồng gửi đồng thời, cách nhau bởi dấu phẩy")
+    parser.add_argument("--requests", type=int, default=20, help="số lượt mỗi case")
+    parser.add_argument("--save-folder", default="static/test", help="nơi ghi ảnh giải thích của ảnh đầu tiên")
+    parser.add_argument("--output", default=os.path.join("reports", "explain_benchmark.json"))
+    parser.add_argument("--baseline", help="báo cáo JSON của lần chạy trước để so sánh")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="mức xấu đi cho phép so với baseline (0.1 = 10%%)")
+    parser.add_argument("--fail-on-regression", action="store_true", help="thoát với mã 1 nếu có hồi quy")
+    args = parser.parse_args()
+
+    models = ai_server.parse_model_names(args.models)
+    paths = list_images(args.folder, args.limit)
+    images = [Image.open(p).convert("RGB") for p in paths]
+    if not images:
+        print(f"Không có ảnh trong {args.folder}")
+        return
+
+    entries = {m: ai_server.model_manager.get(m) for m in models}
+    explained = [m for m in models if entries[m]["meta"]["explain"]]
+    sizes, levels = parse_ints(args.sizes), parse_ints(args.concurrency)
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+
+    standin = None
+    if args.target == "local":
+        url, pid = None, os.getpid()
+    else:
+        if args.target == "standin":
+            standin, url = start_standin()
+            pid = os.getpid()
         else:
-            explain_model_name = "DunnBC22/vit-base-patch16-224-in21k_covid_19_ct_scans"
-
-        print(explain_model_name)
-        files = {
-            "model_kind": (None, explain_model_name),
-            "prediction": (None, "Value"),
-            "image": (filename, input_file, "image/png")
-        }
-
-        response = requests.post(EXPLAIN_SERVER_HOST, files=files)
-        if response.content:
-            with open(os.path.join(UPLOAD_FOLDER, "explain_"+str(idx)+"_"+filename), "wb") as f:
-                f.write(response.content)
\ No newline at end of file
+            url, pid = args.target, args.pid
+        # Explain server luôn explain, model không hỗ trợ thì không đo được
+        modes, models = ["explain"], explained
+
+    # Ảnh giải thích của ảnh đầu tiên + dung lượng mỗi explanation: ảnh đã tô (JPEG) vs saliency thô
+    os.makedirs(args.save_folder, exist_ok=True)
+    sizes_bytes = {"overlay": [], "saliency": []}
+    for idx, m in enumerate(models):
+        if m not in explained:
+            continue
+        inputs = ai_server.prepare_inputs(images[0], {m: entries[m]})
+        saliency = {m: None}
+        ai_server.run_models([m], entries, inputs, {}, "benchmark", saliency)
+        overlay = ai_server.render_explanation(images[0], saliency[m], entries[m]["spec"])
+        with open(os.path.join(args.save_folder, f"explain_{idx}_{os.path.basename(paths[0])}"), "wb") as f:
+            f.write(base64.b64decode(overlay))
+        sizes_bytes["overlay"].append(len(json.dumps(overlay)))
+        sizes_bytes["saliency"].append(len(json.dumps(ai_server.encode_saliency(images[0], saliency[m], entries[m]["spec"]))))
+
+    cases = {}
+    for size in sizes:
+        scaled = [resize_long_side(image, size) for image in images]
+        payloads = [encode_png(image) for image in scaled] if url else None
+        for m in models:
+            for mode in modes:
+                if url:
+                    call, inputs = (lambda payload, m=m: remote_explain(url, m, payload)), payloads
+                else:
+                    call, inputs = (lambda image, m=m, mode=mode: local_explain(entries, m, image, mode == "explain")), scaled
+                for concurrency in levels:
+                    key = f"{m}|{mode}|{size}|c{concurrency}"
+                    cases[key] = {"model": m, "mode": mode, "size": size, "concurrency": concurrency,
+                                  **run_case(call, inputs, args.requests, concurrency, pid)}
+                    print(key, {k: v for k, v in cases[key].items() if k.endswith(("_ms", "_rps", "_mb"))})
+
+    if standin:
+        standin.shutdown()
+
+    report = {
+        "target": "local" if args.target == "local" else ("standin" if standin else url),
+        "images": len(images),
+        "models": models,
+        "methods": {m: entries[m]["meta"]["explain"] for m in models},
+        "sizes": sizes,
+        "concurrency": levels,
+        "requests_per_case": args.requests,
+        "cases": cases
+    }
+    if sizes_bytes["overlay"]:
+        report["bytes_per_explanation"] = {k: round(statistics.mean(v)) for k, v in sizes_bytes.items()}
+        report["storage_reduction"] = round(report["bytes_per_explanation"]["overlay"] / report["bytes_per_explanation"]["saliency"], 1)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(cases, baseline.get("cases", {}), args.tolerance)
+        report["baseline"] = {"path": args.baseline, "tolerance": args.tolerance, "regressions": regressions}
+        for r in regressions:
+            print(f"HỒI QUY {r['case']} {r['metric']}: {r['baseline']} → {r['current']} ({r['change']:+.1%})")
+        if not regressions:
+            print(f"Không có hồi quy so với {args.baseline} (tolerance {args.tolerance:.0%})")
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nĐã ghi báo cáo: {args.output}")
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
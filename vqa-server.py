@@ -1,15 +1,46 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from huggingface_hub import login
-from transformers import pipeline, AutoProcessor, AutoModelForImageTextToText
+from transformers import AutoProcessor, AutoModelForCausalLM, AutoModelForImageTextToText, DynamicCache
+from concurrent.futures import Future, InvalidStateError, TimeoutError as FutureTimeoutError
 from PIL import Image
 import torch
 import base64
+import hashlib
 import io
+import json
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+# =========================
+# Config
+# =========================
+HF_TOKEN = os.getenv("HF_TOKEN")
+# Model load khi khởi động (bỏ trống = không load gì, dùng cho benchmark với model nhỏ)
+VQA_MODELS = [m.strip() for m in os.getenv("VQA_MODELS", "medgemma,idefics").split(",") if m.strip()]
+# Continuous batching: số sequence tối đa cùng decode trong một batch của mỗi model
+GEN_MAX_BATCH_SIZE = int(os.getenv("GEN_MAX_BATCH_SIZE", "8"))
+# Cache image features đã project (output của vision tower + projector) theo hash ảnh + model, để câu hỏi
+# tiếp theo về cùng một ảnh bỏ qua vision encoder. LRU giới hạn theo tổng byte tensor (nằm trên device của model)
+FEATURE_CACHE_MB = float(os.getenv("FEATURE_CACHE_MB", "256"))  # 0 = tắt
+# Prefix KV cache: KV của phần đầu prompt dùng chung (system prompt; system prompt + ảnh) để câu hỏi mới
+# prefill tiếp từ đó thay vì từ đầu. LRU theo tổng byte KV (MedGemma 4B ~140KB/token, ~40MB/ảnh)
+PREFIX_CACHE_MB = float(os.getenv("PREFIX_CACHE_MB", "1024"))  # 0 = tắt
+# Speculative decoding cho MedGemma: model draft nhỏ cùng tokenizer (vd google/gemma-3-270m-it) đề xuất
+# SPEC_NUM_DRAFT_TOKENS token, MedGemma kiểm tra cả loạt trong một forward. Bỏ trống = tắt.
+# Khi bật, MedGemma decode từng request một (batch 1) để giảm độ trễ, nhất là khi chạy trên CPU
+SPEC_DRAFT_MODEL = os.getenv("SPEC_DRAFT_MODEL", "")
+SPEC_NUM_DRAFT_TOKENS = int(os.getenv("SPEC_NUM_DRAFT_TOKENS", "4"))
+# Thời gian tối đa chờ một câu trả lời (tính cả lúc xếp hàng); quá hạn thì trả 504 / event error thay vì treo request
+GEN_RESULT_TIMEOUT_S = float(os.getenv("GEN_RESULT_TIMEOUT_S", "600"))
 
 # =========================
 # Hugging Face login
 # =========================
-login("")
+if HF_TOKEN:
+    login(HF_TOKEN)
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
@@ -24,23 +55,681 @@ def image_from_base64(b64_string: str) -> Image.Image:
     image_bytes = base64.b64decode(b64_string)
     return Image.open(io.BytesIO(image_bytes)).convert("RGB")
 
+def read_vqa_request():
+    """(ảnh, hash nội dung ảnh, các field, có stream không) từ JSON (image_base64) hoặc multipart
+    (image=file, như curl của ai-server)."""
+    if request.is_json:
+        data = request.get_json()
+        b64_string = data.get("image_base64") or ""
+        raw = base64.b64decode(b64_string.split(",")[1] if "," in b64_string else b64_string)
+    else:
+        data = request.form
+        file = request.files.get("image")
+        raw = file.read() if file else b""
+    image = Image.open(io.BytesIO(raw)).convert("RGB") if raw else None
+    image_hash = hashlib.sha256(raw).hexdigest() if raw else None
+    stream = str(data.get("stream", request.args.get("stream", ""))).lower() in ("1", "true", "yes")
+    return image, image_hash, data, stream
+
+def sse(event):
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+def answer(scheduler, inputs, stream, decode, result=None, **submit_kwargs):
+    """Chạy qua scheduler; stream=True → SSE: {"token": phần text mới} cho mỗi token, cuối cùng
+    {"done": true, "result", "timing"}. result(tokens) là câu trả lời đầy đủ (mặc định = decode)."""
+    result = result or decode
+    deadline = time.monotonic() + GEN_RESULT_TIMEOUT_S
+    if not stream:
+        future = scheduler.submit(inputs, **submit_kwargs)
+        try:
+            tokens, timing = future.result(timeout=GEN_RESULT_TIMEOUT_S)
+        except FutureTimeoutError:
+            # Client đã nhận lỗi → bỏ sequence khỏi batch, không decode tiếp và giải phóng KV cache
+            future.cancel()
+            return jsonify({"error": f"Quá {GEN_RESULT_TIMEOUT_S:g}s chưa sinh xong câu trả lời"}), 504
+        return jsonify({"result": result(tokens), "timing": timing})
+
+    events = queue.Queue()
+    future = scheduler.submit(inputs, on_token=lambda tokens: events.put(list(tokens)), **submit_kwargs)
+    future.add_done_callback(lambda f: events.put(None))
+
+    def generate():
+        sent = ""
+        try:
+            while True:
+                try:
+                    tokens = events.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    yield sse({"error": f"Quá {GEN_RESULT_TIMEOUT_S:g}s chưa sinh xong câu trả lời"})
+                    return
+                if tokens is None:
+                    break
+                text = decode(tokens)
+                # Ký tự nhiều byte chưa đủ token thì decode ra U+FFFD, đợi token sau
+                if len(text) > len(sent) and not text.endswith("\ufffd"):
+                    yield sse({"token": text[len(sent):]})
+                    sent = text
+        finally:
+            # Hết giờ hoặc client ngắt stream (generator bị đóng) → bỏ sequence khỏi batch; đã xong thì không làm gì
+            future.cancel()
+        try:
+            tokens, timing = future.result()
+        except Exception as e:
+            yield sse({"error": str(e)})
+            return
+        yield sse({"done": True, "result": result(tokens), "timing": timing})
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 # =========================
-# 1️⃣ MedGemma
+# Image feature cache + prefix KV cache
 # =========================
-medgemma_pipe = pipeline(
-    "image-text-to-text",
-    model="google/medgemma-4b-it",
-    dtype=torch.bfloat16 if device == "cuda" else torch.float32,
-    device=device
-)
+def tensor_bytes(value):
+    if torch.is_tensor(value):
+        return value.numel() * value.element_size()
+    if isinstance(value, (list, tuple)):
+        return sum(tensor_bytes(v) for v in value)
+    return 0
 
-@app.route("/medgemma", methods=["POST"])
-def medgemma_api():
-    data = request.get_json()
 
-    image = image_from_base64(data["image_base64"])
-    prompt = data.get("question", "Describe this X-ray")
+class TensorCache:
+    """LRU cho tensor (hoặc list/tuple tensor), giới hạn theo tổng byte.
+
+    Mỗi entry nhớ thời gian đã tốn để tính nó (cost_ms) để báo thời gian tiết kiệm được khi hit.
+    """
+
+    def __init__(self, max_mb):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "saved_ms": 0.0}
+
+    def get(self, key):
+        """(value, cost_ms) hoặc None."""
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            self.stats["saved_ms"] += item[1]
+            return item[0], item[1]
+
+    def put(self, key, value, cost_ms):
+        size = tensor_bytes(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[2]
+            while self.entries and self.bytes + size > self.max_bytes:
+                self.bytes -= self.entries.popitem(last=False)[1][2]
+                self.stats["evictions"] += 1
+            self.entries[key] = (value, cost_ms, size)
+            self.bytes += size
+
+    def hit_rate(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return round(self.stats["hits"] / lookups, 4) if lookups else 0.0
+
+    def snapshot(self):
+        with self.lock:
+            return {"entries": len(self.entries), "mb": round(self.bytes / 1024 ** 2, 2),
+                    "max_mb": round(self.max_bytes / 1024 ** 2, 2), **self.stats,
+                    "saved_ms": round(self.stats["saved_ms"], 2), "hit_rate": self.hit_rate()}
+
+
+# key = (model, hash ảnh)
+feature_cache = TensorCache(FEATURE_CACHE_MB)
+# key = (model, hash token id của prefix, hash ảnh nếu prefix chứa ảnh)
+prefix_cache = TensorCache(PREFIX_CACHE_MB)
+
+
+def cache_layers(cache):
+    """(keys, values, cumulative_length) của từng layer. DynamicCache luôn tạo tensor mới khi update nên
+    các tensor này giữ nguyên trạng thái hiện tại kể cả khi cache tiếp tục được dùng."""
+    return [(layer.keys, layer.values, getattr(layer, "cumulative_length", None)) for layer in cache.layers]
+
+
+def cache_snapshot(cache):
+    # contiguous() chỉ copy khi layer sliding window đang là view của tensor lớn hơn
+    return [(keys.contiguous(), values.contiguous(), cumulative_length)
+            for keys, values, cumulative_length in cache_layers(cache)]
+
+
+def rollback_cache(cache, before, kept):
+    """Trong các token thêm vào cache kể từ before (= cache_layers(cache)), chỉ giữ kept token đầu.
+
+    Layer sliding window đã bỏ token cũ nên không crop được (DynamicCache.crop báo lỗi); dựng lại từ
+    tensor trước khi thêm + phần token được giữ.
+    """
+    for layer, (keys, values, cumulative_length) in zip(cache.layers, before):
+        if cumulative_length is None:
+            start = keys.shape[-2]
+        else:
+            start = layer.keys.shape[-2] - (layer.cumulative_length - cumulative_length)
+        layer.keys = torch.cat([keys, layer.keys[..., start:start + kept, :]], dim=-2)
+        layer.values = torch.cat([values, layer.values[..., start:start + kept, :]], dim=-2)
+        if cumulative_length is not None:
+            layer.keys = layer.keys[..., -layer.sliding_window + 1:, :]
+            layer.values = layer.values[..., -layer.sliding_window + 1:, :]
+            layer.cumulative_length = cumulative_length + kept
+
+
+def restore_cache(config, snapshot):
+    cache = DynamicCache(config=config)
+    for layer, (keys, values, cumulative_length) in zip(cache.layers, snapshot):
+        layer.lazy_initialization(keys)
+        layer.keys, layer.values = keys, values
+        if cumulative_length is not None:
+            layer.cumulative_length = cumulative_length
+    return cache
+
+
+def gemma3_encode_image(model, inputs):
+    # Vision tower + multi-modal projector, giống Gemma3Model.get_image_features
+    return model.get_image_features(inputs["pixel_values"])
+
+
+def gemma3_image_inputs(model, inputs, features):
+    """Ghép features vào vị trí token ảnh rồi forward bằng inputs_embeds, không cần pixel_values."""
+    input_ids = inputs["input_ids"]
+    image_mask = input_ids == model.config.image_token_id
+    # Token ảnh nằm ngoài vocab của text model thì thay bằng 0 trước khi embed, giống Gemma3Model
+    embed_ids = input_ids.masked_fill(image_mask, 0) if model.config.image_token_id >= model.get_input_embeddings().num_embeddings else input_ids
+    embeds = model.get_input_embeddings()(embed_ids)
+    embeds = embeds.masked_scatter(image_mask.unsqueeze(-1).expand_as(embeds), features.to(embeds.device, embeds.dtype))
+    return {**{k: v for k, v in inputs.items() if k not in ("input_ids", "pixel_values")}, "inputs_embeds": embeds}
+
+
+def gemma3_prefix_boundaries(model, inputs):
+    """Ranh giới prefix dùng chung: ngay trước token ảnh (system prompt) và ngay sau token ảnh cuối
+    (system prompt + ảnh). Trả về [(độ dài prefix, prefix có chứa ảnh không)]."""
+    positions = (inputs["input_ids"][0] == model.config.image_token_id).nonzero()
+    if not len(positions):
+        return []
+    return [(int(positions[0]), False), (int(positions[-1]) + 1, True)]
+
+
+def gemma3_draft_inputs(model, inputs):
+    # Model draft chỉ có text: bỏ token ảnh, giữ system prompt, boi/eoi và câu hỏi
+    input_ids = inputs["input_ids"]
+    return input_ids[:, input_ids[0] != model.config.image_token_id]
+
+
+def idefics_encode_image(model, inputs):
+    # Vision model (+ perceiver resampler nếu có), giống IdeficsModel.forward; trả về (B, số ảnh, seq, hidden)
+    inner = model.model
+    pixel_values = inputs["pixel_values"].to(dtype=inner.dtype)
+    batch_size, num_images = pixel_values.shape[:2]
+    hidden = inner.vision_model(pixel_values=pixel_values.contiguous().view(batch_size * num_images, *pixel_values.shape[2:])).last_hidden_state
+    if inner.config.use_resampler:
+        hidden = inner.perceiver_resampler(hidden)
+    return hidden.view(batch_size, num_images, hidden.shape[1], hidden.shape[2])
+
+
+def idefics_image_inputs(model, inputs, features):
+    key = "perceiver_embeddings" if model.config.use_resampler else "image_encoder_embeddings"
+    return {**{k: v for k, v in inputs.items() if k != "pixel_values"}, key: features}
+
+# =========================
+# Continuous batching
+# =========================
+def left_pad(tensor, length, dim):
+    """Thêm 0 vào đầu trục dim cho đủ length (batch được căn phải: token mới nhất luôn ở cuối)."""
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+class GenerationScheduler:
+    """Sinh text cho nhiều request cùng lúc trên một model bằng continuous batching.
+
+    Một luồng decode giữ batch đang chạy: ở mỗi ranh giới token, request mới được prefill riêng rồi
+    ghép KV cache vào batch (căn phải, padding bên trái + attention mask), sau đó cả batch decode
+    một token. Sequence gặp EOS hoặc đủ max_new_tokens rời batch ngay, không chờ sequence dài nhất.
+    """
+
+    def __init__(self, name, model, eos_token_ids, max_batch_size=GEN_MAX_BATCH_SIZE, decode_kwargs=None,
+                 encode_image=None, image_inputs=None, prefix_boundaries=None, draft_model=None, draft_inputs=None,
+                 num_draft_tokens=SPEC_NUM_DRAFT_TOKENS):
+        self.name = name
+        self.model = model
+        self.eos_token_ids = set(eos_token_ids if isinstance(eos_token_ids, (list, tuple, set)) else [eos_token_ids])
+        self.max_batch_size = max(1, max_batch_size)
+        # Speculative decoding: draft_inputs(model, inputs) → input_ids (batch 1) cho draft_model. Số token draft
+        # được chấp nhận khác nhau giữa các sequence nên chế độ này decode batch 1; không dùng với decode_kwargs
+        self.draft_model = draft_model
+        self.draft_inputs = draft_inputs
+        self.num_draft_tokens = max(1, num_draft_tokens)
+        if draft_model is not None:
+            self.max_batch_size = 1
+        # decode_kwargs(inputs, output) → tensor (batch 1) cần truyền lại ở mọi bước decode, vd ảnh của IDEFICS
+        self.decode_kwargs = decode_kwargs or (lambda inputs, output: {})
+        # encode_image(model, inputs) → features; image_inputs(model, inputs, features) → input cho prefill
+        # không có pixel_values. Có cả hai thì features được cache qua feature_cache
+        self.encode_image = encode_image
+        self.image_inputs = image_inputs
+        # prefix_boundaries(model, inputs) → [(độ dài, có ảnh)]: prompt được prefill theo từng đoạn và KV ở mỗi
+        # ranh giới vào prefix_cache. Chỉ dùng cho model mà input theo chuỗi là input_ids/inputs_embeds,
+        # attention_mask, token_type_ids (Gemma3)
+        self.prefix_boundaries = prefix_boundaries
+        self.queue = queue.Queue()
+        self.active = []
+        self.thread = threading.Thread(target=self._loop, name=f"generate-{name}", daemon=True)
+        self.thread.start()
 
+    def submit(self, inputs, max_new_tokens, suppress_ids=(), on_token=None, image_key=None):
+        """inputs là output của processor (batch 1). Future trả về (token id sinh ra, timing);
+        future.cancel() bỏ request dù đang chờ hay đang decode (sequence bị cắt khỏi batch ở bước sau).
+
+        on_token(tokens) được gọi từ luồng decode mỗi khi có thêm một token (dùng cho stream).
+        image_key (hash nội dung ảnh) để dùng lại image features / prefix KV của ảnh đã hỏi trước đó.
+        """
+        future = Future()
+        self.queue.put({
+            "inputs": inputs,
+            "image_key": image_key,
+            "max_new_tokens": max_new_tokens,
+            "suppress_ids": list(suppress_ids),
+            "on_token": on_token,
+            "future": future,
+            "enqueued_at": time.perf_counter(),
+            "tokens": [],
+            "max_batch": 1,
+            "speculative": {}
+        })
+        return future
+
+    def depth(self):
+        return {"queued": self.queue.qsize(), "active": len(self.active)}
+
+    def _loop(self):
+        while True:
+            seq = None  # request đang được admit (chưa nằm trong self.active)
+            try:
+                if not self.active:
+                    seq = self.queue.get()
+                    self._admit(seq)
+                while len(self.active) < self.max_batch_size:
+                    try:
+                        seq = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    self._admit(seq)
+                seq = None
+                self._drop_cancelled()
+                if self.active:
+                    self._step()
+            except Exception as e:
+                # Lỗi ngoài forward (ghép/cắt KV cache...): trạng thái batch không còn tin được → báo lỗi cho mọi
+                # request đang chạy và đang chờ, luồng decode vẫn sống để nhận request mới
+                print(f"[generate-{self.name}] Lỗi trong vòng decode: {e}")
+                self._fail_all(e, seq)
+
+    def _fail_all(self, error, admitting=None):
+        seqs, self.active = self.active, []
+        if admitting is not None:
+            seqs.append(admitting)
+        while True:
+            try:
+                seqs.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        for seq in seqs:
+            self._resolve(seq, error=error)
+
+    def _resolve(self, seq, result=None, error=None):
+        # Request đã bị huỷ (client hết giờ/ngắt stream) thì không còn ai nhận kết quả
+        try:
+            if error is not None:
+                seq["future"].set_exception(error)
+            else:
+                seq["future"].set_result(result)
+        except InvalidStateError:
+            pass
+
+    def _drop_cancelled(self):
+        """Cắt các sequence đã bị huỷ khỏi batch để không decode tiếp và trả lại KV cache của chúng."""
+        keep = [row for row, seq in enumerate(self.active) if not seq["future"].cancelled()]
+        if len(keep) == len(self.active):
+            return
+        self.active = [self.active[row] for row in keep]
+        if self.active:
+            self._retire(keep)
+        else:
+            self.batch = None
+
+    def _pick(self, logits, seqs):
+        for row, seq in enumerate(seqs):
+            if seq["suppress_ids"]:
+                logits[row, seq["suppress_ids"]] = float("-inf")
+        return logits.argmax(dim=-1)
+
+    def _finish(self, seq):
+        end = time.perf_counter()
+        decode_s = end - seq["admitted_at"]
+        timing = {
+            "queue_wait_ms": round((seq["admitted_at"] - seq["enqueued_at"]) * 1000, 2),
+            "prefill_ms": round(seq["prefill_ms"], 2),
+            "first_token_ms": round((seq["first_token_at"] - seq["enqueued_at"]) * 1000, 2),
+            "generate_ms": round(decode_s * 1000, 2),
+            "new_tokens": len(seq["tokens"]),
+            "tokens_per_s": round(len(seq["tokens"]) / decode_s, 2) if decode_s > 0 else None,
+            "max_batch_size": seq["max_batch"],
+            **seq["vision"],
+            **seq["prefix"],
+            **seq["speculative"]
+        }
+        self._resolve(seq, (seq["tokens"], timing))
+
+    def _append(self, seq, token):
+        seq["tokens"].append(token)
+        if len(seq["tokens"]) == 1:
+            seq["first_token_at"] = time.perf_counter()
+        if seq["on_token"] is not None and token not in self.eos_token_ids:
+            try:
+                seq["on_token"](seq["tokens"])
+            except Exception as e:
+                # Callback stream lỗi chỉ làm mất stream của request đó, không ảnh hưởng cả batch
+                print(f"[generate-{self.name}] on_token lỗi, bỏ stream của request: {e}")
+                seq["on_token"] = None
+
+    def _done(self, seq, token):
+        return token in self.eos_token_ids or len(seq["tokens"]) >= seq["max_new_tokens"]
+
+    def _vision_inputs(self, seq):
+        """Thay pixel_values bằng image features, lấy từ cache nếu ảnh này đã được encode cho model này."""
+        inputs = seq["inputs"]
+        if self.encode_image is None or "pixel_values" not in inputs:
+            return inputs, {}
+        key = (self.name, seq["image_key"]) if seq["image_key"] and feature_cache.max_bytes > 0 else None
+        cached = feature_cache.get(key) if key else None
+        if cached is not None:
+            features, encode_ms = cached
+            stats = {"feature_cache": "hit", "vision_ms": 0.0, "vision_saved_ms": round(encode_ms, 2)}
+        else:
+            start = time.perf_counter()
+            with torch.inference_mode():
+                features = self.encode_image(self.model, inputs)
+            encode_ms = (time.perf_counter() - start) * 1000
+            if key:
+                feature_cache.put(key, features, encode_ms)
+            stats = {"feature_cache": "miss" if key else None, "vision_ms": round(encode_ms, 2), "vision_saved_ms": 0.0}
+        stats["feature_cache_hit_rate"] = feature_cache.hit_rate()
+        return self.image_inputs(self.model, inputs, features), stats
+
+    def _prefix_levels(self, seq):
+        """[(độ dài prefix, có ảnh, key trong prefix_cache hoặc None nếu không cache được)]."""
+        if self.prefix_boundaries is None or prefix_cache.max_bytes == 0:
+            return []
+        input_ids = seq["inputs"]["input_ids"]
+        levels = []
+        for length, has_image in self.prefix_boundaries(self.model, seq["inputs"]):
+            if length >= input_ids.shape[1]:
+                break
+            key = None
+            if seq["image_key"] or not has_image:
+                ids_hash = hashlib.sha256(input_ids[0, :length].cpu().numpy().tobytes()).hexdigest()
+                key = (self.name, ids_hash, seq["image_key"] if has_image else None)
+            levels.append((length, has_image, key))
+        return levels
+
+    def _segment(self, model_inputs, start, end):
+        """Input cho đoạn [start, end) của prompt khi KV của [0, start) đã nằm trong cache."""
+        segment = {"cache_position": torch.arange(start, end, device=self.model.device)}
+        for name, value in model_inputs.items():
+            if name in ("input_ids", "inputs_embeds"):
+                segment[name] = value[:, start:end]
+            elif name in ("attention_mask", "token_type_ids"):
+                # Mask (kể cả mask hai chiều giữa các token ảnh) tính theo vị trí tuyệt đối nên cần từ đầu prompt
+                segment[name] = value[:, :end]
+            else:
+                segment[name] = value
+        return segment
+
+    def _prefill(self, seq):
+        """Prefill prompt, bắt đầu từ prefix dài nhất có trong prefix_cache. Trả về (cache, output cuối)."""
+        inputs = seq["inputs"]
+        length = inputs["input_ids"].shape[1]
+        levels = self._prefix_levels(seq)
+        cache, start, cost_ms, image_cached = None, 0, 0.0, False
+        for boundary, has_image, key in reversed(levels):
+            hit = prefix_cache.get(key) if key else None
+            if hit is not None:
+                cache, cost_ms = restore_cache(self.model.config, hit[0]), hit[1]
+                start, image_cached = boundary, has_image
+                break
+        seq["prefix"] = {"prefix_tokens": start, "prefix_saved_ms": round(cost_ms, 2),
+                         "prefix_cache_hit_rate": prefix_cache.hit_rate()} if levels else {}
+
+        if image_cached:
+            # KV của ảnh đã có trong cache nên không cần vision encoder
+            model_inputs, seq["vision"] = {k: v for k, v in inputs.items() if k != "pixel_values"}, {"vision_ms": 0.0}
+        else:
+            model_inputs, seq["vision"] = self._vision_inputs(seq)
+            cost_ms += seq["vision"].get("vision_ms", 0.0)
+        if cache is None:
+            cache = DynamicCache(config=self.model.config)
+
+        for end, has_image, key in [level for level in levels if level[0] > start] + [(length, False, None)]:
+            begin = time.perf_counter()
+            with torch.inference_mode():
+                if start == 0 and end == length:
+                    output = self.model(**model_inputs, past_key_values=cache, use_cache=True)
+                else:
+                    # Đoạn nối tiếp cache có sẵn vẫn phải được coi là prefill (Gemma3 chỉ dựng mask hai chiều cho
+                    # token ảnh khi prefill, và nhận ra prefill qua cache rỗng hoặc use_cache=False); KV vẫn
+                    # được ghi vào cache vì past_key_values được truyền vào
+                    output = self.model(**self._segment(model_inputs, start, end), past_key_values=cache,
+                                        use_cache=start == 0)
+            cost_ms += (time.perf_counter() - begin) * 1000
+            if key is not None:
+                prefix_cache.put(key, cache_snapshot(cache), cost_ms)
+            start = end
+        return cache, output
+
+    def _admit(self, seq):
+        """Prefill một request rồi ghép vào batch đang chạy."""
+        if seq["future"].cancelled():
+            return
+        seq["admitted_at"] = time.perf_counter()
+        inputs = seq["inputs"]
+        try:
+            cache, output = self._prefill(seq)
+            token = int(self._pick(output.logits[:, -1].float(), [seq])[0])
+            extra = self.decode_kwargs(inputs, output)
+            if self.draft_model is not None:
+                seq["draft"] = self._draft_prefill(seq, token)
+        except Exception as e:
+            self._resolve(seq, error=e)
+            return
+        seq["prefill_ms"] = (time.perf_counter() - seq["admitted_at"]) * 1000
+        self._append(seq, token)
+        if self._done(seq, token):
+            self._finish(seq)
+            return
+
+        mask = inputs["attention_mask"].to(self.model.device) if "attention_mask" in inputs else torch.ones_like(inputs["input_ids"])
+        row = {
+            "cache": cache,
+            "mask": mask,
+            "next": torch.tensor([token], device=mask.device),
+            "position": mask.sum(dim=-1),
+            "extra": extra
+        }
+        if not self.active:
+            self.batch = row
+        else:
+            self._merge(row)
+        self.active.append(seq)
+
+    def _merge(self, row):
+        batch = self.batch
+        length = max(batch["mask"].shape[1], row["mask"].shape[1])
+        for target, source in zip(batch["cache"].layers, row["cache"].layers):
+            # Layer sliding window chỉ giữ vài token cuối nên lấy độ dài theo từng layer
+            size = max(target.keys.shape[-2], source.keys.shape[-2])
+            target.keys = torch.cat([left_pad(target.keys, size, 2), left_pad(source.keys, size, 2)])
+            target.values = torch.cat([left_pad(target.values, size, 2), left_pad(source.values, size, 2)])
+            if hasattr(target, "cumulative_length"):
+                target.cumulative_length = length
+        batch["mask"] = torch.cat([left_pad(batch["mask"], length, 1), left_pad(row["mask"], length, 1)])
+        batch["next"] = torch.cat([batch["next"], row["next"]])
+        batch["position"] = torch.cat([batch["position"], row["position"]])
+        batch["extra"] = {k: torch.cat([v, row["extra"][k]]) for k, v in batch["extra"].items()}
+
+    def _retire(self, keep):
+        """Bỏ các sequence đã xong khỏi batch, cắt bớt cột đầu chỉ còn padding."""
+        batch = self.batch
+        index = torch.tensor(keep, device=batch["mask"].device)
+        batch["mask"] = batch["mask"][index]
+        batch["next"] = batch["next"][index]
+        batch["position"] = batch["position"][index]
+        batch["extra"] = {k: v[index] for k, v in batch["extra"].items()}
+        batch["cache"].batch_select_indices(index)
+
+        length = batch["mask"].shape[1] - int(batch["mask"].any(dim=0).int().argmax())
+        batch["mask"] = batch["mask"][:, -length:]
+        for layer in batch["cache"].layers:
+            layer.keys = layer.keys[:, :, -min(length, layer.keys.shape[-2]):]
+            layer.values = layer.values[:, :, -min(length, layer.values.shape[-2]):]
+            if hasattr(layer, "cumulative_length"):
+                layer.cumulative_length = length
+
+    def _draft_prefill(self, seq, token):
+        draft_cache = DynamicCache(config=self.draft_model.config)
+        with torch.inference_mode():
+            self.draft_model(input_ids=self.draft_inputs(self.model, seq["inputs"]).to(self.draft_model.device),
+                             past_key_values=draft_cache, use_cache=True)
+        seq["speculative"] = {"draft_proposed": 0, "draft_accepted": 0, "acceptance_rate": None}
+        # pending: token đã sinh nhưng chưa có trong cache của draft
+        return {"cache": draft_cache, "pending": [token]}
+
+    def _speculate(self):
+        """Speculative decoding cho sequence đang chạy (batch 1).
+
+        Draft đề xuất k token greedy, model chính chạy token hiện tại + k token đó trong một forward.
+        Giữ các token draft trùng với argmax của model chính, rồi thêm argmax của model chính ở vị trí
+        lệch đầu tiên (hoặc sau token draft cuối), nên với greedy kết quả giống decode từng token.
+        """
+        batch, seq = self.batch, self.active[0]
+        draft, k = seq["draft"], self.num_draft_tokens
+        length = batch["mask"].shape[1]
+        device = batch["mask"].device
+        try:
+            with torch.inference_mode():
+                draft_before = cache_layers(draft["cache"])
+                proposals = []
+                feed = draft["pending"]
+                for _ in range(k):
+                    logits = self.draft_model(input_ids=torch.tensor([feed], device=self.draft_model.device),
+                                              past_key_values=draft["cache"], use_cache=True).logits
+                    proposals.append(int(self._pick(logits[:, -1].float(), [seq])[0]))
+                    feed = proposals[-1:]
+
+                before = cache_layers(batch["cache"])
+                output = self.model(
+                    input_ids=torch.tensor([[int(batch["next"][0])] + proposals], device=device),
+                    attention_mask=torch.cat([batch["mask"], batch["mask"].new_ones((1, k + 1))], dim=1),
+                    position_ids=(batch["position"] + torch.arange(k + 1, device=device))[None],
+                    cache_position=torch.arange(length, length + k + 1, device=device),
+                    past_key_values=batch["cache"],
+                    use_cache=True
+                )
+                verified = self._pick(output.logits[0].float(), [seq] * (k + 1)).tolist()
+        except Exception as e:
+            self._resolve(seq, error=e)
+            self.active = []
+            return
+
+        accepted = 0
+        while accepted < k and proposals[accepted] == verified[accepted]:
+            accepted += 1
+        new_tokens = proposals[:accepted] + [verified[accepted]]
+        # Bỏ KV của các token draft bị từ chối ở cả hai model
+        rollback_cache(batch["cache"], before, accepted + 1)
+        rollback_cache(draft["cache"], draft_before, len(draft["pending"]) + min(accepted, k - 1))
+        draft["pending"] = proposals[k - 1:] + new_tokens[-1:] if accepted == k else new_tokens[-1:]
+        batch["mask"] = batch["mask"].new_ones((1, length + accepted + 1))
+        batch["position"] = batch["position"] + accepted + 1
+        batch["next"] = torch.tensor(new_tokens[-1:], device=device)
+
+        stats = seq["speculative"]
+        stats["draft_proposed"] += k
+        stats["draft_accepted"] += accepted
+        stats["acceptance_rate"] = round(stats["draft_accepted"] / stats["draft_proposed"], 4)
+        for token in new_tokens:
+            self._append(seq, token)
+            if self._done(seq, token):
+                self._finish(seq)
+                self.active = []
+                return
+
+    def _step(self):
+        """Decode một token cho cả batch."""
+        if self.draft_model is not None:
+            self._speculate()
+            return
+        batch = self.batch
+        length = batch["mask"].shape[1]
+        batch["mask"] = torch.cat([batch["mask"], batch["mask"].new_ones((batch["mask"].shape[0], 1))], dim=1)
+        try:
+            with torch.inference_mode():
+                output = self.model(
+                    input_ids=batch["next"][:, None],
+                    attention_mask=batch["mask"],
+                    position_ids=batch["position"][:, None],
+                    cache_position=torch.tensor([length], device=batch["mask"].device),
+                    past_key_values=batch["cache"],
+                    use_cache=True,
+                    **batch["extra"]
+                )
+            tokens = self._pick(output.logits[:, -1].float(), self.active)
+        except Exception as e:
+            for seq in self.active:
+                self._resolve(seq, error=e)
+            self.active = []
+            return
+        batch["next"] = tokens
+        batch["position"] = batch["position"] + 1
+
+        keep = []
+        for row, (seq, token) in enumerate(zip(self.active, tokens.tolist())):
+            self._append(seq, token)
+            seq["max_batch"] = max(seq["max_batch"], len(self.active))
+            if self._done(seq, token):
+                self._finish(seq)
+            else:
+                keep.append(row)
+        if len(keep) < len(self.active):
+            self.active = [self.active[row] for row in keep]
+            if self.active:
+                self._retire(keep)
+            else:
+                self.batch = None
+
+
+schedulers = {}
+
+# =========================
+# 1️⃣ MedGemma
+# =========================
+def medgemma_inputs(processor, model, image, prompt):
+    content = [
+        {"type": "text", "text": prompt},
+        {"type": "image", "image": image}
+    ]
+    # Bật prefix_cache: ảnh đứng trước câu hỏi để system prompt + ảnh là prefix chung của mọi câu hỏi về ảnh này.
+    # Thứ tự này đổi prompt (và câu trả lời) so với bản gốc, nên tắt cache (PREFIX_CACHE_MB=0) thì giữ thứ tự gốc
+    if prefix_cache.max_bytes > 0:
+        content.reverse()
     messages = [
         {
             "role": "system",
@@ -48,35 +737,70 @@ def medgemma_api():
         },
         {
             "role": "user",
-            "content": [
-                {"type": "text", "text": prompt},
-                {"type": "image", "image": image}
-            ]
+            "content": content
         }
     ]
 
-    output = medgemma_pipe(
-        text=messages,
-        max_new_tokens=300
+    return processor.apply_chat_template(
+        messages, add_generation_prompt=True, tokenize=True,
+        return_dict=True, return_tensors="pt"
+    ).to(model.device, dtype=model.dtype)
+
+
+if "medgemma" in VQA_MODELS:
+    medgemma_processor = AutoProcessor.from_pretrained("google/medgemma-4b-it")
+    medgemma_model = AutoModelForImageTextToText.from_pretrained(
+        "google/medgemma-4b-it",
+        dtype=torch.bfloat16 if device == "cuda" else torch.float32,
+        device_map=device
     )
+    medgemma_draft = None
+    if SPEC_DRAFT_MODEL:
+        medgemma_draft = AutoModelForCausalLM.from_pretrained(SPEC_DRAFT_MODEL, dtype=medgemma_model.dtype,
+                                                              device_map=device).eval()
+    schedulers["medgemma"] = GenerationScheduler("medgemma", medgemma_model, medgemma_model.generation_config.eos_token_id,
+                                                 encode_image=gemma3_encode_image, image_inputs=gemma3_image_inputs,
+                                                 prefix_boundaries=gemma3_prefix_boundaries,
+                                                 draft_model=medgemma_draft, draft_inputs=gemma3_draft_inputs)
 
-    result = output[0]["generated_text"][-1]["content"]
-    return jsonify({"result": result})
+@app.route("/medgemma", methods=["POST"])
+def medgemma_api():
+    if "medgemma" not in schedulers:
+        return jsonify({"error": "medgemma chưa được load (VQA_MODELS)"}), 404
+    image, image_hash, data, stream = read_vqa_request()
+    if image is None:
+        return jsonify({"error": "Thiếu ảnh"}), 400
+    inputs = medgemma_inputs(medgemma_processor, medgemma_model, image, data.get("question", "Describe this X-ray"))
+    return answer(schedulers["medgemma"], inputs, stream,
+                  lambda tokens: medgemma_processor.decode(tokens, skip_special_tokens=True),
+                  max_new_tokens=300, image_key=image_hash)
 
 # =========================
 # 2️⃣ IDEFICS Medical VQA
 # =========================
-idefics_processor = AutoProcessor.from_pretrained("HuggingFaceM4/idefics-9b")
-idefics_model = AutoModelForImageTextToText.from_pretrained(
-    "Shashwath01/Idefic_medical_VQA_merged_4bit",
-    device_map=device
-)
+def idefics_decode_kwargs(inputs, output):
+    # Giống IdeficsForVisionText2Text khi generate: các bước sau dùng lại ảnh đã encode + mask của token cuối
+    key = "perceiver_embeddings" if idefics_model.config.use_resampler else "image_encoder_embeddings"
+    return {key: output.image_hidden_states, "image_attention_mask": inputs["image_attention_mask"][:, -1:]}
+
+
+if "idefics" in VQA_MODELS:
+    idefics_processor = AutoProcessor.from_pretrained("HuggingFaceM4/idefics-9b")
+    idefics_model = AutoModelForImageTextToText.from_pretrained(
+        "Shashwath01/Idefic_medical_VQA_merged_4bit",
+        device_map=device
+    )
+    schedulers["idefics"] = GenerationScheduler("idefics", idefics_model, idefics_processor.tokenizer.eos_token_id,
+                                                decode_kwargs=idefics_decode_kwargs,
+                                                encode_image=idefics_encode_image, image_inputs=idefics_image_inputs)
 
 @app.route("/idefics", methods=["POST"])
 def idefics_api():
-    data = request.get_json()
-
-    image = image_from_base64(data["image_base64"])
+    if "idefics" not in schedulers:
+        return jsonify({"error": "idefics chưa được load (VQA_MODELS)"}), 404
+    image, image_hash, data, stream = read_vqa_request()
+    if image is None or not data.get("question"):
+        return jsonify({"error": "Thiếu ảnh hoặc câu hỏi"}), 400
     question = data["question"]
 
     tokenizer = idefics_processor.tokenizer
@@ -91,30 +815,27 @@ def idefics_api():
         return_tensors="pt"
     ).to(device)
 
-    generated_ids = idefics_model.generate(
-        **inputs,
+    # Stream chỉ gửi phần sinh thêm; câu trả lời cuối vẫn kèm prompt giống output cũ của generate
+    prompt_ids = inputs["input_ids"][0].tolist()
+    return answer(
+        schedulers["idefics"], inputs, stream,
+        lambda tokens: idefics_processor.decode(tokens, skip_special_tokens=True),
+        lambda tokens: idefics_processor.batch_decode([prompt_ids + tokens], skip_special_tokens=True)[0],
         max_new_tokens=200,
-        bad_words_ids=bad_words_ids,
-        eos_token_id=tokenizer.eos_token_id,
-        pad_token_id=tokenizer.pad_token_id
+        suppress_ids=[ids[0] for ids in bad_words_ids if len(ids) == 1],
+        image_key=image_hash
     )
 
-    answer = idefics_processor.batch_decode(
-        generated_ids,
-        skip_special_tokens=True
-    )[0]
-
-    return jsonify({"result": answer})
-
 # =========================
 # Health check
 # =========================
 @app.route("/health", methods=["GET"])
 def health():
-    return jsonify({"status": "ok"})
+    return jsonify({"status": "ok", "generate": {name: s.depth() for name, s in schedulers.items()},
+                    "feature_cache": feature_cache.snapshot(), "prefix_cache": prefix_cache.snapshot()})
 
 # =========================
 # Run
 # =========================
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000)
\ No newline at end of file
+    app.run(host="0.0.0.0", port=5000, threaded=True)
@@ -1,7 +1,9 @@
-from flask import g, Flask, render_template, render_template_string, request, jsonify, redirect, url_for, flash, session
+from flask import g, Flask, render_template, render_template_string, request, jsonify, redirect, url_for, flash, session, Response, stream_with_context
 import sqlite3, os, secrets, requests
 from datetime import datetime
 from celery import Celery
+import redis
+import time
 import uuid
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
@@ -10,6 +12,11 @@ from flask_talisman import Talisman
 from flask_bcrypt import Bcrypt
 from flasgger import Swagger
 import yaml
+import base64
+import json
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 
 app = Flask(__name__)
 app.secret_key = "inseclab"
@@ -40,20 +47,48 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'nrrd', 'hdr', 'img', 'nii', 'gz', '
 # server host
 WEB_SERVER_HOST = 'http://10.102.196.113'
 AI_SERVER_HOST = 'http://10.102.196.113:8080'
+# ai-server trả 429/503 + Retry-After khi hàng đợi inference đầy → task Celery thử lại sau
+AI_SERVER_MAX_RETRIES = 10
+# Upload một lần: ai-server /prepare convert + kiểm tra ảnh y tế, ảnh đã decode được giữ theo token.
+# /upload chờ /prepare đồng bộ (Flask: giữ một web worker trong lúc chờ) để trả lời ngay ảnh có phải ảnh y tế;
+# timeout chỉ đủ cho decode + gate (GATE_TIMEOUT_S=10 bên ai-server), quá hạn thì trả lỗi thay vì giữ worker lâu hơn
+AI_SERVER_PREPARE_TIMEOUT = 15
+PENDING_UPLOADS_MAX = 5
 IMG_SERVER_HOST = 'http://10.102.196.113:8000'
 EXPLAIN_SERVER_HOST = "http://10.102.196.101:8000/explain"
+# Heatmap chỉ được tạo khi có người mở chi tiết chẩn đoán, hoặc prefetch lúc ai-server rảnh:
+# celery beat gọi prefetch mỗi EXPLAIN_PREFETCH_INTERVAL_S giây, mỗi lượt tạo tối đa EXPLAIN_PREFETCH_BATCH chẩn đoán
+# khi hàng đợi của ai-server (/queue/stats) không quá EXPLAIN_PREFETCH_MAX_PENDING ảnh.
+# ai-server tính heatmap trong cùng lượt forward; model nào ai-server không giải thích được thì mới gọi EXPLAIN_SERVER_HOST
+EXPLAIN_PREFETCH_INTERVAL_S = 60
+EXPLAIN_PREFETCH_BATCH = 2
+EXPLAIN_PREFETCH_MAX_PENDING = 0
+# Heatmap đã xếp hàng quá EXPLAIN_QUEUED_TIMEOUT_S giây mà chưa xong (worker chết giữa chừng...) được xếp hàng lại
+EXPLAIN_QUEUED_TIMEOUT_S = 900
+# Các model cần EXPLAIN_SERVER_HOST được gửi song song qua một session giữ kết nối keep-alive;
+# timeout (connect, read) giây để một model treo không giữ worker Celery mãi
+EXPLAIN_MAX_WORKERS = 8
+EXPLAIN_TIMEOUT = (5, 60)
+REDIS_URL = 'redis://localhost:6379/0'
+# Vision QA stream: task Celery đọc token từ ai-server (SSE) rồi ghi vào Redis stream vqa_stream:<task_id>,
+# /vqaStream/<task_id> chuyển tiếp cho trình duyệt. Stream được đọc lại từ đầu (hoặc từ Last-Event-ID)
+# nên trang mở muộn hay kết nối lại đều không mất token; key hết hạn sau VQA_STREAM_TTL_S giây
+VQA_STREAM_TTL_S = 600
+VQA_STREAM_TIMEOUT_S = 600
+VQA_STREAM_BLOCK_MS = 15000
 
 # Rate limiter
 limiter = Limiter(key_func=get_remote_address, app=app, default_limits=["100 per hour"])
 
 # Cấu hình Celery dùng Redis làm broker
-app.config['CELERY_BROKER_URL'] = 'redis://localhost:6379/0'   # broker
-app.config['CELERY_RESULT_BACKEND'] = 'redis://localhost:6379/0'  # lưu kết quả
+app.config['CELERY_BROKER_URL'] = REDIS_URL   # broker
+app.config['CELERY_RESULT_BACKEND'] = REDIS_URL  # lưu kết quả
 
 celery = Celery(app.name,
                 broker=app.config['CELERY_BROKER_URL'],
                 backend=app.config['CELERY_RESULT_BACKEND'])
 celery.conf.update(app.config)
+stream_redis = redis.Redis.from_url(REDIS_URL, decode_responses=True)
 
 # Folders
 PROFILE_PIC_FOLDER = 'static/profile_pics'
@@ -67,6 +102,47 @@ DB_FILE = 'insecmed.db'
 def allowed_ext(filename):
     return '.' in filename and filename.rsplit('.',1)[1].lower() in ALLOWED_EXTENSIONS
 
+# --- DICOM/volume: gửi thẳng file gốc cho ai-server, ảnh xem trước do ai-server trả về khi /prepare ---
+PREVIEW_EXTENSIONS = (".dcm", ".nii", ".nii.gz", ".nrrd", ".hdr", ".img")
+
+# Volume được chẩn đoán trên slice giữa mà ai-server render lúc /prepare, chính là ảnh xem trước
+VOLUME_EXTENSIONS = (".nii", ".nii.gz", ".nrrd", ".hdr", ".img")
+
+def display_filename(filename):
+    # Trình duyệt không hiển thị được DICOM/volume → lịch sử dùng ảnh xem trước
+    return filename + ".jpg" if filename.lower().endswith(PREVIEW_EXTENSIONS) else filename
+
+def ai_server_upload(filename):
+    # File gửi lại cho ai-server /diagnose khi không dùng token: DICOM 2D gửi file gốc (ai-server tự window/level),
+    # volume gửi ảnh xem trước để ra cùng một ảnh 2D như lúc /prepare
+    return display_filename(filename) if filename.lower().endswith(VOLUME_EXTENSIONS) else filename
+
+def prepare_upload(filename):
+    """Gửi file gốc cho ai-server đúng một lần: decode + gate ngay trong ai-server, trả về (status, payload có token)."""
+    path = os.path.join(UPLOAD_FOLDER, filename)
+    with open(path, 'rb') as f:
+        resp = requests.post(f"{AI_SERVER_HOST}/prepare", files={'file': (filename, f)}, timeout=AI_SERVER_PREPARE_TIMEOUT)
+    try:
+        data = resp.json()
+    except ValueError:
+        data = {"error": resp.text}
+    if resp.ok and data.get("preview"):
+        with open(path + ".jpg", "wb") as out:
+            out.write(base64.b64decode(data.pop("preview")))
+    return resp.status_code, data
+
+def remember_upload(token, **info):
+    # Session cookie: chỉ giữ vài upload đang chờ xác nhận gần nhất
+    pending = dict(session.get('pending_uploads', {}))
+    pending[token] = info
+    session['pending_uploads'] = dict(list(pending.items())[-PENDING_UPLOADS_MAX:])
+
+def take_upload(token):
+    pending = dict(session.get('pending_uploads', {}))
+    info = pending.pop(token, None) if token else None
+    session['pending_uploads'] = pending
+    return info
+
 def init_db():
     conn = sqlite3.connect(DB_FILE)
     c = conn.cursor()
@@ -171,86 +247,409 @@ def load_notifications():
         n["user_id"] = users_map.get(creator_id)
     g.notifications = notifications
 
+# --- Heatmap lười ---
+# Cột explain_image_filename giữ tên file heatmap của từng model (cách nhau bởi dấu phẩy) kèm trạng thái:
+# "pending:<file>" chưa tạo, "queued:<unix time>:<file>" đã xếp hàng tạo, "failed:<file>" tạo thất bại (chỉ thử lại
+# khi có người mở lại chẩn đoán, không thử lại theo từng lần poll/prefetch), "<file>" đã có ảnh, rỗng = model không có heatmap.
+# Heatmap lưu saliency thô (<file>.json: PNG xám 8-bit + box, vài trăm byte) để trình duyệt tự tô lên ảnh gốc;
+# heatmap ảnh PNG/JPEG cũ được tạo lại thành .json khi có người mở chẩn đoán (nếu còn file gốc)
+EXPLAIN_PENDING = "pending:"
+EXPLAIN_QUEUED = "queued:"
+EXPLAIN_FAILED = "failed:"
+SALIENCY_SUFFIX = ".json"
+# Heatmap ảnh lấy từ EXPLAIN_SERVER_HOST (model ai-server không tự giải thích được) → không chuyển đổi lại
+REMOTE_HEATMAP_SUFFIX = ".remote.png"
+
+def pending_explain_filenames(filename, count):
+    return "".join(f"{EXPLAIN_PENDING}explain_{idx}_{display_filename(filename)}{SALIENCY_SUFFIX}," for idx in range(count))
+
+def saliency_filename(filename):
+    return filename if filename.endswith(SALIENCY_SUFFIX) else filename + SALIENCY_SUFFIX
+
+def explain_entries(value):
+    """Tách cột explain_image_filename thành [{"filename", "status"}] theo thứ tự model."""
+    items = (value or "").split(",")
+    if items[-1] == "":
+        items.pop()
+    entries = []
+    for item in items:
+        if not item:
+            entries.append({"filename": None, "status": "none"})
+        elif item.startswith(EXPLAIN_PENDING):
+            entries.append({"filename": item[len(EXPLAIN_PENDING):], "status": "pending"})
+        elif item.startswith(EXPLAIN_QUEUED):
+            queued_at, _, filename = item[len(EXPLAIN_QUEUED):].partition(":")
+            if not queued_at.isdigit():
+                # Bản ghi cũ "queued:<file>" chưa có thời điểm xếp hàng → coi như đã quá hạn
+                queued_at, filename = "0", item[len(EXPLAIN_QUEUED):]
+            entries.append({"filename": filename, "status": "queued", "queued_at": int(queued_at)})
+        elif item.startswith(EXPLAIN_FAILED):
+            entries.append({"filename": item[len(EXPLAIN_FAILED):], "status": "failed"})
+        elif os.path.exists(os.path.join(UPLOAD_FOLDER, item)):
+            entries.append({"filename": item, "status": "ready"})
+        else:
+            # Bản ghi cũ lưu sẵn tên file dù heatmap có thể chưa từng được ghi → tạo khi mở
+            entries.append({"filename": saliency_filename(item), "status": "pending"})
+    return entries
+
+def join_explain_entries(entries):
+    prefix = {"pending": EXPLAIN_PENDING, "failed": EXPLAIN_FAILED, "ready": ""}
+    def item(e):
+        if e["status"] == "queued":
+            return f"{EXPLAIN_QUEUED}{e['queued_at']}:{e['filename']}"
+        return prefix[e["status"]] + e["filename"]
+    return "".join((item(e) if e["filename"] else "") + "," for e in entries)
+
+def explain_status(entries):
+    statuses = {e["status"] for e in entries}
+    for status in ("pending", "queued", "failed"):
+        if status in statuses:
+            return status
+    return "ready"
+
+def update_explain_entries(diag_id, old_value, entries):
+    # Compare-and-set: chỉ ghi khi cột chưa bị request/worker khác đổi → mỗi heatmap chỉ được xếp hàng một lần
+    conn = get_db_conn()
+    cur = conn.execute("UPDATE diagnoses SET explain_image_filename = ? WHERE id = ? AND explain_image_filename IS ?",
+                       (join_explain_entries(entries), diag_id, old_value))
+    conn.commit()
+    conn.close()
+    return cur.rowcount == 1
+
+def claim_explanations(diag_id, value, image_filename=None, retry_failed=False):
+    """Chuyển các heatmap pending (và queued đã quá hạn) sang queued; trả về entries mới, hoặc None nếu không có gì để tạo.
+
+    Có image_filename (người dùng đang xem) thì heatmap ảnh cũ cũng được xếp hàng chuyển sang saliency.
+    retry_failed: heatmap failed cũng được thử lại (người dùng vừa mở chẩn đoán, không phải poll).
+    """
+    entries = explain_entries(value)
+    now = int(time.time())
+    migrate = bool(image_filename) and os.path.exists(os.path.join(UPLOAD_FOLDER, upload_source(image_filename)))
+    claimed = []
+    for e in entries:
+        legacy = migrate and e["status"] == "ready" and not e["filename"].endswith((SALIENCY_SUFFIX, REMOTE_HEATMAP_SUFFIX))
+        stale = e["status"] == "queued" and now - e["queued_at"] > EXPLAIN_QUEUED_TIMEOUT_S
+        retry = e["status"] == "pending" or stale or legacy or (retry_failed and e["status"] == "failed")
+        claimed.append({"filename": saliency_filename(e["filename"]), "status": "queued", "queued_at": now} if retry else e)
+    if claimed == entries:
+        return None
+    return claimed if update_explain_entries(diag_id, value, claimed) else None
+
+def modify_explain_entries(diag_id, change):
+    """Đọc cột heatmap, áp change(entries) rồi compare-and-set; sub-task của các model ghi song song nên thử lại khi bị chen."""
+    while True:
+        conn = get_db_conn()
+        row = conn.execute("SELECT explain_image_filename FROM diagnoses WHERE id = ?", (diag_id,)).fetchone()
+        conn.close()
+        if not row:
+            return
+        if update_explain_entries(diag_id, row[0], change(explain_entries(row[0]))):
+            return
+
+def set_explain_slots(diag_id, updates):
+    # Gắn heatmap của từng model ngay khi xong, không chờ các model khác
+    modify_explain_entries(diag_id, lambda entries: [updates.get(idx, e) for idx, e in enumerate(entries)])
+
+def release_explanations(diag_id, indices=None, status="pending"):
+    # ai-server bận (prefetch nhường chỗ) → trả về pending để lượt sau tạo tiếp;
+    # tạo thất bại → failed, chỉ thử lại khi có người mở lại chẩn đoán
+    modify_explain_entries(diag_id, lambda entries: [
+        {"filename": e["filename"], "status": status} if e["status"] == "queued" and (indices is None or idx in indices) else e
+        for idx, e in enumerate(entries)
+    ])
+
+def fail_explanations(diag_id, indices=None):
+    release_explanations(diag_id, indices, status="failed")
+
+def request_explanations(diag_id, value, image_filename=None, retry_failed=False):
+    """Gọi khi có người xem chẩn đoán: xếp hàng tạo heatmap còn thiếu; trả về entries hiện tại.
+
+    retry_failed=True khi người dùng mở chẩn đoán/bấm xem heatmap; các lần poll sau đó để False.
+    """
+    claimed = claim_explanations(diag_id, value, image_filename, retry_failed)
+    if claimed is None:
+        return explain_entries(value)
+    # Mỗi model một sub-task: heatmap nào xong trước được gắn vào chẩn đoán trước
+    previous = explain_entries(value)
+    for idx, e in enumerate(claimed):
+        if e["status"] == "queued" and e != previous[idx]:
+            explain_diagnosis.apply_async(args=[diag_id, idx])
+    return claimed
+
+def upload_source(image_filename):
+    # Lịch sử lưu ảnh xem trước (.dcm.jpg...) → file gốc để gửi lại cho ai-server
+    source = image_filename[:-len(".jpg")]
+    return source if image_filename.endswith(".jpg") and source.lower().endswith(PREVIEW_EXTENSIONS) else image_filename
+
+explain_session = requests.Session()
+explain_session.mount("http://", HTTPAdapter(pool_connections=2, pool_maxsize=EXPLAIN_MAX_WORKERS))
+explain_session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=EXPLAIN_MAX_WORKERS))
+
+def remote_explanation(model, upload_name, image_bytes, prediction):
+    """Heatmap từ EXPLAIN_SERVER_HOST cho model mà ai-server không tự giải thích được; lỗi/timeout → None."""
+    explain_model_name = ""
+
+    if 'skin' in model:
+        explain_model_name = "Anwarkh1/Skin_Cancer-Image_Classification"
+
+    elif 'breast' in model:
+        explain_model_name = "Falah/vit-base-breast-cancer"
+
+    elif 'brain' in model:
+        explain_model_name = "DunnBC22/vit-base-patch16-224-in21k_brain_tumor_diagnosis"
+
+    elif 'pneu' in model:
+        explain_model_name = "xyuan/vit-xray-pneumonia-classification"
+
+    else:
+        explain_model_name = "DunnBC22/vit-base-patch16-224-in21k_covid_19_ct_scans"
+
+    # Gửi bytes đã đọc sẵn: mỗi request có body riêng, không dùng chung một file handle
+    files = {
+        "model_kind": (None, explain_model_name),
+        "prediction": (None, prediction),
+        "image": (upload_name, image_bytes, mimetypes.guess_type(upload_name)[0] or "image/png")
+    }
+    try:
+        response = explain_session.post(EXPLAIN_SERVER_HOST, files=files, timeout=EXPLAIN_TIMEOUT)
+    except requests.RequestException:
+        return None
+    return response.content if response.ok and response.content else None
+
+def remove_legacy_heatmap(saliency):
+    # Heatmap ảnh cũ cùng tên (bỏ đuôi .json) không còn dùng sau khi đã có saliency
+    legacy = os.path.join(UPLOAD_FOLDER, saliency[:-len(SALIENCY_SUFFIX)])
+    if os.path.exists(legacy):
+        os.remove(legacy)
+
+def generate_explanations(diag_id, indices=None):
+    """Chẩn đoán lại với explain=saliency (ai-server tính heatmap trong cùng lượt forward) và ghi các heatmap đang queued.
+
+    indices giới hạn các model cần tạo (mặc định: mọi model đang queued). Trả về response của ai-server
+    (429/503 thì heatmap vẫn queued để caller quyết định thử lại hay trả về pending).
+    """
+    conn = get_db_conn()
+    row = conn.execute("SELECT model, image_filename, explain_image_filename FROM diagnoses WHERE id = ?", (diag_id,)).fetchone()
+    conn.close()
+    entries = explain_entries(row[2]) if row else []
+    todo = [idx for idx, e in enumerate(entries) if e["status"] == "queued" and (indices is None or idx in indices)]
+    if not todo:
+        return None
+    models = row[0].split(',')
+    # ai-server trả kết quả theo đúng thứ tự model gửi lên
+    data = {'model': ",".join(models[idx] for idx in todo), 'explain': 'saliency'}
+
+    path = os.path.join(UPLOAD_FOLDER, ai_server_upload(upload_source(row[1])))
+    try:
+        with open(path, 'rb') as f:
+            resp = explain_session.post(f"{AI_SERVER_HOST}/diagnose", data=data, files={'file': f}, timeout=EXPLAIN_TIMEOUT)
+        if resp.status_code in (429, 503):
+            return resp
+        if resp.status_code != 200:
+            fail_explanations(diag_id, todo)
+            return resp
+
+        results = dict(zip(todo, resp.json()['results']))
+        updates, fallback = {}, []
+        for idx in todo:
+            explanation = (results[idx].get('explanation') if idx in results else None) or {}
+            saliency = entries[idx]["filename"]
+            if explanation.get('map'):
+                with open(os.path.join(UPLOAD_FOLDER, saliency), "w") as f:
+                    json.dump({k: explanation[k] for k in ('method', 'shape', 'box', 'map')}, f)
+                remove_legacy_heatmap(saliency)
+                updates[idx] = dict(entries[idx], status="ready")
+            else:
+                fallback.append(idx)
+        set_explain_slots(diag_id, updates)
+
+        if fallback:
+            # Explain server chỉ trả ảnh đã tô → lưu dạng ảnh như cũ. Các model gửi cùng lúc,
+            # latency ≈ một lần explain thay vì tổng của N model; ảnh nào xong trước ghi trước.
+            # Explain server không đọc được DICOM/volume → gửi ảnh đang hiển thị (ảnh xem trước do ai-server render)
+            with open(os.path.join(UPLOAD_FOLDER, row[1]), 'rb') as f:
+                image_bytes = f.read()
+            with ThreadPoolExecutor(max_workers=min(EXPLAIN_MAX_WORKERS, len(fallback))) as pool:
+                futures = {
+                    pool.submit(remote_explanation, models[idx], row[1], image_bytes,
+                                results[idx]['top_label_origin'] if idx in results else ""): idx
+                    for idx in fallback
+                }
+                for future in as_completed(futures):
+                    idx = futures[future]
+                    content = future.result()
+                    if content:
+                        remote = entries[idx]["filename"][:-len(SALIENCY_SUFFIX)] + REMOTE_HEATMAP_SUFFIX
+                        with open(os.path.join(UPLOAD_FOLDER, remote), "wb") as f:
+                            f.write(content)
+                        set_explain_slots(diag_id, {idx: {"filename": remote, "status": "ready"}})
+                    else:
+                        set_explain_slots(diag_id, {idx: {"filename": None, "status": "none"}})
+    except (OSError, requests.RequestException):
+        fail_explanations(diag_id, todo)
+        raise
+    return resp
+
+def ai_server_idle():
+    try:
+        stats = requests.get(f"{AI_SERVER_HOST}/queue/stats", timeout=5).json()
+    except (requests.RequestException, ValueError):
+        return False
+    waiting = stats.get("diagnose", {}).get("pending", 0) + sum(stats.get("batch", {}).values())
+    return waiting <= EXPLAIN_PREFETCH_MAX_PENDING
+
+def ai_server_error(resp):
+    # Thông báo lỗi của ai-server ({"error": ...}) để task thất bại với lý do rõ ràng
+    try:
+        return f"ai-server {resp.status_code}: {resp.json().get('error', resp.text)}"
+    except ValueError:
+        return f"ai-server {resp.status_code}: {resp.text[:200]}"
+
+def prediction_label(result):
+    # Stage cascade bị bỏ qua: nhãn chỉ được suy ra từ model rẻ, ghi rõ để không bị đọc như dự đoán thật
+    if result.get('skipped'):
+        return f"{result['top_label']} (suy ra từ {result['inferred_from']})"
+    return result['top_label']
+
 # -----------------Celery ----------------
 @celery.task(bind=True, queue='pipeline_a')
-def call_diagnosis_from_ai_server(self, filename, patient_id, model_name, user_id):
-    input_file = open(os.path.join(UPLOAD_FOLDER, filename), 'rb')
+def call_diagnosis_from_ai_server(self, filename, patient_id, model_name, user_id, token=None):
+    # Trạng thái từng bước cho /diagnoseStatus thay vì "queued" tới khi xong
+    self.update_state(state='PROGRESS', meta={'stage': 'classifying'})
     # Gọi API server để inference
-    files = {'file': input_file}
     data = {'model': model_name}
-    resp = requests.post(f"{AI_SERVER_HOST}/diagnose", data=data, files=files)
+    # Ảnh đã được ai-server decode lúc /prepare → chỉ gửi token; token hết hạn (410) thì upload lại
+    # đúng ảnh mà /prepare đã dùng (volume: ảnh xem trước) để kết quả có cùng dạng 2D
+    resp = requests.post(f"{AI_SERVER_HOST}/diagnose", data={**data, 'token': token}) if token else None
+    if resp is None or resp.status_code == 410:
+        with open(os.path.join(UPLOAD_FOLDER, ai_server_upload(filename)), 'rb') as input_file:
+            resp = requests.post(f"{AI_SERVER_HOST}/diagnose", data=data, files={'file': input_file})
+    if resp.status_code in (429, 503):
+        raise self.retry(countdown=int(resp.headers.get("Retry-After", "5")), max_retries=AI_SERVER_MAX_RETRIES)
+    if resp.status_code != 200:
+        raise RuntimeError(ai_server_error(resp))
     results = resp.json()
 
     labels = ""
     for i in range(len(model_name.split(','))):
-        labels += results['results'][i]['top_label'] + "/"
-
-    explain_filenames = ""
-
-    for idx, m in enumerate(model_name.split(',')):
-        # Explain Multipart form-data
-        explain_model_name = ""
-
-        if 'skin' in m:
-            explain_model_name = "Anwarkh1/Skin_Cancer-Image_Classification"
-
-        elif 'breast' in m:
-            explain_model_name = "Falah/vit-base-breast-cancer"
-
-        elif 'brain' in m:
-            explain_model_name = "DunnBC22/vit-base-patch16-224-in21k_brain_tumor_diagnosis"
+        labels += prediction_label(results['results'][i]) + "/"
+    # Xác suất lưu kèm lấy từ model thật sự đã chạy đầu tiên, không lấy từ kết quả suy ra của cascade
+    probability = next((r['top_score'] for r in results['results'] if not r.get('skipped')), results['results'][0]['top_score'])
 
-        elif 'pneu' in m:
-            explain_model_name = "xyuan/vit-xray-pneumonia-classification"
-
-        else:
-            explain_model_name = "DunnBC22/vit-base-patch16-224-in21k_covid_19_ct_scans"
-
-        files = {
-            "model_kind": (None, explain_model_name),
-            "prediction": (None, "Value"),
-            "image": (filename, input_file, "image/png")
-        }
-
-        explain_filenames += "explain_"+str(idx)+"_"+filename + ","
-
-        response = requests.post(EXPLAIN_SERVER_HOST, files=files)
-        if response.content:
-            with open(os.path.join(UPLOAD_FOLDER, "explain_"+str(idx)+"_"+filename), "wb") as f:
-                f.write(response.content)
+    # Kết quả phân loại trả về ngay; heatmap chưa tạo ở đây (phần lớn chẩn đoán không bao giờ được mở lại),
+    # khi được xem thì mỗi model là một sub-task explain_diagnosis gắn dần vào chẩn đoán qua /diagnosis_explain
+    explain_filenames = pending_explain_filenames(filename, len(model_name.split(',')))
 
     # Lưu vào database
     conn = get_db_conn()
     cur = conn.execute(
         "INSERT INTO diagnoses (user_id, patient_id, model, image_filename, explain_image_filename, prediction, probability, timestamp) VALUES (?,?,?,?,?,?,?,?)",
-        (user_id, patient_id, model_name, filename, explain_filenames, labels, results['results'][0]['top_score'], datetime.now())
+        (user_id, patient_id, model_name, display_filename(filename), explain_filenames, labels, probability, datetime.now())
     )
     diag_id = cur.lastrowid
     results["diagnosis_id"] = diag_id
     results["explain_image_filenames"] = explain_filenames
+    results["explain_status"] = "pending"
     conn.commit()
     conn.close()
 
     return results
 
+@celery.task(bind=True, queue='pipeline_a')
+def explain_diagnosis(self, diag_id, idx=None):
+    # Sub-task heatmap của một model; có người đang chờ xem → chạy cùng queue với chẩn đoán
+    indices = None if idx is None else [idx]
+    resp = generate_explanations(diag_id, indices)
+    if resp is not None and resp.status_code in (429, 503):
+        if self.request.retries >= AI_SERVER_MAX_RETRIES:
+            fail_explanations(diag_id, indices)
+            return
+        raise self.retry(countdown=int(resp.headers.get("Retry-After", "5")), max_retries=AI_SERVER_MAX_RETRIES)
+
+@celery.task(queue='pipeline_explain')
+def prefetch_explanations():
+    """Chạy theo lịch celery beat: tạo trước heatmap cho các chẩn đoán mới nhất khi ai-server rảnh."""
+    if not ai_server_idle():
+        return 0
+    conn = get_db_conn()
+    rows = conn.execute("SELECT id, explain_image_filename FROM diagnoses WHERE explain_image_filename LIKE ? ORDER BY id DESC LIMIT ?",
+                        (f"%{EXPLAIN_PENDING}%", EXPLAIN_PREFETCH_BATCH)).fetchall()
+    conn.close()
+    generated = 0
+    for diag_id, value in rows:
+        if claim_explanations(diag_id, value) is None:
+            continue
+        try:
+            resp = generate_explanations(diag_id)
+        except (OSError, requests.RequestException) as e:
+            # Heatmap của chẩn đoán này đã chuyển sang failed → lượt sau không chọn lại, làm tiếp chẩn đoán khác
+            app.logger.warning("prefetch heatmap %s thất bại: %s", diag_id, e)
+            continue
+        if resp is not None and resp.status_code in (429, 503):
+            # ai-server bận trở lại → trả về pending, nhường cho request của người dùng
+            release_explanations(diag_id)
+            break
+        if resp is not None and resp.status_code != 200:
+            # Lỗi khác: generate_explanations đã đánh dấu failed, chuyển sang chẩn đoán tiếp theo
+            continue
+        generated += 1
+    return generated
+
+celery.conf.beat_schedule = {
+    "prefetch-explanations": {"task": prefetch_explanations.name, "schedule": EXPLAIN_PREFETCH_INTERVAL_S}
+}
+
+def vqa_stream_key(task_id):
+    return f"vqa_stream:{task_id}"
+
+def publish_vqa_event(task_id, event):
+    key = vqa_stream_key(task_id)
+    stream_redis.xadd(key, {"event": json.dumps(event, ensure_ascii=False)})
+    stream_redis.expire(key, VQA_STREAM_TTL_S)
+
+def relay_vqa_stream(task_id, resp):
+    """Đọc SSE của ai-server, ghi từng token vào Redis stream; trả về {"answer", "timing"} khi xong."""
+    for line in resp.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data:"):
+            continue
+        event = json.loads(line[5:])
+        if event.get("error"):
+            publish_vqa_event(task_id, {"error": event["error"]})
+            raise RuntimeError(event["error"])
+        if event.get("done"):
+            return {"answer": event["answer"], "timing": event.get("timing")}
+        publish_vqa_event(task_id, {"token": event["token"]})
+    raise RuntimeError("Stream từ ai-server bị ngắt trước khi có câu trả lời")
+
 @celery.task(bind=True, queue='pipeline_b')
-def call_vision_qa_from_ai_server(self, filename, question, patient_id, model_name, user_id):
+def call_vision_qa_from_ai_server(self, filename, question, patient_id, model_name, user_id, token=None):
     # Gọi API server để inference
-    files = {'file': open(os.path.join(UPLOAD_FOLDER, filename), 'rb')}
-    data = {'question': question, 'model': model_name}
-    resp = requests.post(f"{AI_SERVER_HOST}/vqa-diagnose", data=data, files=files)
-    results = resp.json()
+    data = {'question': question, 'model': model_name, 'stream': '1'}
+    resp = requests.post(f"{AI_SERVER_HOST}/vqa-diagnose", data={**data, 'token': token}, stream=True) if token else None
+    if resp is None or resp.status_code == 410:
+        with open(os.path.join(UPLOAD_FOLDER, ai_server_upload(filename)), 'rb') as f:
+            resp = requests.post(f"{AI_SERVER_HOST}/vqa-diagnose", data=data, files={'file': f}, stream=True)
+    if resp.status_code in (429, 503):
+        raise self.retry(countdown=int(resp.headers.get("Retry-After", "5")), max_retries=AI_SERVER_MAX_RETRIES)
+    if resp.status_code != 200:
+        raise RuntimeError(ai_server_error(resp))
+    if resp.headers.get("Content-Type", "").startswith("text/event-stream"):
+        results = relay_vqa_stream(self.request.id, resp)
+    else:
+        results = resp.json()
     # Lưu vào database
     conn = get_db_conn()
     cur = conn.execute(
         "INSERT INTO qa_interactions (user_id, patient_id, model, image_filename, question, answer, timestamp) VALUES (?,?,?,?,?,?,?)",
-        (user_id, patient_id, model_name, filename, question, results['answer'], datetime.now())
+        (user_id, patient_id, model_name, display_filename(filename), question, results['answer'], datetime.now())
     )
     diag_id = cur.lastrowid
     results["diagnosis_id"] = diag_id
     conn.commit()
     conn.close()
 
+    # Câu trả lời đầy đủ (HTML) chỉ gửi sau khi đã lưu vào qa_interactions
+    publish_vqa_event(self.request.id, {"done": True, "result": results})
     return results
 
 
@@ -260,6 +659,8 @@ def task_diagnosis_status(task_id):
     task = call_diagnosis_from_ai_server.AsyncResult(task_id)
     if task.state == 'PENDING':
         return jsonify({"status": "queued"})
+    elif task.state == 'PROGRESS':
+        return jsonify({"status": "running", **(task.info or {})})
     elif task.state == 'SUCCESS':
         return jsonify({"status": "finished", "result": task.result})
     elif task.state == 'FAILURE':
@@ -280,6 +681,39 @@ def task_visionqa_status(task_id):
     else:
         return jsonify({"status": task.state})
 
+@app.route('/vqaStream/<task_id>')
+@limiter.limit("60 per second")
+def task_visionqa_stream(task_id):
+    """SSE: từng token của câu trả lời Vision QA, kết thúc bằng event done (kèm kết quả đã lưu) hoặc error."""
+    if 'user_id' not in session:
+        return jsonify({"error": "Unauthorized"}), 403
+    last_id = request.headers.get("Last-Event-ID", "0")
+
+    def events(last_id):
+        deadline = time.monotonic() + VQA_STREAM_TIMEOUT_S
+        while time.monotonic() < deadline:
+            entries = stream_redis.xread({vqa_stream_key(task_id): last_id}, block=VQA_STREAM_BLOCK_MS)
+            if not entries:
+                # Không có token mới: task lỗi trước khi stream, hoặc stream đã hết hạn nhưng còn kết quả
+                task = call_vision_qa_from_ai_server.AsyncResult(task_id)
+                if task.state == 'FAILURE':
+                    yield f"data: {json.dumps({'error': str(task.info)}, ensure_ascii=False)}\n\n"
+                    return
+                if task.state == 'SUCCESS':
+                    yield f"data: {json.dumps({'done': True, 'result': task.result}, ensure_ascii=False)}\n\n"
+                    return
+                yield ": keep-alive\n\n"
+                continue
+            for entry_id, fields in entries[0][1]:
+                last_id = entry_id
+                yield f"id: {entry_id}\ndata: {fields['event']}\n\n"
+                event = json.loads(fields["event"])
+                if event.get("done") or event.get("error"):
+                    return
+
+    return Response(stream_with_context(events(last_id)), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 # ---------------- Routes ----------------
 @app.route("/ping", methods=["GET"])
 @limiter.limit("5 per minute")
@@ -707,6 +1141,23 @@ def respond_share():
 
 
 # ---------------- Diagnosis ----------------
+@app.route("/diagnosis_explain")
+@limiter.limit("60 per minute")
+def diagnosis_explain():
+    if 'user_id' not in session:
+        return jsonify({"error": "Vui lòng đăng nhập"}), 401
+    conn = get_db_conn()
+    row = conn.execute("SELECT id, user_id, share_to, explain_image_filename, image_filename FROM diagnoses WHERE id = ?", (request.args.get("id"),)).fetchone()
+    user_row = conn.execute("SELECT email FROM users WHERE id = ?", (session['user_id'],)).fetchone()
+    conn.close()
+    if not row:
+        return jsonify({"error": "Diagnosis not found"}), 404
+    if row[1] != session['user_id'] and (not user_row or row[2] != user_row["email"]):
+        return jsonify({"error": "Permission denied"}), 403
+    # retry=1 (lần hỏi đầu khi mở kết quả) mới thử lại heatmap failed, các lần poll sau chỉ đọc trạng thái
+    heatmaps = request_explanations(row[0], row[3], row[4], retry_failed=request.args.get("retry") == "1")
+    return jsonify({"status": explain_status(heatmaps), "heatmaps": heatmaps, "image_filename": row[4]})
+
 @app.route("/diagnosis_detail")
 @limiter.limit("10 per minute") 
 def diagnosis_detail():
@@ -780,7 +1231,10 @@ def diagnosis_detail():
             "share_to": row[8],
             "sharer": sharer[0],
             "patient": patient[0],
-            "explain_image_filename": row[10]
+            "explain_image_filename": row[10],
+            # Lần xem đầu tiên mới xếp hàng tạo heatmap (heatmap failed được thử lại một lần mỗi lần mở trang),
+            # trang tự hỏi lại /diagnosis_explain tới khi xong
+            "heatmaps": request_explanations(row[0], row[10], row[4], retry_failed=True)
         }
 
     else:
@@ -917,12 +1371,14 @@ def diagnose():
 
         return render_template('diagnosis.html', notifications=g.notifications, patient_id=session['user_id'], isDoctor=isDoctor, patients=patients, show_patient_management=show_patient_management, api_host=WEB_SERVER_HOST, img_host=IMG_SERVER_HOST)
 
-    # POST: lưu file và request vào DB
+    # POST: lưu file, ai-server convert + kiểm tra ảnh y tế, rồi đưa vào hàng đợi hoặc chờ người dùng xác nhận
     file = request.files.get('file')
     model_name = request.form.get('model')
     patient_id = request.form.get('patient_id')
+    # auto=1: model được chọn theo vùng chụp mà gate nhận ra, người dùng xác nhận trước khi chạy
+    auto = request.form.get('auto') == '1'
 
-    if not file or not model_name or not patient_id:
+    if not file or not (model_name or auto) or not patient_id:
         return jsonify({"error": "Thiếu file, model hoặc mã bệnh nhân"}), 400
 
     conn = get_db_conn()
@@ -952,12 +1408,36 @@ def diagnose():
     file.save(os.path.join(UPLOAD_FOLDER, filename))
 
     try:
-        # Gửi task vào Celery
-        task = call_diagnosis_from_ai_server.apply_async(args=[filename, patient_id, model_name, session['user_id']])
+        status, prepared = prepare_upload(filename)
+    except requests.RequestException as e:
+        return jsonify({"error": "Lỗi kết nối API"}), 500
+    if status != 200:
+        return jsonify({"error": prepared.get("error", "Không thể kiểm tra loại ảnh")}), status
+
+    token, verdict = prepared["token"], prepared["gate"]
+    if verdict["medical"] and not auto:
+        # Ảnh y tế + model đã chọn sẵn → đưa vào hàng đợi ngay, không cần hỏi lại
+        task = call_diagnosis_from_ai_server.apply_async(args=[filename, patient_id, model_name, session['user_id'], token])
+        return jsonify({"task_id": task.id, "status": "queued"}), 200
+
+    remember_upload(token, filename=filename, patient_id=patient_id)
+    return jsonify({"status": "confirm", "token": token, "gate": verdict}), 200
+
+@app.route('/diagnose/confirm', methods=['POST'])
+@limiter.limit("3 per minute")
+def diagnose_confirm():
+    if ('user_id' not in session) or ('user_role' not in session):
+        return jsonify({"error": "Unauthorized"}), 403
+    model_name = request.form.get('model')
+    upload = take_upload(request.form.get('token'))
+    if not upload or not model_name:
+        return jsonify({"error": "Ảnh đã hết hạn, vui lòng chọn lại ảnh"}), 400
+
+    try:
+        # Gửi task vào Celery, ảnh đã nằm sẵn trên ai-server theo token
+        task = call_diagnosis_from_ai_server.apply_async(args=[upload['filename'], upload['patient_id'], model_name, session['user_id'], request.form.get('token')])
     except requests.RequestException as e:
         return jsonify({"error": "Lỗi kết nối API"}), 500
-    finally:
-        pass
 
     return jsonify({"task_id": task.id, "status": "queued"}), 200
 
@@ -1014,9 +1494,22 @@ def vision_qa():
                 return jsonify({"error": "Invalid format"})
     file.save(os.path.join(UPLOAD_FOLDER, filename))
 
+    try:
+        status, prepared = prepare_upload(filename)
+    except requests.RequestException as e:
+        return jsonify({"error": "Lỗi kết nối API"}), 500
+    if status != 200:
+        return jsonify({"error": prepared.get("error", "Không thể kiểm tra loại ảnh")}), status
+
+    token, verdict = prepared["token"], prepared["gate"]
+    if not verdict["medical"]:
+        # Không phải ảnh y tế → hỏi người dùng trước khi gửi cho VQA
+        remember_upload(token, filename=filename, patient_id=patient_id)
+        return jsonify({"status": "confirm", "token": token, "gate": verdict}), 200
+
     try:
         # Gửi task vào Celery
-        task = call_vision_qa_from_ai_server.apply_async(args=[filename, question, patient_id, model_name, session['user_id']])
+        task = call_vision_qa_from_ai_server.apply_async(args=[filename, question, patient_id, model_name, session['user_id'], token])
     except requests.RequestException as e:
         return jsonify({"error": "Lỗi kết nối API"}), 500
     finally:
@@ -1024,6 +1517,24 @@ def vision_qa():
 
     return jsonify({"task_id": task.id, "status": "queued"})
 
+@app.route('/vision-qa/confirm', methods=['POST'])
+@limiter.limit("2 per 10 minutes")
+def vision_qa_confirm():
+    if ('user_id' not in session) or ('user_role' not in session):
+        return jsonify({"error": "Unauthorized"}), 403
+    question = request.form.get('question')
+    model_name = request.form.get('model')
+    upload = take_upload(request.form.get('token'))
+    if not upload or not question:
+        return jsonify({"error": "Ảnh đã hết hạn, vui lòng chọn lại ảnh"}), 400
+
+    try:
+        task = call_vision_qa_from_ai_server.apply_async(args=[upload['filename'], question, upload['patient_id'], model_name, session['user_id'], request.form.get('token')])
+    except requests.RequestException as e:
+        return jsonify({"error": "Lỗi kết nối API"}), 500
+
+    return jsonify({"task_id": task.id, "status": "queued"})
+
 
 # ---------------- Main ----------------
 if __name__ == '__main__':
@@ -2,21 +2,26 @@ import os
 import time
 import uuid
 import sqlite3
+import json
 from datetime import datetime
 from typing import Optional
 from passlib.context import CryptContext
 from fastapi import (
     FastAPI, Request, Form, UploadFile, File, Depends, HTTPException, status
 )
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.responses import Response
 from celery import Celery
+import redis
+import redis.asyncio
 import requests
 import logging
+import base64
+from starlette.concurrency import run_in_threadpool
 
 # --- CONFIG ---
 
@@ -33,8 +38,30 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'nrrd', 'hdr', 'img', 'nii', 'gz', '
 
 WEB_SERVER_HOST = 'http://10.102.196.113'
 AI_SERVER_HOST = 'http://10.102.196.113:8080'
+# ai-server trả 429/503 + Retry-After khi hàng đợi inference đầy → task Celery thử lại sau
+AI_SERVER_MAX_RETRIES = 10
+# Upload một lần: ai-server /prepare convert + kiểm tra ảnh y tế, ảnh đã decode được giữ theo token.
+# /upload chờ /prepare đồng bộ (Flask: giữ một web worker trong lúc chờ) để trả lời ngay ảnh có phải ảnh y tế;
+# timeout chỉ đủ cho decode + gate (GATE_TIMEOUT_S=10 bên ai-server), quá hạn thì trả lỗi thay vì giữ worker lâu hơn
+AI_SERVER_PREPARE_TIMEOUT = 15
+PENDING_UPLOADS_MAX = 5
 IMG_SERVER_HOST = 'http://10.102.196.113:8000'
 EXPLAIN_SERVER_HOST = "http://10.102.196.101:8000/explain"
+# Heatmap chỉ được tạo khi có người mở chi tiết chẩn đoán, hoặc prefetch lúc ai-server rảnh:
+# celery beat gọi prefetch mỗi EXPLAIN_PREFETCH_INTERVAL_S giây, mỗi lượt tạo tối đa EXPLAIN_PREFETCH_BATCH chẩn đoán
+# khi hàng đợi của ai-server (/queue/stats) không quá EXPLAIN_PREFETCH_MAX_PENDING ảnh
+EXPLAIN_PREFETCH_INTERVAL_S = 60
+EXPLAIN_PREFETCH_BATCH = 2
+EXPLAIN_PREFETCH_MAX_PENDING = 0
+# Heatmap đã xếp hàng quá EXPLAIN_QUEUED_TIMEOUT_S giây mà chưa xong (worker chết giữa chừng...) được xếp hàng lại
+EXPLAIN_QUEUED_TIMEOUT_S = 900
+REDIS_URL = 'redis://localhost:6379/0'
+# Vision QA stream: task Celery đọc token từ ai-server (SSE) rồi ghi vào Redis stream vqa_stream:<task_id>,
+# /vqaStream/<task_id> chuyển tiếp cho trình duyệt. Stream được đọc lại từ đầu (hoặc từ Last-Event-ID)
+# nên trang mở muộn hay kết nối lại đều không mất token; key hết hạn sau VQA_STREAM_TTL_S giây
+VQA_STREAM_TTL_S = 600
+VQA_STREAM_TIMEOUT_S = 600
+VQA_STREAM_BLOCK_MS = 15000
 
 # --- App & templates ---
 app = FastAPI(title="InsecMed (FastAPI port)", version="1.0.0")
@@ -61,9 +88,11 @@ class SecurityHeadersMiddleware(BaseHTTPMiddleware):
 # --- Celery config ---
 celery = Celery(
     "insecmed",
-    broker='redis://localhost:6379/0',
-    backend='redis://localhost:6379/0'
+    broker=REDIS_URL,
+    backend=REDIS_URL
 )
+stream_redis = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+stream_aredis = redis.asyncio.Redis.from_url(REDIS_URL, decode_responses=True)
 
 # --- DB helpers ---
 def init_db():
@@ -164,6 +193,47 @@ init_db()
 def allowed_ext(filename: str) -> bool:
     return '.' in filename and filename.rsplit('.',1)[1].lower() in ALLOWED_EXTENSIONS
 
+# --- DICOM/volume: gửi thẳng file gốc cho ai-server, ảnh xem trước do ai-server trả về khi /prepare ---
+PREVIEW_EXTENSIONS = (".dcm", ".nii", ".nii.gz", ".nrrd", ".hdr", ".img")
+
+# Volume được chẩn đoán trên slice giữa mà ai-server render lúc /prepare, chính là ảnh xem trước
+VOLUME_EXTENSIONS = (".nii", ".nii.gz", ".nrrd", ".hdr", ".img")
+
+def display_filename(filename: str) -> str:
+    # Trình duyệt không hiển thị được DICOM/volume → lịch sử dùng ảnh xem trước
+    return filename + ".jpg" if filename.lower().endswith(PREVIEW_EXTENSIONS) else filename
+
+def ai_server_upload(filename: str) -> str:
+    # File gửi lại cho ai-server /diagnose khi không dùng token: DICOM 2D gửi file gốc (ai-server tự window/level),
+    # volume gửi ảnh xem trước để ra cùng một ảnh 2D như lúc /prepare
+    return display_filename(filename) if filename.lower().endswith(VOLUME_EXTENSIONS) else filename
+
+def prepare_upload(filename: str):
+    """Gửi file gốc cho ai-server đúng một lần: decode + gate ngay trong ai-server, trả về (status, payload có token)."""
+    path = os.path.join(UPLOAD_FOLDER, filename)
+    with open(path, 'rb') as f:
+        resp = requests.post(f"{AI_SERVER_HOST}/prepare", files={'file': (filename, f)}, timeout=AI_SERVER_PREPARE_TIMEOUT)
+    try:
+        data = resp.json()
+    except ValueError:
+        data = {"error": resp.text}
+    if resp.ok and data.get("preview"):
+        with open(path + ".jpg", "wb") as out:
+            out.write(base64.b64decode(data.pop("preview")))
+    return resp.status_code, data
+
+def remember_upload(request: Request, token: str, **info) -> None:
+    # Session cookie: chỉ giữ vài upload đang chờ xác nhận gần nhất
+    pending = dict(request.session.get('pending_uploads', {}))
+    pending[token] = info
+    request.session['pending_uploads'] = dict(list(pending.items())[-PENDING_UPLOADS_MAX:])
+
+def take_upload(request: Request, token: Optional[str]):
+    pending = dict(request.session.get('pending_uploads', {}))
+    info = pending.pop(token, None) if token else None
+    request.session['pending_uploads'] = pending
+    return info
+
 def get_client_ip(request: Request) -> str:
     xf = request.headers.get("x-forwarded-for")
     if xf:
@@ -178,83 +248,346 @@ def rate_limit(limit_str: str):
         return wrapper
     return decorator
 
+# --- Heatmap lười ---
+# Cột explain_image_filename giữ tên file heatmap của từng model (cách nhau bởi dấu phẩy) kèm trạng thái:
+# "pending:<file>" chưa tạo, "queued:<unix time>:<file>" đã xếp hàng tạo, "failed:<file>" tạo thất bại (chỉ thử lại
+# khi có người mở lại chẩn đoán, không thử lại theo từng lần poll/prefetch), "<file>" đã có ảnh, rỗng = model không có heatmap.
+# Heatmap lưu saliency thô (<file>.json: PNG xám 8-bit + box, vài trăm byte) để trình duyệt tự tô lên ảnh gốc;
+# heatmap ảnh PNG/JPEG cũ được tạo lại thành .json khi có người mở chẩn đoán (nếu còn file gốc)
+EXPLAIN_PENDING = "pending:"
+EXPLAIN_QUEUED = "queued:"
+EXPLAIN_FAILED = "failed:"
+SALIENCY_SUFFIX = ".json"
+
+def pending_explain_filenames(filename: str, count: int) -> str:
+    return "".join(f"{EXPLAIN_PENDING}explain_{idx}_{display_filename(filename)}{SALIENCY_SUFFIX}," for idx in range(count))
+
+def saliency_filename(filename: str) -> str:
+    return filename if filename.endswith(SALIENCY_SUFFIX) else filename + SALIENCY_SUFFIX
+
+def explain_entries(value: Optional[str]):
+    """Tách cột explain_image_filename thành [{"filename", "status"}] theo thứ tự model."""
+    items = (value or "").split(",")
+    if items[-1] == "":
+        items.pop()
+    entries = []
+    for item in items:
+        if not item:
+            entries.append({"filename": None, "status": "none"})
+        elif item.startswith(EXPLAIN_PENDING):
+            entries.append({"filename": item[len(EXPLAIN_PENDING):], "status": "pending"})
+        elif item.startswith(EXPLAIN_QUEUED):
+            queued_at, _, filename = item[len(EXPLAIN_QUEUED):].partition(":")
+            if not queued_at.isdigit():
+                # Bản ghi cũ "queued:<file>" chưa có thời điểm xếp hàng → coi như đã quá hạn
+                queued_at, filename = "0", item[len(EXPLAIN_QUEUED):]
+            entries.append({"filename": filename, "status": "queued", "queued_at": int(queued_at)})
+        elif item.startswith(EXPLAIN_FAILED):
+            entries.append({"filename": item[len(EXPLAIN_FAILED):], "status": "failed"})
+        elif os.path.exists(os.path.join(UPLOAD_FOLDER, item)):
+            entries.append({"filename": item, "status": "ready"})
+        else:
+            # Bản ghi cũ lưu sẵn tên file dù heatmap có thể chưa từng được ghi → tạo khi mở
+            entries.append({"filename": saliency_filename(item), "status": "pending"})
+    return entries
+
+def join_explain_entries(entries) -> str:
+    prefix = {"pending": EXPLAIN_PENDING, "failed": EXPLAIN_FAILED, "ready": ""}
+    def item(e):
+        if e["status"] == "queued":
+            return f"{EXPLAIN_QUEUED}{e['queued_at']}:{e['filename']}"
+        return prefix[e["status"]] + e["filename"]
+    return "".join((item(e) if e["filename"] else "") + "," for e in entries)
+
+def explain_status(entries) -> str:
+    statuses = {e["status"] for e in entries}
+    for status in ("pending", "queued", "failed"):
+        if status in statuses:
+            return status
+    return "ready"
+
+def update_explain_entries(diag_id, old_value, entries) -> bool:
+    # Compare-and-set: chỉ ghi khi cột chưa bị request/worker khác đổi → mỗi heatmap chỉ được xếp hàng một lần
+    conn = get_db_conn()
+    cur = conn.execute("UPDATE diagnoses SET explain_image_filename = ? WHERE id = ? AND explain_image_filename IS ?",
+                       (join_explain_entries(entries), diag_id, old_value))
+    conn.commit()
+    conn.close()
+    return cur.rowcount == 1
+
+def claim_explanations(diag_id, value, image_filename=None, retry_failed=False):
+    """Chuyển các heatmap pending (và queued đã quá hạn) sang queued; trả về entries mới, hoặc None nếu không có gì để tạo.
+
+    Có image_filename (người dùng đang xem) thì heatmap ảnh cũ cũng được xếp hàng chuyển sang saliency.
+    retry_failed: heatmap failed cũng được thử lại (người dùng vừa mở chẩn đoán, không phải poll).
+    """
+    entries = explain_entries(value)
+    now = int(time.time())
+    migrate = bool(image_filename) and os.path.exists(os.path.join(UPLOAD_FOLDER, upload_source(image_filename)))
+    claimed = []
+    for e in entries:
+        legacy = migrate and e["status"] == "ready" and not e["filename"].endswith(SALIENCY_SUFFIX)
+        stale = e["status"] == "queued" and now - e["queued_at"] > EXPLAIN_QUEUED_TIMEOUT_S
+        retry = e["status"] == "pending" or stale or legacy or (retry_failed and e["status"] == "failed")
+        claimed.append({"filename": saliency_filename(e["filename"]), "status": "queued", "queued_at": now} if retry else e)
+    if claimed == entries:
+        return None
+    return claimed if update_explain_entries(diag_id, value, claimed) else None
+
+def modify_explain_entries(diag_id, change):
+    """Đọc cột heatmap, áp change(entries) rồi compare-and-set; sub-task của các model ghi song song nên thử lại khi bị chen."""
+    while True:
+        conn = get_db_conn()
+        row = conn.execute("SELECT explain_image_filename FROM diagnoses WHERE id = ?", (diag_id,)).fetchone()
+        conn.close()
+        if not row:
+            return
+        if update_explain_entries(diag_id, row[0], change(explain_entries(row[0]))):
+            return
+
+def set_explain_slots(diag_id, updates):
+    # Gắn heatmap của từng model ngay khi xong, không chờ các model khác
+    modify_explain_entries(diag_id, lambda entries: [updates.get(idx, e) for idx, e in enumerate(entries)])
+
+def release_explanations(diag_id, indices=None, status="pending"):
+    # ai-server bận (prefetch nhường chỗ) → trả về pending để lượt sau tạo tiếp;
+    # tạo thất bại → failed, chỉ thử lại khi có người mở lại chẩn đoán
+    modify_explain_entries(diag_id, lambda entries: [
+        {"filename": e["filename"], "status": status} if e["status"] == "queued" and (indices is None or idx in indices) else e
+        for idx, e in enumerate(entries)
+    ])
+
+def fail_explanations(diag_id, indices=None):
+    release_explanations(diag_id, indices, status="failed")
+
+def request_explanations(diag_id, value, image_filename=None, retry_failed=False):
+    """Gọi khi có người xem chẩn đoán: xếp hàng tạo heatmap còn thiếu; trả về entries hiện tại.
+
+    retry_failed=True khi người dùng mở chẩn đoán/bấm xem heatmap; các lần poll sau đó để False.
+    """
+    claimed = claim_explanations(diag_id, value, image_filename, retry_failed)
+    if claimed is None:
+        return explain_entries(value)
+    # Mỗi model một sub-task: heatmap nào xong trước được gắn vào chẩn đoán trước
+    previous = explain_entries(value)
+    for idx, e in enumerate(claimed):
+        if e["status"] == "queued" and e != previous[idx]:
+            explain_diagnosis.apply_async(args=[diag_id, idx])
+    return claimed
+
+def upload_source(image_filename: str) -> str:
+    # Lịch sử lưu ảnh xem trước (.dcm.jpg...) → file gốc để gửi lại cho ai-server
+    source = image_filename[:-len(".jpg")]
+    return source if image_filename.endswith(".jpg") and source.lower().endswith(PREVIEW_EXTENSIONS) else image_filename
+
+def remove_legacy_heatmap(saliency):
+    # Heatmap ảnh cũ cùng tên (bỏ đuôi .json) không còn dùng sau khi đã có saliency
+    legacy = os.path.join(UPLOAD_FOLDER, saliency[:-len(SALIENCY_SUFFIX)])
+    if os.path.exists(legacy):
+        os.remove(legacy)
+
+def generate_explanations(diag_id, indices=None):
+    """Chẩn đoán lại với explain=saliency (ai-server tính heatmap trong cùng lượt forward) và ghi các heatmap đang queued.
+
+    indices giới hạn các model cần tạo (mặc định: mọi model đang queued). Trả về response của ai-server
+    (429/503 thì heatmap vẫn queued để caller quyết định thử lại hay trả về pending).
+    """
+    conn = get_db_conn()
+    row = conn.execute("SELECT model, image_filename, explain_image_filename FROM diagnoses WHERE id = ?", (diag_id,)).fetchone()
+    conn.close()
+    entries = explain_entries(row[2]) if row else []
+    todo = [idx for idx, e in enumerate(entries) if e["status"] == "queued" and (indices is None or idx in indices)]
+    if not todo:
+        return None
+    models = row[0].split(',')
+    # ai-server trả kết quả theo đúng thứ tự model gửi lên
+    data = {'model': ",".join(models[idx] for idx in todo), 'explain': 'saliency'}
+
+    try:
+        with open(os.path.join(UPLOAD_FOLDER, ai_server_upload(upload_source(row[1]))), 'rb') as f:
+            resp = requests.post(f"{AI_SERVER_HOST}/diagnose", data=data, files={'file': f})
+    except (OSError, requests.RequestException):
+        fail_explanations(diag_id, todo)
+        raise
+    if resp.status_code in (429, 503):
+        return resp
+    if resp.status_code != 200:
+        fail_explanations(diag_id, todo)
+        return resp
+
+    results = resp.json()['results']
+    updates = {}
+    for pos, idx in enumerate(todo):
+        explanation = (results[pos].get('explanation') if pos < len(results) else None) or {}
+        if explanation.get('map'):
+            with open(os.path.join(UPLOAD_FOLDER, entries[idx]["filename"]), "w") as f:
+                json.dump({k: explanation[k] for k in ('method', 'shape', 'box', 'map')}, f)
+            remove_legacy_heatmap(entries[idx]["filename"])
+            updates[idx] = dict(entries[idx], status="ready")
+        else:
+            # Model/backend không hỗ trợ explain (onnx, volume...) → không có heatmap, khỏi thử lại
+            updates[idx] = {"filename": None, "status": "none"}
+    set_explain_slots(diag_id, updates)
+    return resp
+
+def ai_server_idle() -> bool:
+    try:
+        stats = requests.get(f"{AI_SERVER_HOST}/queue/stats", timeout=5).json()
+    except (requests.RequestException, ValueError):
+        return False
+    waiting = stats.get("diagnose", {}).get("pending", 0) + sum(stats.get("batch", {}).values())
+    return waiting <= EXPLAIN_PREFETCH_MAX_PENDING
+
+def ai_server_error(resp):
+    # Thông báo lỗi của ai-server ({"error": ...}) để task thất bại với lý do rõ ràng
+    try:
+        return f"ai-server {resp.status_code}: {resp.json().get('error', resp.text)}"
+    except ValueError:
+        return f"ai-server {resp.status_code}: {resp.text[:200]}"
+
+def prediction_label(result):
+    # Stage cascade bị bỏ qua: nhãn chỉ được suy ra từ model rẻ, ghi rõ để không bị đọc như dự đoán thật
+    if result.get('skipped'):
+        return f"{result['top_label']} (suy ra từ {result['inferred_from']})"
+    return result['top_label']
+
 # --- Celery tasks ---
 @celery.task(bind=True, queue='pipeline_a')
-def call_diagnosis_from_ai_server(self, filename, patient_id, model_name, user_id):
-    files = {'file': open(os.path.join(UPLOAD_FOLDER, filename), 'rb')}
+def call_diagnosis_from_ai_server(self, filename, patient_id, model_name, user_id, token=None):
+    # Trạng thái từng bước cho /diagnoseStatus thay vì "queued" tới khi xong
+    self.update_state(state='PROGRESS', meta={'stage': 'classifying'})
     data = {'model': model_name}
-    resp = requests.post(f"{AI_SERVER_HOST}/diagnose", data=data, files=files)
+    # Ảnh đã được ai-server decode lúc /prepare → chỉ gửi token; token hết hạn (410) thì upload lại
+    # đúng ảnh mà /prepare đã dùng (volume: ảnh xem trước) để kết quả có cùng dạng 2D
+    resp = requests.post(f"{AI_SERVER_HOST}/diagnose", data={**data, 'token': token}) if token else None
+    if resp is None or resp.status_code == 410:
+        with open(os.path.join(UPLOAD_FOLDER, ai_server_upload(filename)), 'rb') as f:
+            resp = requests.post(f"{AI_SERVER_HOST}/diagnose", data=data, files={'file': f})
+    if resp.status_code in (429, 503):
+        raise self.retry(countdown=int(resp.headers.get("Retry-After", "5")), max_retries=AI_SERVER_MAX_RETRIES)
+    if resp.status_code != 200:
+        raise RuntimeError(ai_server_error(resp))
     results = resp.json()
 
     labels = ""
     for i in range(len(model_name.split(','))):
-        labels += results['results'][i]['top_label'] + "/"
-
-
-    explain_filenames = ""
-
-    for idx, m in enumerate(model_name.split(',')):
-        input_file = open(os.path.join(UPLOAD_FOLDER, filename), 'rb')
-        # Explain Multipart form-data
-        explain_model_name = ""
-
-        if 'skin' in m:
-            explain_model_name = "Anwarkh1/Skin_Cancer-Image_Classification"
+        labels += prediction_label(results['results'][i]) + "/"
+    # Xác suất lưu kèm lấy từ model thật sự đã chạy đầu tiên, không lấy từ kết quả suy ra của cascade
+    probability = next((r['top_score'] for r in results['results'] if not r.get('skipped')), results['results'][0]['top_score'])
 
-        elif 'breast' in m:
-            explain_model_name = "Falah/vit-base-breast-cancer"
 
-        elif 'brain' in m:
-            explain_model_name = "DunnBC22/vit-base-patch16-224-in21k_brain_tumor_diagnosis"
-
-        elif 'pneu' in m:
-            explain_model_name = "xyuan/vit-xray-pneumonia-classification"
-
-        else:
-            explain_model_name = "DunnBC22/vit-base-patch16-224-in21k_covid_19_ct_scans"
-
-        files = {
-            "model_kind": (None, explain_model_name),
-            "prediction": (None, results["results"][idx]["top_label_origin"]),
-            "image": (filename, input_file, "image/png")
-        }
-        explain_filenames += "explain_"+str(idx)+"_"+filename + ","
-
-        # response = requests.post(EXPLAIN_SERVER_HOST, files=files)
-        # if response.content:
-        #     with open(os.path.join(UPLOAD_FOLDER, "explain_"+str(idx)+"_"+filename), "wb") as f:
-        #         f.write(response.content)
+    # Kết quả phân loại trả về ngay; heatmap chưa tạo ở đây (phần lớn chẩn đoán không bao giờ được mở lại),
+    # khi được xem thì mỗi model là một sub-task explain_diagnosis gắn dần vào chẩn đoán qua /diagnosis_explain
+    explain_filenames = pending_explain_filenames(filename, len(model_name.split(',')))
 
     conn = get_db_conn()
     cur = conn.execute(
         "INSERT INTO diagnoses (user_id, patient_id, model, image_filename, explain_image_filename, prediction, probability, timestamp) VALUES (?,?,?,?,?,?,?,?)",
-        (user_id, patient_id, model_name, filename, explain_filenames, labels, results['results'][0]['top_score'], datetime.now())
+        (user_id, patient_id, model_name, display_filename(filename), explain_filenames, labels, probability, datetime.now())
     )
     diag_id = cur.lastrowid
     results["diagnosis_id"] = diag_id
     results["explain_image_filenames"] = explain_filenames
+    results["explain_status"] = "pending"
     conn.commit()
     conn.close()
 
     return results
 
+@celery.task(bind=True, queue='pipeline_a')
+def explain_diagnosis(self, diag_id, idx=None):
+    # Sub-task heatmap của một model; có người đang chờ xem → chạy cùng queue với chẩn đoán
+    indices = None if idx is None else [idx]
+    resp = generate_explanations(diag_id, indices)
+    if resp is not None and resp.status_code in (429, 503):
+        if self.request.retries >= AI_SERVER_MAX_RETRIES:
+            fail_explanations(diag_id, indices)
+            return
+        raise self.retry(countdown=int(resp.headers.get("Retry-After", "5")), max_retries=AI_SERVER_MAX_RETRIES)
+
+@celery.task(queue='pipeline_explain')
+def prefetch_explanations():
+    """Chạy theo lịch celery beat: tạo trước heatmap cho các chẩn đoán mới nhất khi ai-server rảnh."""
+    if not ai_server_idle():
+        return 0
+    conn = get_db_conn()
+    rows = conn.execute("SELECT id, explain_image_filename FROM diagnoses WHERE explain_image_filename LIKE ? ORDER BY id DESC LIMIT ?",
+                        (f"%{EXPLAIN_PENDING}%", EXPLAIN_PREFETCH_BATCH)).fetchall()
+    conn.close()
+    generated = 0
+    for diag_id, value in rows:
+        if claim_explanations(diag_id, value) is None:
+            continue
+        try:
+            resp = generate_explanations(diag_id)
+        except (OSError, requests.RequestException) as e:
+            # Heatmap của chẩn đoán này đã chuyển sang failed → lượt sau không chọn lại, làm tiếp chẩn đoán khác
+            logger.warning("prefetch heatmap %s thất bại: %s", diag_id, e)
+            continue
+        if resp is not None and resp.status_code in (429, 503):
+            # ai-server bận trở lại → trả về pending, nhường cho request của người dùng
+            release_explanations(diag_id)
+            break
+        if resp is not None and resp.status_code != 200:
+            # Lỗi khác: generate_explanations đã đánh dấu failed, chuyển sang chẩn đoán tiếp theo
+            continue
+        generated += 1
+    return generated
+
+celery.conf.beat_schedule = {
+    "prefetch-explanations": {"task": prefetch_explanations.name, "schedule": EXPLAIN_PREFETCH_INTERVAL_S}
+}
+
+def vqa_stream_key(task_id):
+    return f"vqa_stream:{task_id}"
+
+def publish_vqa_event(task_id, event):
+    key = vqa_stream_key(task_id)
+    stream_redis.xadd(key, {"event": json.dumps(event, ensure_ascii=False)})
+    stream_redis.expire(key, VQA_STREAM_TTL_S)
+
+def relay_vqa_stream(task_id, resp):
+    """Đọc SSE của ai-server, ghi từng token vào Redis stream; trả về {"answer", "timing"} khi xong."""
+    for line in resp.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data:"):
+            continue
+        event = json.loads(line[5:])
+        if event.get("error"):
+            publish_vqa_event(task_id, {"error": event["error"]})
+            raise RuntimeError(event["error"])
+        if event.get("done"):
+            return {"answer": event["answer"], "timing": event.get("timing")}
+        publish_vqa_event(task_id, {"token": event["token"]})
+    raise RuntimeError("Stream từ ai-server bị ngắt trước khi có câu trả lời")
+
 @celery.task(bind=True, queue='pipeline_b')
-def call_vision_qa_from_ai_server(self, filename, question, patient_id, model_name, user_id):
-    files = {'file': open(os.path.join(UPLOAD_FOLDER, filename), 'rb')}
-    data = {'question': question, 'model': model_name}
-    resp = requests.post(f"{AI_SERVER_HOST}/vqa-diagnose", data=data, files=files)
-    results = resp.json()
+def call_vision_qa_from_ai_server(self, filename, question, patient_id, model_name, user_id, token=None):
+    data = {'question': question, 'model': model_name, 'stream': '1'}
+    resp = requests.post(f"{AI_SERVER_HOST}/vqa-diagnose", data={**data, 'token': token}, stream=True) if token else None
+    if resp is None or resp.status_code == 410:
+        with open(os.path.join(UPLOAD_FOLDER, ai_server_upload(filename)), 'rb') as f:
+            resp = requests.post(f"{AI_SERVER_HOST}/vqa-diagnose", data=data, files={'file': f}, stream=True)
+    if resp.status_code in (429, 503):
+        raise self.retry(countdown=int(resp.headers.get("Retry-After", "5")), max_retries=AI_SERVER_MAX_RETRIES)
+    if resp.status_code != 200:
+        raise RuntimeError(ai_server_error(resp))
+    if resp.headers.get("Content-Type", "").startswith("text/event-stream"):
+        results = relay_vqa_stream(self.request.id, resp)
+    else:
+        results = resp.json()
 
     conn = get_db_conn()
     cur = conn.execute(
         "INSERT INTO qa_interactions (user_id, patient_id, model, image_filename, question, answer, timestamp) VALUES (?,?,?,?,?,?,?)",
-        (user_id, patient_id, model_name, filename, question, results['answer'], datetime.now())
+        (user_id, patient_id, model_name, display_filename(filename), question, results['answer'], datetime.now())
     )
     diag_id = cur.lastrowid
     results["diagnosis_id"] = diag_id
     conn.commit()
     conn.close()
 
+    # Câu trả lời đầy đủ (HTML) chỉ gửi sau khi đã lưu vào qa_interactions
+    publish_vqa_event(self.request.id, {"done": True, "result": results})
     return results
 
 # Helper to include notifications easily
@@ -702,7 +1035,10 @@ async def diagnosis_detail(request: Request, notifications=Depends(get_notificat
             "share_to": row[8],
             "sharer": (sharer[0] if sharer else "N/A"),
             "patient": (patient[0] if patient else "N/A"),
-            "explain_image_filenames": row[10]
+            "explain_image_filenames": row[10],
+            # Lần xem đầu tiên mới xếp hàng tạo heatmap (heatmap failed được thử lại một lần mỗi lần mở trang),
+            # trang tự hỏi lại /diagnosis_explain tới khi xong
+            "heatmaps": request_explanations(row[0], row[10], row[4], retry_failed=True)
         }
 
     else:
@@ -745,6 +1081,22 @@ async def diagnosis_detail(request: Request, notifications=Depends(get_notificat
 
     return templates.TemplateResponse("diagnosis_detail.html", template_context(request, notifications=notifications, tag=tag, showUpdate=showUpdate, isDoctor=True, show_patient_management=True, diagnosis=diagnosis, flashes=get_flashes(request)))
 
+@app.get("/diagnosis_explain")
+async def diagnosis_explain(request: Request, id: Optional[int] = None, retry: Optional[str] = None):
+    if 'user_id' not in request.session:
+        return JSONResponse({"error": "Vui lòng đăng nhập"}, status_code=401)
+    conn = get_db_conn()
+    row = conn.execute("SELECT id, user_id, share_to, explain_image_filename, image_filename FROM diagnoses WHERE id = ?", (id,)).fetchone()
+    user_row = conn.execute("SELECT email FROM users WHERE id = ?", (request.session['user_id'],)).fetchone()
+    conn.close()
+    if not row:
+        return JSONResponse({"error": "Diagnosis not found"}, status_code=404)
+    if row[1] != request.session['user_id'] and (not user_row or row[2] != user_row["email"]):
+        return JSONResponse({"error": "Permission denied"}, status_code=403)
+    # retry=1 (lần hỏi đầu khi mở kết quả) mới thử lại heatmap failed, các lần poll sau chỉ đọc trạng thái
+    heatmaps = await run_in_threadpool(request_explanations, row[0], row[3], row[4], retry == "1")
+    return {"status": explain_status(heatmaps), "heatmaps": heatmaps, "image_filename": row[4]}
+
 # ---------------- Update patient diagnosis ----------------
 @app.post("/update_patient_diagnosis")
 #@rate_limit("3/minute")
@@ -802,10 +1154,13 @@ async def diagnose_get(request: Request, notifications=Depends(get_notifications
 
 @app.post("/diagnose")
 #@rate_limit("3/minute")
-async def diagnose_post(request: Request, file: UploadFile = File(...), model: str = Form(...), patient_id: str = Form(...)):
+async def diagnose_post(request: Request, file: UploadFile = File(...), model: Optional[str] = Form(None), patient_id: str = Form(...),
+                        auto: Optional[str] = Form(None)):
     if ('user_id' not in request.session) or ('user_role' not in request.session):
         return JSONResponse({"error": "Unauthorized"}, status_code=403)
-    if not file or not model or not patient_id:
+    # auto=1: model được chọn theo vùng chụp mà gate nhận ra, người dùng xác nhận trước khi chạy
+    auto = auto == '1'
+    if not file or not (model or auto) or not patient_id:
         return JSONResponse({"error": "Thiếu file, model hoặc mã bệnh nhân"}, status_code=400)
 
     conn = get_db_conn()
@@ -830,7 +1185,33 @@ async def diagnose_post(request: Request, file: UploadFile = File(...), model: s
         f.write(await file.read())
 
     try:
-        task = call_diagnosis_from_ai_server.apply_async(args=[filename, patient_id, model, request.session['user_id']])
+        status, prepared = await run_in_threadpool(prepare_upload, filename)
+    except requests.RequestException:
+        return JSONResponse({"error": "Lỗi kết nối API"}, status_code=500)
+    if status != 200:
+        return JSONResponse({"error": prepared.get("error", "Không thể kiểm tra loại ảnh")}, status_code=status)
+
+    token, verdict = prepared["token"], prepared["gate"]
+    if verdict["medical"] and not auto:
+        # Ảnh y tế + model đã chọn sẵn → đưa vào hàng đợi ngay, không cần hỏi lại
+        task = call_diagnosis_from_ai_server.apply_async(args=[filename, patient_id, model, request.session['user_id'], token])
+        return {"task_id": task.id, "status": "queued"}
+
+    remember_upload(request, token, filename=filename, patient_id=patient_id)
+    return {"status": "confirm", "token": token, "gate": verdict}
+
+@app.post("/diagnose/confirm")
+#@rate_limit("3/minute")
+async def diagnose_confirm(request: Request, token: str = Form(...), model: str = Form(...)):
+    if ('user_id' not in request.session) or ('user_role' not in request.session):
+        return JSONResponse({"error": "Unauthorized"}, status_code=403)
+    upload = take_upload(request, token)
+    if not upload:
+        return JSONResponse({"error": "Ảnh đã hết hạn, vui lòng chọn lại ảnh"}, status_code=400)
+
+    try:
+        # Ảnh đã nằm sẵn trên ai-server theo token
+        task = call_diagnosis_from_ai_server.apply_async(args=[upload['filename'], upload['patient_id'], model, request.session['user_id'], token])
     except requests.RequestException:
         return JSONResponse({"error": "Lỗi kết nối API"}, status_code=500)
 
@@ -843,6 +1224,8 @@ async def task_diagnosis_status(task_id: str):
     task = call_diagnosis_from_ai_server.AsyncResult(task_id)
     if task.state == 'PENDING':
         return {"status": "queued"}
+    elif task.state == 'PROGRESS':
+        return {"status": "running", **(task.info or {})}
     elif task.state == 'SUCCESS':
         return {"status": "finished", "result": task.result}
     elif task.state == 'FAILURE':
@@ -863,6 +1246,40 @@ async def task_visionqa_status(task_id: str):
     else:
         return {"status": task.state}
 
+@app.get("/vqaStream/{task_id}")
+async def task_visionqa_stream(request: Request, task_id: str):
+    """SSE: từng token của câu trả lời Vision QA, kết thúc bằng event done (kèm kết quả đã lưu) hoặc error."""
+    if 'user_id' not in request.session:
+        return JSONResponse({"error": "Unauthorized"}, status_code=403)
+    last_id = request.headers.get("Last-Event-ID", "0")
+
+    async def events():
+        nonlocal last_id
+        deadline = time.monotonic() + VQA_STREAM_TIMEOUT_S
+        while time.monotonic() < deadline:
+            entries = await stream_aredis.xread({vqa_stream_key(task_id): last_id}, block=VQA_STREAM_BLOCK_MS)
+            if not entries:
+                # Không có token mới: task lỗi trước khi stream, hoặc stream đã hết hạn nhưng còn kết quả
+                task = call_vision_qa_from_ai_server.AsyncResult(task_id)
+                state, info = await run_in_threadpool(lambda: (task.state, task.info))
+                if state == 'FAILURE':
+                    yield f"data: {json.dumps({'error': str(info)}, ensure_ascii=False)}\n\n"
+                    return
+                if state == 'SUCCESS':
+                    yield f"data: {json.dumps({'done': True, 'result': info}, ensure_ascii=False)}\n\n"
+                    return
+                yield ": keep-alive\n\n"
+                continue
+            for entry_id, fields in entries[0][1]:
+                last_id = entry_id
+                yield f"id: {entry_id}\ndata: {fields['event']}\n\n"
+                event = json.loads(fields["event"])
+                if event.get("done") or event.get("error"):
+                    return
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 # ---------------- Vision QA ----------------
 @app.get("/vision-qa", response_class=HTMLResponse)
 async def vision_qa_get(request: Request, notifications=Depends(get_notifications)):
@@ -903,7 +1320,36 @@ async def vision_qa_post(request: Request, file: UploadFile = File(...), questio
         f.write(await file.read())
 
     try:
-        task = call_vision_qa_from_ai_server.apply_async(args=[filename, question, patient_id, model, request.session['user_id']])
+        status, prepared = await run_in_threadpool(prepare_upload, filename)
+    except requests.RequestException:
+        return JSONResponse({"error": "Lỗi kết nối API"}, status_code=500)
+    if status != 200:
+        return JSONResponse({"error": prepared.get("error", "Không thể kiểm tra loại ảnh")}, status_code=status)
+
+    token, verdict = prepared["token"], prepared["gate"]
+    if not verdict["medical"]:
+        # Không phải ảnh y tế → hỏi người dùng trước khi gửi cho VQA
+        remember_upload(request, token, filename=filename, patient_id=patient_id)
+        return {"status": "confirm", "token": token, "gate": verdict}
+
+    try:
+        task = call_vision_qa_from_ai_server.apply_async(args=[filename, question, patient_id, model, request.session['user_id'], token])
+    except requests.RequestException:
+        return JSONResponse({"error": "Lỗi kết nối API"}, status_code=500)
+
+    return {"task_id": task.id, "status": "queued"}
+
+@app.post("/vision-qa/confirm")
+#@rate_limit("2/10minutes")
+async def vision_qa_confirm(request: Request, token: str = Form(...), question: str = Form(...), model: str = Form(...)):
+    if ('user_id' not in request.session) or ('user_role' not in request.session):
+        return JSONResponse({"error": "Unauthorized"}, status_code=403)
+    upload = take_upload(request, token)
+    if not upload:
+        return JSONResponse({"error": "Ảnh đã hết hạn, vui lòng chọn lại ảnh"}, status_code=400)
+
+    try:
+        task = call_vision_qa_from_ai_server.apply_async(args=[upload['filename'], question, upload['patient_id'], model, request.session['user_id'], token])
     except requests.RequestException:
         return JSONResponse({"error": "Lỗi kết nối API"}, status_code=500)
 
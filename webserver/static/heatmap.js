@@ -0,0 +1,87 @@
+// Tô saliency lên ảnh gốc ngay trên trình duyệt.
+// File heatmap (.json) chỉ chứa saliency ở độ phân giải của model (PNG xám 8-bit) + box = vùng ảnh
+// model nhìn thấy (tỉ lệ theo kích thước ảnh), nên đổi độ trong suốt / colormap không cần gọi lại server.
+const HEATMAP_COLORMAPS = {
+  jet: x => [1.5 - Math.abs(4 * x - 3), 1.5 - Math.abs(4 * x - 2), 1.5 - Math.abs(4 * x - 1)],
+  hot: x => [3 * x, 3 * x - 1, 3 * x - 2],
+  viridis: x => {
+    const stops = [[0.267, 0.005, 0.329], [0.231, 0.322, 0.545], [0.129, 0.569, 0.549], [0.369, 0.788, 0.384], [0.993, 0.906, 0.144]];
+    const pos = x * (stops.length - 1);
+    const i = Math.min(stops.length - 2, Math.floor(pos));
+    return stops[i].map((v, k) => v + (stops[i + 1][k] - v) * (pos - i));
+  },
+  gray: x => [x, x, x]
+};
+// Ảnh lớn thì tô heatmap ở độ phân giải thấp hơn rồi phóng lên, saliency gốc chỉ vài chục ô
+const HEATMAP_MAX_SIDE = 512;
+
+function loadHeatmapImage(src) {
+  return new Promise((resolve, reject) => {
+    const img = new Image();
+    img.onload = () => resolve(img);
+    img.onerror = reject;
+    img.src = src;
+  });
+}
+
+function drawHeatmap(canvas, opacity, colormap) {
+  const { base, map, box } = canvas.heatmapData;
+  const width = base.naturalWidth, height = base.naturalHeight;
+  canvas.width = width;
+  canvas.height = height;
+  const ctx = canvas.getContext('2d');
+  ctx.drawImage(base, 0, 0);
+
+  const left = Math.round(box[0] * width), top = Math.round(box[1] * height);
+  const boxW = Math.max(1, Math.round(box[2] * width) - left), boxH = Math.max(1, Math.round(box[3] * height) - top);
+  const scale = Math.min(1, HEATMAP_MAX_SIDE / Math.max(boxW, boxH));
+  const layer = document.createElement('canvas');
+  layer.width = Math.max(1, Math.round(boxW * scale));
+  layer.height = Math.max(1, Math.round(boxH * scale));
+  const lctx = layer.getContext('2d');
+  lctx.imageSmoothingEnabled = true;
+  lctx.imageSmoothingQuality = 'high';
+  lctx.drawImage(map, 0, 0, layer.width, layer.height);
+
+  const pixels = lctx.getImageData(0, 0, layer.width, layer.height);
+  const cmap = HEATMAP_COLORMAPS[colormap] || HEATMAP_COLORMAPS.jet;
+  const lut = Array.from({ length: 256 }, (_, v) => cmap(v / 255).map(c => Math.round(Math.min(1, Math.max(0, c)) * 255)));
+  const alpha = Math.round(opacity * 255);
+  for (let i = 0; i < pixels.data.length; i += 4) {
+    const [r, g, b] = lut[pixels.data[i]];
+    pixels.data[i] = r;
+    pixels.data[i + 1] = g;
+    pixels.data[i + 2] = b;
+    pixels.data[i + 3] = alpha;
+  }
+  lctx.putImageData(pixels, 0, 0);
+  ctx.drawImage(layer, left, top, boxW, boxH);
+}
+
+// Gắn canvas + thanh chỉnh độ trong suốt + chọn colormap vào container
+async function mountHeatmap(container, imageUrl, heatmapUrl) {
+  if (!heatmapUrl.endsWith('.json')) {
+    // Heatmap ảnh cũ (chưa được chuyển sang saliency)
+    container.innerHTML = `<img width="224px" src="${heatmapUrl}" alt="Heatmap" class="img-fluid rounded shadow">`;
+    return;
+  }
+  const saliency = await (await fetch(heatmapUrl, { credentials: 'include' })).json();
+  const [base, map] = await Promise.all([loadHeatmapImage(imageUrl), loadHeatmapImage(`data:image/png;base64,${saliency.map}`)]);
+
+  container.innerHTML = `
+    <canvas class="img-fluid rounded shadow" style="width: 224px;"></canvas>
+    <div class="d-flex align-items-center gap-2 mt-2" style="max-width: 320px;">
+      <input type="range" class="form-range heatmap-opacity" min="0" max="1" step="0.05" value="0.5" title="Độ trong suốt">
+      <select class="form-select form-select-sm heatmap-colormap" style="width: auto;">
+        ${Object.keys(HEATMAP_COLORMAPS).map(name => `<option value="${name}">${name}</option>`).join('')}
+      </select>
+    </div>`;
+  const canvas = container.querySelector('canvas');
+  const opacity = container.querySelector('.heatmap-opacity');
+  const colormap = container.querySelector('.heatmap-colormap');
+  canvas.heatmapData = { base, map, box: saliency.box };
+  const redraw = () => drawHeatmap(canvas, parseFloat(opacity.value), colormap.value);
+  opacity.addEventListener('input', redraw);
+  colormap.addEventListener('change', redraw);
+  redraw();
+}